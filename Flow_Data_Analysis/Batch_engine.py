@@ -0,0 +1,182 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from Flow_ingest import load_joined_samples
+from Flow_stream import stream_group_means
+from Flow_instrument import instrumented
+from Metric_spec import FILTER_SPEC
+from Replicate_stats import replicate_stats
+from Flow_cache import cache_dir as default_cache_dir, file_fingerprint, load_manifest, save_manifest
+from Lazy_import import lazy_import
+
+pd = lazy_import('pandas')
+
+# Bump this whenever process_plate changes so previously cached per-plate results are rebuilt
+ENGINE_VERSION = 5
+
+
+# Function to run the per-plate read -> plate-map join -> filter -> groupby stage
+def process_plate(sample_file_path, platemap_file_path, chunksize=None):
+    # Very large exports are streamed in bounded chunks instead of being loaded whole
+    if chunksize:
+        return stream_group_means(sample_file_path, platemap_file_path, chunksize=chunksize)
+
+    # Read the sample file and join it to the platemap based on well positions
+    df = load_joined_samples(sample_file_path, platemap_file_path)
+    return average_data(filter_data(df))
+
+
+# Function to keep the rows of the filter spec's gates (R6 on a methanogen Y Parameter unless another spec is given),
+# with only the columns the outputs carry
+@instrumented('filter')
+def filter_data(df, spec=FILTER_SPEC):
+    filtered_df = spec.select_rows(df)
+
+    # Select only the required columns
+    selected_columns = ['Plate', 'Sample_Name', 'Gate', 'Y Parameter', '%Gated']
+    return filtered_df[selected_columns]
+
+
+# Function to group filtered rows by 'Sample_Name' and calculate the mean %Gated, with the replicate statistics
+# (count, SD, CV, bootstrap CI, outliers and z-scores against the plate's controls) alongside it
+@instrumented('groupby')
+def average_data(filtered_data):
+    return replicate_stats(filtered_data, keys=['Sample_Name', 'Plate', 'Gate', 'Y Parameter'])
+
+
+# Function to pair every sample CSV with its '<base>_plate_map.csv' partner
+def find_plate_pairs(sample_dir, platemap_dir):
+    pairs = []
+    for sample_file in os.listdir(sample_dir):
+        if not sample_file.endswith('.csv'):
+            continue
+
+        base_name = os.path.splitext(sample_file)[0]
+        platemap_file_path = os.path.join(platemap_dir, f'{base_name}_plate_map.csv')
+
+        # Check if the plate map file exists
+        if not os.path.exists(platemap_file_path):
+            print(f"Plate map file for {sample_file} not found. Skipping.")
+            continue
+
+        pairs.append((sample_file, os.path.join(sample_dir, sample_file), platemap_file_path))
+    return pairs
+
+
+# Function to read the batch manifest, returning an empty one if it was written by an older version of the engine
+def load_batch_manifest(manifest_path):
+    manifest = load_manifest(manifest_path)
+    return manifest if manifest.get('version') == ENGINE_VERSION else {}
+
+
+# Function to tell which path process_plate takes: 'streamed' (means only) with a chunksize, 'full' otherwise
+def processing_mode(chunksize=None):
+    return 'streamed' if chunksize else 'full'
+
+
+# Function to name a plate's cached result after both content hashes and the processing mode, so any change to
+# either input, or switching between the streamed and full paths, invalidates it
+def plate_result_path(results_dir, sample_fp, platemap_fp, mode='full'):
+    return os.path.join(results_dir, f"{sample_fp['sha256'][:20]}_{platemap_fp['sha256'][:20]}_{mode}.pkl")
+
+
+# Function to cache one plate processed outside run_batch (e.g. by the watch folder), so later batches reuse it
+def store_plate_result(sample_file_path, platemap_file_path, averaged_data, summaries=None, cache_dir=None):
+    cache_dir = cache_dir or default_cache_dir
+    manifest_path = os.path.join(cache_dir, 'batch_manifest.json')
+    results_dir = os.path.join(cache_dir, 'plates')
+    os.makedirs(results_dir, exist_ok=True)
+
+    manifest = load_batch_manifest(manifest_path)
+    entries = manifest.get('plates', {})
+    sample_file = os.path.basename(sample_file_path)
+    entry = entries.get(sample_file, {})
+    sample_fp = file_fingerprint(sample_file_path, entry.get('sample'))
+    platemap_fp = file_fingerprint(platemap_file_path, entry.get('plate_map'))
+    result_path = plate_result_path(results_dir, sample_fp, platemap_fp, 'full')
+
+    averaged_data.to_pickle(result_path)
+    if entry.get('result') not in (None, result_path) and os.path.exists(entry['result']):
+        os.remove(entry['result'])
+    entries[sample_file] = {'sample': sample_fp, 'plate_map': platemap_fp, 'mode': 'full', 'result': result_path,
+                            'summaries': summaries or {}}
+    save_manifest(manifest_path, {'version': ENGINE_VERSION, 'plates': entries})
+    return result_path
+
+
+# Function to process every sample/plate map pair, reusing cached results for unchanged inputs
+def run_batch(sample_dir, platemap_dir, workers=1, cache_dir=None, rebuild=False, chunksize=None):
+    results, _ = run_batch_with_summaries(sample_dir, platemap_dir, workers=workers, cache_dir=cache_dir,
+                                          rebuild=rebuild, chunksize=chunksize)
+    return results
+
+
+# Function to run the batch and also return a small per-plate summary (e.g. control sums and counts).
+# Each summary is computed once when its plate is processed and kept in the manifest with the cached result.
+def run_batch_with_summaries(sample_dir, platemap_dir, summarize=None, workers=1, cache_dir=None, rebuild=False,
+                             chunksize=None):
+    cache_dir = cache_dir or default_cache_dir
+    manifest_path = os.path.join(cache_dir, 'batch_manifest.json')
+    results_dir = os.path.join(cache_dir, 'plates')
+    os.makedirs(results_dir, exist_ok=True)
+
+    # Start from an empty manifest if it was written by an older version of the engine
+    manifest = {} if rebuild else load_batch_manifest(manifest_path)
+    entries = manifest.get('plates', {})
+
+    mode = processing_mode(chunksize)
+    new_entries = {}
+    results = {}
+    pending = []
+    pairs = find_plate_pairs(sample_dir, platemap_dir)
+    for sample_file, sample_file_path, platemap_file_path in pairs:
+        entry = entries.get(sample_file, {})
+        sample_fp = file_fingerprint(sample_file_path, entry.get('sample'))
+        platemap_fp = file_fingerprint(platemap_file_path, entry.get('plate_map'))
+
+        result_path = plate_result_path(results_dir, sample_fp, platemap_fp, mode)
+        new_entries[sample_file] = {'sample': sample_fp, 'plate_map': platemap_fp, 'mode': mode, 'result': result_path}
+
+        # A result is reused only if it came from the same inputs and the same (streamed or full) path
+        if entry.get('mode') == mode and entry.get('result') == result_path and os.path.exists(result_path):
+            results[sample_file] = pd.read_pickle(result_path)
+            new_entries[sample_file]['summaries'] = entry.get('summaries', {})
+        else:
+            pending.append((sample_file, sample_file_path, platemap_file_path, result_path))
+
+    print(f"{len(pairs) - len(pending)} plate(s) unchanged, {len(pending)} to process.")
+
+    # Run the new or changed plates, in a process pool if more than one worker was requested
+    sample_paths = [p[1] for p in pending]
+    platemap_paths = [p[2] for p in pending]
+    chunksizes = [chunksize] * len(pending)
+    if workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            processed = list(pool.map(process_plate, sample_paths, platemap_paths, chunksizes))
+    else:
+        processed = [process_plate(s, p, c) for s, p, c in zip(sample_paths, platemap_paths, chunksizes)]
+
+    for (sample_file, _, _, result_path), averaged_data in zip(pending, processed):
+        averaged_data.to_pickle(result_path)
+        results[sample_file] = averaged_data
+
+    # Summarize only the plates that have no stored summary yet
+    summaries = {}
+    if summarize:
+        for sample_file, entry in new_entries.items():
+            stored = entry.setdefault('summaries', {})
+            if summarize.__name__ not in stored:
+                stored[summarize.__name__] = summarize(results[sample_file])
+            summaries[sample_file] = stored[summarize.__name__]
+
+    # Remove cached results that no longer belong to any input pair
+    keep = {entry['result'] for entry in new_entries.values()}
+    for file_name in os.listdir(results_dir):
+        file_path = os.path.join(results_dir, file_name)
+        if file_path not in keep:
+            os.remove(file_path)
+
+    save_manifest(manifest_path, {'version': ENGINE_VERSION, 'plates': new_entries})
+
+    # Return the per-plate results (and summaries) in the same order the sample files were found
+    return [results[sample_file] for sample_file, _, _ in pairs], [summaries.get(sample_file) for sample_file, _, _ in pairs]
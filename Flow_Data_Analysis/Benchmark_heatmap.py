@@ -0,0 +1,91 @@
+import argparse
+import time
+
+from Heatmap_matrix import amino_acids, build_heatmap_data, find_closest_match
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+# Function to build the heatmap the way Heat_map_v2.py used to: one iterrows pass with per-row lookups
+def legacy_heatmap_data(flow_data, mutation_data, sequence):
+    heatmap_data = pd.DataFrame(index=amino_acids, columns=[f"{aa}{i+1}" for i, aa in enumerate(sequence)])
+    heatmap_data = heatmap_data.astype(float)
+    unmatched = []
+
+    for _, row in flow_data.iterrows():
+        sample_name = row['Sample_Name']
+        try:
+            flow_value = float(row['%Gated'])
+        except ValueError:
+            flow_value = np.nan
+
+        matching_mutation = mutation_data[mutation_data['Name'] == sample_name]
+        if matching_mutation.empty:
+            closest_match = find_closest_match(sample_name, mutation_data['Name'].tolist())
+            if not closest_match:
+                unmatched.append((sample_name, closest_match))
+                continue
+            matching_mutation = mutation_data[mutation_data['Name'] == closest_match]
+
+        position = matching_mutation.iloc[0]['Mutated Residue']
+        amino_acid = matching_mutation.iloc[0]['Mutant AA']
+        if str(position).isdigit() and 1 <= int(position) <= len(sequence):
+            column_name = f"{sequence[int(position) - 1]}{position}"
+            if column_name in heatmap_data.columns and amino_acid in heatmap_data.index:
+                heatmap_data.at[amino_acid, column_name] = flow_value
+
+    return heatmap_data, unmatched
+
+
+# Function to generate a synthetic single-mutant library with its flow data
+def synthetic_library(variants, length, misspelled, seed=0):
+    rng = np.random.default_rng(seed)
+    residues = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+    sequence = ''.join(rng.choice(residues, size=length))
+
+    # Pick distinct (position, mutant amino acid) pairs that differ from the wild type
+    cells = [(p, aa) for p in range(1, length + 1) for aa in residues if aa != sequence[p - 1]]
+    picked = rng.choice(len(cells), size=min(variants, len(cells)), replace=False)
+    mutation_data = pd.DataFrame(
+        [(f"{sequence[p - 1]}{p}{aa}".lower(), p, aa) for p, aa in (cells[i] for i in picked)],
+        columns=['Name', 'Mutated Residue', 'Mutant AA'],
+    )
+
+    # Two replicates of most variants, a few misspelled names that need fuzzy matching, and the controls
+    names = list(mutation_data['Name']) + list(mutation_data['Name'].sample(frac=0.5, random_state=seed))
+    names += [f"{name}x" for name in mutation_data['Name'].sample(misspelled, random_state=seed + 1)]
+    names += ['nd', 'gb2004', 'bc96_none']
+    flow_data = pd.DataFrame({'Sample_Name': names, '%Gated': rng.uniform(0, 8, size=len(names))})
+    return flow_data, mutation_data, sequence
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the vectorized heatmap assembly against the iterrows loop.')
+    parser.add_argument('--variants', type=int, default=5000, help='Number of single mutants in the library')
+    parser.add_argument('--length', type=int, default=400, help='Protein length')
+    parser.add_argument('--misspelled', type=int, default=25, help='Number of sample names that need fuzzy matching')
+    args = parser.parse_args()
+
+    flow_data, mutation_data, sequence = synthetic_library(args.variants, args.length, args.misspelled)
+    print(f"{len(mutation_data)} variants, {len(flow_data)} flow rows, protein length {len(sequence)}")
+
+    start = time.perf_counter()
+    legacy, legacy_unmatched = legacy_heatmap_data(flow_data, mutation_data, sequence)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorized, unmatched = build_heatmap_data(flow_data, mutation_data, sequence)
+    vectorized_time = time.perf_counter() - start
+
+    # The output must be identical to the loop's
+    pd.testing.assert_frame_equal(legacy, vectorized)
+    assert legacy_unmatched == unmatched
+
+    print(f"iterrows loop: {legacy_time:.3f} s")
+    print(f"vectorized:    {vectorized_time:.3f} s ({legacy_time / vectorized_time:.0f}x faster)")
+
+
+if __name__ == '__main__':
+    main()
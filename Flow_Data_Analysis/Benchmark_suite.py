@@ -0,0 +1,475 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import contextlib
+import datetime
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from Plate_index import LAYOUTS
+from Compact_schema import concat_compact, frame_mb
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# The pipeline modules are imported inside the stages: each stage runs in a fresh process that must first
+# point FLOW_CACHE_DIR at the benchmark's own cache
+
+# Gates every synthetic export carries first (the scripts read R6 and R9); extra gates are R10, R11, ...
+BASE_GATES = ['R1', 'R3', 'R6', 'R9']
+Y_PARAMETERS = ['FL1-A methanogen', 'FSC-A']
+
+STAGES = ['ingest', 'join', 'filter', 'groupby', 'normalize', 'heatmap', 'render']
+
+history_file = 'benchmark_history.json'
+
+# Modules a command imports before it touches any data, each allowed this fraction of the time `import pandas`
+# takes on the same machine; none may load the libraries in DEFERRED_IMPORTS at import (they load on first use)
+IMPORT_BUDGETS = {'Flow_cli': 0.1, 'Results_store': 0.1, 'Filter_data': 0.35, 'Filter_avg_norm': 0.35,
+                  'Flow_watch': 0.35, 'Flow': 0.35, 'Flow_PI': 0.35, 'Plot_filtered': 0.35, 'Heat_map_v2': 0.35}
+DEFERRED_IMPORTS = ['pandas', 'numpy', 'pyarrow', 'matplotlib', 'seaborn', 'Bio.SeqIO', 'scipy']
+
+
+# Function to name the rows of a plate ('A'..'Z', then 'AA'..'AF' for 1536-well plates)
+def row_labels(n_rows):
+    return [chr(65 + i) if i < 26 else 'A' + chr(65 + i - 26) for i in range(n_rows)]
+
+
+# Function to write a plate map: gb2004 in the first column, ND in the last and variants everywhere else
+def write_plate_map(file_path, wells, variant_names, offset=0):
+    n_rows, n_columns = LAYOUTS[wells]
+    inner = n_rows * (n_columns - 2)
+    names = np.asarray(variant_names, dtype=object)[(offset + np.arange(inner)) % len(variant_names)]
+
+    layout = pd.DataFrame(names.reshape(n_rows, n_columns - 2), columns=[str(c) for c in range(2, n_columns)])
+    layout.insert(0, '1', 'gb2004')
+    layout[str(n_columns)] = 'ND'
+    layout.insert(0, 'Unnamed: 0', row_labels(n_rows))
+    layout.to_csv(file_path, index=False)
+
+
+# Function to write a cytometer gate-summary export: one row per well, gate and Y Parameter
+def write_gate_summary(file_path, plate, wells, gates, rng):
+    n_rows, n_columns = LAYOUTS[wells]
+    well_names = [f'{row}{column}' for row in row_labels(n_rows) for column in range(1, n_columns + 1)]
+    n = len(well_names) * len(gates) * len(Y_PARAMETERS)
+
+    export = pd.DataFrame({
+        'Plate': plate,
+        'Sample': np.repeat(well_names, len(gates) * len(Y_PARAMETERS)),
+        'Gate': np.tile(np.repeat(gates, len(Y_PARAMETERS)), len(well_names)),
+        'X Parameter': 'SSC-A',
+        'Y Parameter': np.tile(Y_PARAMETERS, len(well_names) * len(gates)),
+        '%Gated': rng.uniform(0, 8, size=n).round(2),
+        'Count': rng.integers(0, 50_000, size=n),
+    })
+    export.to_csv(file_path, index=False)
+
+
+# Function to write a mutation table with the columns Heat_map_v2.py reads
+def write_mutation_table(file_path, mutation_data):
+    mutation_data.to_csv(file_path, index=False)
+
+
+# Function to write a protein sequence as a GenPept record
+def write_genpept(file_path, sequence):
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+    from Bio import SeqIO
+    record = SeqRecord(Seq(sequence), id='SYNTH', name='SYNTH', description='synthetic benchmark protein',
+                       annotations={'molecule_type': 'protein'})
+    SeqIO.write(record, file_path, 'genbank')
+
+
+# Function to generate a complete synthetic campaign (exports, plate maps, mutation table, GenPept) under root
+def generate_campaign(root, plates=20, wells=96, gates=4, length=400, variants=2000, seed=0):
+    from Benchmark_heatmap import synthetic_library
+
+    rng = np.random.default_rng(seed)
+    gate_names = (BASE_GATES + [f'R{10 + i}' for i in range(max(gates - len(BASE_GATES), 0))])[:max(gates, 1)]
+    _, mutation_data, sequence = synthetic_library(variants, length, misspelled=0, seed=seed)
+
+    sample_dir = os.path.join(root, 'Flow_Files')
+    platemap_dir = os.path.join(root, 'Plate_Maps')
+    os.makedirs(sample_dir, exist_ok=True)
+    os.makedirs(platemap_dir, exist_ok=True)
+
+    pairs = []
+    n_rows, n_columns = LAYOUTS[wells]
+    for i in range(plates):
+        plate = f'synthetic_plate_{i:04d}'
+        sample_path = os.path.join(sample_dir, f'{plate}.csv')
+        platemap_path = os.path.join(platemap_dir, f'{plate}_plate_map.csv')
+        write_gate_summary(sample_path, plate, wells, gate_names, rng)
+        write_plate_map(platemap_path, wells, list(mutation_data['Name']), offset=i * n_rows * (n_columns - 2))
+        pairs.append((sample_path, platemap_path))
+
+    mutation_path = os.path.join(root, 'mutations.csv')
+    genpept_path = os.path.join(root, 'protein.gpt')
+    write_mutation_table(mutation_path, mutation_data)
+    write_genpept(genpept_path, sequence)
+    return {'root': root, 'sample_dir': sample_dir, 'platemap_dir': platemap_dir, 'pairs': pairs,
+            'mutation_file': mutation_path, 'genpept_file': genpept_path}
+
+
+# Function to read this process's peak resident set size in MB (None where the resource module is missing)
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KB on Linux
+
+
+# Context manager marking the timed part of a stage (its setup runs before it, untimed)
+class StageClock:
+    def __enter__(self):
+        self.setup_rss_mb = peak_rss_mb()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+
+
+# Function to make sure every plate's columnar copies exist, so warm stages don't pay for conversion
+def _warm_cache(campaign):
+    from Flow_ingest import _columnar_path
+    for sample_path, platemap_path in campaign['pairs']:
+        _columnar_path(sample_path, 'samples')
+        _columnar_path(platemap_path, 'plate_index')
+
+
+def _joined(campaign):
+    from Flow_ingest import load_joined_samples
+    _warm_cache(campaign)
+    return [load_joined_samples(s, p) for s, p in campaign['pairs']]
+
+
+def _averaged(campaign):
+    from Batch_engine import filter_data, average_data
+    return [average_data(filter_data(joined)) for joined in _joined(campaign)]
+
+
+def stage_ingest(campaign, clock):
+    from Flow_ingest import columnar_dir, load_samples, load_plate_index
+    shutil.rmtree(columnar_dir, ignore_errors=True)
+    with clock:
+        rows = sum(len(load_samples(sample_path)) for sample_path, _ in campaign['pairs'])
+        for _, platemap_path in campaign['pairs']:
+            load_plate_index(platemap_path)
+    return rows, rows
+
+
+def stage_join(campaign, clock):
+    from Flow_ingest import load_joined_samples
+    _warm_cache(campaign)
+    with clock:
+        rows = sum(len(load_joined_samples(s, p)) for s, p in campaign['pairs'])
+    return rows, rows
+
+
+def stage_filter(campaign, clock):
+    from Batch_engine import filter_data
+    joined = _joined(campaign)
+    with clock:
+        filtered = [filter_data(df) for df in joined]
+    return sum(map(len, joined)), sum(map(len, filtered))
+
+
+def stage_groupby(campaign, clock):
+    from Batch_engine import filter_data, average_data
+    filtered = [filter_data(df) for df in _joined(campaign)]
+    with clock:
+        averaged = [average_data(df) for df in filtered]
+    return sum(map(len, filtered)), sum(map(len, averaged))
+
+
+def stage_normalize(campaign, clock):
+    from Filter_avg_norm import control_stats, normalize_data
+    averaged = _averaged(campaign)
+    plate_stats = [control_stats(df) for df in averaged]
+    with clock:
+        normalized = normalize_data(concat_compact(averaged), plate_stats)
+    return len(normalized), len(normalized)
+
+
+def stage_heatmap(campaign, clock):
+    from Heat_map_v2 import safe_load_file, load_sequence, prepare_heatmap
+    flow_data = concat_compact(_averaged(campaign))
+    mutation_data = safe_load_file(campaign['mutation_file'])
+    sequence = load_sequence(campaign['genpept_file'])
+    with clock:
+        data_cleaned, _, _ = prepare_heatmap(flow_data, mutation_data, sequence)
+    return len(flow_data), int(data_cleaned.notna().sum().sum())
+
+
+def stage_render(campaign, clock):
+    import Plot_render
+    Plot_render.start_batch()
+    from Flow import filter_methanogen, plot_flow
+    from Heat_map_v2 import safe_load_file, load_sequence, prepare_heatmap, plot_heatmap
+
+    # Every plate's flow plot plus one heatmap, drawn off-screen the way the render command does
+    pairs = campaign['pairs'][:campaign['render_plates']]
+    joined = _joined(dict(campaign, pairs=pairs))
+    flow_data = concat_compact(_averaged(campaign))
+    heatmap = prepare_heatmap(flow_data, safe_load_file(campaign['mutation_file']),
+                              load_sequence(campaign['genpept_file']))
+    plots_dir = os.path.join(campaign['root'], 'plots')
+    with clock:
+        for (sample_path, _), df in zip(pairs, joined):
+            plot_flow(filter_methanogen(df.rename(columns={'Sample_Name': 'Mapped Sample'})), sample_path,
+                      save_dir=plots_dir, show=False)
+        plot_heatmap(*heatmap, output_folder=plots_dir)
+    return len(pairs) + 1, len(pairs) + 1
+
+
+STAGE_FUNCTIONS = {
+    'ingest': stage_ingest,
+    'join': stage_join,
+    'filter': stage_filter,
+    'groupby': stage_groupby,
+    'normalize': stage_normalize,
+    'heatmap': stage_heatmap,
+    'render': stage_render,
+}
+
+
+# Function to point a fresh stage process at the benchmark cache and a headless backend
+def _init_stage_process(cache_dir):
+    os.environ['FLOW_CACHE_DIR'] = cache_dir
+    os.environ['MPLBACKEND'] = 'Agg'
+    # The pipeline loads pandas and pyarrow on first use; load them here so the stages time their work, not the imports
+    import pandas, pyarrow.feather, pyarrow.parquet  # noqa: F401
+
+
+# Function to run one stage (inside its own process) and measure it; the scripts' own messages are silenced
+def run_stage(name, campaign):
+    clock = StageClock()
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows_in, rows_out = STAGE_FUNCTIONS[name](campaign, clock)
+    return {'seconds': round(clock.seconds, 4), 'peak_rss_mb': peak_rss_mb(), 'setup_rss_mb': clock.setup_rss_mb,
+            'rows_in': rows_in, 'rows_out': rows_out}
+
+
+# Function to run the chosen stages, each in a fresh process so peak RSS is the stage's own high-water mark
+def run_benchmark(campaign, stages=STAGES, cache_dir=None):
+    cache_dir = cache_dir or os.path.join(campaign['root'], '.flow_cache')
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for name in stages:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_init_stage_process,
+                                 initargs=(cache_dir,)) as pool:
+            results[name] = pool.submit(run_stage, name, campaign).result()
+        print(f"  {name:<10} {results[name]['seconds']:8.3f} s  peak RSS {results[name]['peak_rss_mb'] or 0:7.1f} MB  "
+              f"rows {results[name]['rows_in']} -> {results[name]['rows_out']}")
+    return results
+
+
+# Function to rebuild a table the way the pipeline used to hold it: object strings and float64 everywhere
+def legacy_frame(df):
+    return df.astype({column: object if isinstance(dtype, pd.CategoricalDtype) else np.float64
+                      for column, dtype in df.dtypes.items()
+                      if isinstance(dtype, pd.CategoricalDtype) or dtype == np.float32})
+
+
+# Function to measure every campaign table in the old layout and in the compact one (shared categoricals,
+# float32 where safe); runs in a stage process and returns {table: [old MB, compact MB]}
+def memory_footprint(campaign):
+    from Batch_engine import filter_data, average_data
+    from Filter_avg_norm import control_stats, normalize_data
+
+    joined = _joined(campaign)
+    filtered = [filter_data(df) for df in joined]
+    averaged = [average_data(df) for df in filtered]
+    plate_stats = [control_stats(df) for df in averaged]
+    tables = {
+        'joined': (pd.concat([legacy_frame(df) for df in joined], ignore_index=True), concat_compact(joined)),
+        'filtered': (pd.concat([legacy_frame(df) for df in filtered], ignore_index=True), concat_compact(filtered)),
+        'campaign': (normalize_data(pd.concat([legacy_frame(df) for df in averaged], ignore_index=True), plate_stats),
+                     normalize_data(concat_compact(averaged), plate_stats)),
+    }
+    return {name: [len(compact), frame_mb(old), frame_mb(compact)] for name, (old, compact) in tables.items()}
+
+
+# Function to print the memory report of a campaign
+def memory_report(campaign, cache_dir=None):
+    cache_dir = cache_dir or os.path.join(campaign['root'], '.flow_cache')
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_stage_process, initargs=(cache_dir,)) as pool:
+        report = pool.submit(memory_footprint, campaign).result()
+    for name, (rows, old_mb, compact_mb) in report.items():
+        print(f"  {name:<10} {rows:>10} rows  {old_mb:9.1f} MB -> {compact_mb:8.1f} MB  ({old_mb / compact_mb:5.1f}x smaller)")
+    return report
+
+
+# Function to return the short hash of the checked-out commit (None outside a git tree)
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Function to load the benchmark history ({'baselines': {config: run}, 'runs': [...]})
+def load_history(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'baselines': {}, 'runs': []}
+
+
+# Function to append a run to the history, making it the baseline for its configuration when asked (or when first)
+def record_run(path, run, set_baseline=False):
+    history = load_history(path)
+    history['runs'].append(run)
+    key = config_key(run['config'])
+    if set_baseline or key not in history['baselines']:
+        history['baselines'][key] = run
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp_path, path)
+    return history
+
+
+# Function to key runs by the campaign scale they measured
+def config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+
+# Function to compare a run with its baseline; returns the stages that got slower than the threshold allows
+def compare_to_baseline(run, baseline, threshold=0.2):
+    regressions = []
+    print(f"\nCompared with the baseline from {baseline['date']} ({baseline.get('revision') or 'unknown revision'}):")
+    for name, result in run['stages'].items():
+        reference = baseline['stages'].get(name)
+        if not reference or not reference['seconds']:
+            print(f"  {name:<10} no baseline")
+            continue
+        ratio = result['seconds'] / reference['seconds']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"  {name:<10} {reference['seconds']:8.3f} s -> {result['seconds']:8.3f} s  ({ratio:5.2f}x){flag}")
+    return regressions
+
+
+# Function to time `import module` in a fresh interpreter with -X importtime (best of `repeats`); returns the
+# seconds and the names of the modules it imported
+def import_time(module, repeats=3):
+    best, loaded = None, set()
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True,
+                                text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        rows = [line.split('|') for line in result.stderr.splitlines() if line.startswith('import time:')]
+        timings = {name.strip(): int(cumulative) for _, cumulative, name in rows if cumulative.strip().isdigit()}
+        loaded = set(timings)
+        seconds = timings[module] / 1e6
+        best = seconds if best is None else min(best, seconds)
+    return best, loaded
+
+
+# Function to list the DEFERRED_IMPORTS libraries a module loads at import, read from sys.modules of a fresh interpreter
+# (modules from lazy_import sit there unexecuted until first use, and are not counted)
+def eager_imports(module):
+    listing = ("print('\\n'.join(name for name, m in list(sys.modules.items()) "
+               "if type(m).__name__ != '_LazyModule'))")
+    result = subprocess.run([sys.executable, '-c', f'import sys, {module}; {listing}'],
+                            capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    loaded = set(result.stdout.split())
+    return [name for name in DEFERRED_IMPORTS if any(m == name or m.startswith(name + '.') for m in loaded)]
+
+
+# Function to check every module of IMPORT_BUDGETS against its budget; returns the modules over budget
+def check_import_budgets(budgets=IMPORT_BUDGETS):
+    reference, _ = import_time('pandas')
+    print(f"import pandas takes {reference:.3f} s here")
+    failures = []
+    for module, fraction in budgets.items():
+        seconds, loaded = import_time(module)
+        eager = [name for name in DEFERRED_IMPORTS if any(m == name or m.startswith(name + '.') for m in loaded)]
+        flag = ''
+        if seconds > fraction * reference or eager:
+            flag = '  OVER BUDGET' + (f" (imports {', '.join(eager)})" if eager else '')
+            failures.append(module)
+        print(f"  {module:<16} {seconds:6.3f} s  budget {fraction * reference:6.3f} s{flag}")
+    return failures
+
+
+def build_parser(parser=None):
+    parser = parser or argparse.ArgumentParser(description='Benchmark every pipeline stage on a synthetic campaign.')
+    parser.add_argument('--plates', type=int, default=20, help='Number of plates in the campaign')
+    parser.add_argument('--wells', type=int, default=96, choices=sorted(LAYOUTS), help='Wells per plate')
+    parser.add_argument('--gates', type=int, default=4, help='Gates per well (R1, R3, R6, R9, then R10, ...)')
+    parser.add_argument('--length', type=int, default=400, help='Protein length')
+    parser.add_argument('--variants', type=int, default=2000, help='Number of single mutants in the library')
+    parser.add_argument('--render-plates', type=int, default=3, help='Plates drawn in the render stage')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--workdir', help='Folder for the synthetic campaign (default: a fresh temporary folder)')
+    parser.add_argument('--history', default=history_file, help='JSON file the runs are appended to')
+    parser.add_argument('--set-baseline', action='store_true', help='Make this run the baseline for its scale')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown (fraction) reported as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Exit with status 1 on a regression')
+    parser.add_argument('--memory', action='store_true',
+                        help='Only report the memory footprint of the campaign tables, old layout vs compact')
+    parser.add_argument('--imports', action='store_true',
+                        help='Only check the import-time budgets (exit status 1 when a module is over budget)')
+    return parser
+
+
+# Function to generate the campaign, run the stages, record the run and compare it with the baseline
+def run(args):
+    import tempfile
+
+    if args.imports:
+        return 1 if check_import_budgets() else 0
+
+    config = {'plates': args.plates, 'wells': args.wells, 'gates': args.gates, 'length': args.length,
+              'variants': args.variants, 'render_plates': args.render_plates}
+    workdir = args.workdir or tempfile.mkdtemp(prefix='flow_benchmark_')
+    try:
+        start = time.perf_counter()
+        campaign = generate_campaign(workdir, args.plates, args.wells, args.gates, args.length, args.variants)
+        campaign['render_plates'] = args.render_plates
+        print(f"Generated {args.plates} plate(s) of {args.wells} wells in {time.perf_counter() - start:.1f} s ({workdir})")
+
+        if args.memory:
+            memory_report(campaign)
+            return 0
+        stages = run_benchmark(campaign, [name for name in STAGES if name in args.stages])
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    record = {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'revision': git_revision(),
+              'python': sys.version.split()[0], 'pandas': pd.__version__, 'config': config, 'stages': stages}
+    previous = load_history(args.history)['baselines'].get(config_key(config))
+    record_run(args.history, record, set_baseline=args.set_baseline)
+    print(f"Run recorded in {args.history}")
+
+    regressions = compare_to_baseline(record, previous, args.threshold) if previous else []
+    if not previous:
+        print("No baseline for this scale yet; this run is now the baseline.")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+def main():
+    return run(build_parser().parse_args())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Label columns that repeat on almost every row; held as categoricals (one small dictionary plus integer codes)
+LABEL_COLUMNS = ['Plate', 'Sample', 'Sample_Name', 'Mapped Sample', 'Category', 'Gate', 'Y Parameter']
+
+# A measurement is stored as float32 only when every value has at most this many decimals and stays below this
+# magnitude (at most 7 significant digits), so float32 still holds it exactly to the precision it was recorded with
+FLOAT32_DECIMALS = 4
+FLOAT32_MAX_ABS = 1000
+
+
+# Function to tell whether float32 keeps every value of a column to the precision it was recorded with
+def float32_safe(values):
+    values = np.asarray(values, dtype=float)
+    finite = values[np.isfinite(values)]
+    return bool(np.all(np.abs(finite) < FLOAT32_MAX_ABS)
+                and np.allclose(np.round(finite, FLOAT32_DECIMALS), finite, rtol=0, atol=1e-9))
+
+
+# Function to shrink a table in place: label columns become categoricals and float64 measurements become float32
+# where float32_safe allows (means, SDs and other derived values keep float64)
+def compact_frame(df, label_columns=LABEL_COLUMNS):
+    for column in df.columns:
+        dtype = df[column].dtype
+        if column in label_columns:
+            if not isinstance(dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype('category')
+        elif dtype == np.float64 and float32_safe(df[column]):
+            df[column] = df[column].astype(np.float32)
+    return df
+
+
+# Function to concatenate per-plate tables without losing their categoricals: pd.concat falls back to object
+# strings when the plates' categories differ, so each label column is first given the union of every plate's
+# categories (sorted, as astype('category') would) and all plates share that one dictionary
+def concat_compact(frames):
+    frames = list(frames)
+    categorical = {column for frame in frames for column in frame.columns
+                   if isinstance(frame[column].dtype, pd.CategoricalDtype)}
+
+    shared = {}
+    for column in categorical:
+        labels = [frame[column].astype('category') for frame in frames if column in frame.columns]
+        categories = pd.Index([]).append([values.cat.categories for values in labels]).unique()
+        try:
+            categories = categories.sort_values()
+        except TypeError:
+            pass  # labels of mixed types keep their first-seen order
+        shared[column] = categories
+
+    frames = [frame.assign(**{column: frame[column].astype('category').cat.set_categories(categories)
+                              for column, categories in shared.items() if column in frame.columns})
+              for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+# Function to cut every label at its first '.' (e.g. '12.0' -> '12') exactly as str(x).split('.')[0] did,
+# but once per distinct label instead of once per row; returns a categorical Series
+def strip_decimal_suffix(values):
+    labels = values.astype('category')
+
+    # Missing labels (code -1) pick the trailing 'nan' entry, as str(nan) did
+    cleaned = pd.Index(list(labels.cat.categories.astype(str).str.split('.', n=1).str[0]) + ['nan'])
+    categories = cleaned.unique()
+    codes = categories.get_indexer(cleaned)[labels.cat.codes.to_numpy()]
+    stripped = pd.Categorical.from_codes(codes, categories=categories).remove_unused_categories()
+    return pd.Series(stripped, index=values.index, name=values.name)
+
+
+# Function to read a measurement column as float64 values; float32 columns are rounded back to their recorded
+# decimals (4.33, not 4.329999923...), which float32_safe guaranteed they had
+def float64_values(values):
+    values = pd.to_numeric(values, errors='coerce')
+    if values.dtype == np.float32:
+        return np.round(values.to_numpy(dtype=np.float64), FLOAT32_DECIMALS)
+    return values.to_numpy(dtype=float)
+
+
+# Function to turn float32 columns back into float64 before a table leaves for a format that only holds float64
+# (the results store, Excel)
+def widen_float32(df):
+    columns = [column for column in df.columns if df[column].dtype == np.float32]
+    if not columns:
+        return df
+    return df.assign(**{column: float64_values(df[column]) for column in columns})
+
+
+# Function to measure a table's memory footprint in MB, strings included
+def frame_mb(df):
+    return df.memory_usage(deep=True).sum() / (1 << 20)
@@ -0,0 +1,181 @@
+import os
+import re
+
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Well names as they appear in keywords or file names ('A1', 'A01', 'H12', 'AF48')
+WELL_PATTERN = re.compile(r'(?<![A-Za-z0-9])([A-Z]{1,2})0*([1-9]\d?)(?![0-9])')
+
+# Keywords instruments use to record the well a file was acquired from
+WELL_KEYWORDS = ['$WELLID', 'WELL ID', 'WELLID', 'WELL', '$SMNO']
+
+
+# Function to parse the TEXT segment into a keyword dictionary (keywords upper-cased)
+def parse_text_segment(raw):
+    delimiter = raw[:1]
+    body = raw[1:]
+
+    # A doubled delimiter is an escaped literal delimiter inside a value
+    placeholder = '\0'
+    parts = body.replace(delimiter * 2, placeholder).split(delimiter)
+    parts = [part.replace(placeholder, delimiter) for part in parts]
+    if parts and parts[-1] == '':
+        parts = parts[:-1]
+    return {parts[i].strip().upper(): parts[i + 1].strip() for i in range(0, len(parts) - 1, 2)}
+
+
+# Function to build the NumPy structured dtype of one event from the TEXT keywords
+def event_dtype(text, channels):
+    byte_order = '<' if text.get('$BYTEORD', '1,2,3,4').startswith('1') else '>'
+    data_type = text.get('$DATATYPE', 'F').upper()
+
+    fields = []
+    for i, channel in enumerate(channels, start=1):
+        if data_type == 'F':
+            fields.append((channel, f'{byte_order}f4'))
+        elif data_type == 'D':
+            fields.append((channel, f'{byte_order}f8'))
+        elif data_type == 'I':
+            bits = int(text[f'$P{i}B'])
+            if bits not in (8, 16, 32, 64):
+                raise ValueError(f"Bit-packed integer data ({bits} bits for parameter {i}) is not supported.")
+            fields.append((channel, f'{byte_order}u{bits // 8}'))
+        else:
+            raise ValueError(f"Unsupported $DATATYPE '{data_type}'.")
+    return np.dtype(fields)
+
+
+# Function to normalize a well name to the 'A1' form used in the Sample column of gate summaries
+def normalize_well(value):
+    match = WELL_PATTERN.search(str(value).upper())
+    return f'{match.group(1)}{int(match.group(2))}' if match else None
+
+
+# One FCS 3.0/3.1 file; events are a read-only memory map of the DATA segment, nothing is loaded up front
+class FcsFile:
+    def __init__(self, file_path):
+        self.path = file_path
+
+        with open(file_path, 'rb') as f:
+            header = f.read(58)
+            self.version = header[:6].decode('ascii')
+            if not self.version.startswith('FCS'):
+                raise ValueError(f"{file_path} is not an FCS file.")
+
+            offsets = [int(header[i:i + 8].strip() or 0) for i in range(10, 58, 8)]
+            text_start, text_end, data_start, data_end = offsets[:4]
+            f.seek(text_start)
+            self.text = parse_text_segment(f.read(text_end - text_start + 1).decode('latin-1'))
+
+        # Offsets beyond 99,999,999 bytes do not fit the header and are only given in TEXT
+        if data_start == 0 and data_end == 0:
+            data_start = int(self.text['$BEGINDATA'])
+            data_end = int(self.text['$ENDDATA'])
+
+        if self.text.get('$MODE', 'L').upper() != 'L':
+            raise ValueError(f"{file_path}: only list-mode ($MODE L) data is supported.")
+
+        parameters = int(self.text['$PAR'])
+        self.channels = self._unique([self.text.get(f'$P{i}N', f'P{i}') for i in range(1, parameters + 1)])
+        self.labels = [self.text.get(f'$P{i}S', '') for i in range(1, parameters + 1)]
+
+        dtype = event_dtype(self.text, self.channels)
+        events = int(self.text.get('$TOT', (data_end - data_start + 1) // dtype.itemsize))
+        self.events = np.memmap(file_path, dtype=dtype, mode='r', offset=data_start, shape=(events,))
+
+        # Well the file was acquired from: a keyword first, otherwise the file name
+        self.well = None
+        for keyword in WELL_KEYWORDS:
+            if keyword in self.text:
+                self.well = normalize_well(self.text[keyword])
+                if self.well:
+                    break
+        if not self.well:
+            self.well = normalize_well(os.path.splitext(os.path.basename(file_path))[0].split('_')[-1])
+
+    @staticmethod
+    def _unique(names):
+        seen = {}
+        unique = []
+        for name in names:
+            seen[name] = seen.get(name, 0) + 1
+            unique.append(name if seen[name] == 1 else f'{name}_{seen[name]}')
+        return unique
+
+    def __len__(self):
+        return len(self.events)
+
+    # Function to return one channel as a (zero-copy) NumPy array
+    def channel(self, name):
+        return self.events[name]
+
+    # Function to return selected channels as a DataFrame with a 'Sample' (well) column for the plate-map join
+    def to_frame(self, channels=None):
+        channels = channels or self.channels
+        df = pd.DataFrame({name: np.asarray(self.events[name]) for name in channels})
+        df.insert(0, 'Sample', self.well)
+        return df
+
+
+# Function to open an FCS file
+def read_fcs(file_path):
+    return FcsFile(file_path)
+
+
+# Function to open every FCS file of a folder (memory-mapped, so a 96-well plate costs almost no RAM), keyed by well.
+# Two files of the same well (e.g. a re-acquired well) are an error rather than one silently replacing the other.
+def read_fcs_dir(fcs_dir):
+    files = {}
+    for file_name in sorted(os.listdir(fcs_dir)):
+        if file_name.lower().endswith('.fcs'):
+            fcs = read_fcs(os.path.join(fcs_dir, file_name))
+            key = fcs.well or file_name
+            if key in files:
+                raise ValueError(f"{file_name} and {os.path.basename(files[key].path)} are both well {key}; "
+                                 f"move the one that should not be gated out of {fcs_dir}.")
+            files[key] = fcs
+    return files
+
+
+# Function to write a float32 list-mode FCS 3.1 file, e.g. synthetic plates for tests and benchmarks
+def write_fcs(file_path, events, text=None):
+    channels = list(events.keys()) if isinstance(events, dict) else list(events.dtype.names)
+    data = np.empty(len(events[channels[0]]), dtype=[(name, '<f4') for name in channels])
+    for name in channels:
+        data[name] = events[name]
+    data_bytes = data.tobytes()
+
+    keywords = {'$BYTEORD': '1,2,3,4', '$DATATYPE': 'F', '$MODE': 'L', '$NEXTDATA': '0',
+                '$PAR': str(len(channels)), '$TOT': str(len(data))}
+    for i, name in enumerate(channels, start=1):
+        keywords.update({f'$P{i}N': name, f'$P{i}B': '32', f'$P{i}E': '0,0', f'$P{i}R': '262144'})
+    keywords.update(text or {})
+
+    # TEXT starts right after the 58-byte header; the data offsets are written into TEXT at a fixed width
+    text_start = 58
+    data_start = 0
+    while True:
+        keywords['$BEGINDATA'] = f'{data_start:020d}'
+        keywords['$ENDDATA'] = f'{data_start + max(len(data_bytes) - 1, 0):020d}'
+        segment = '|' + ''.join(f"{k.replace('|', '||')}|{str(v).replace('|', '||')}|" for k, v in keywords.items())
+        segment = segment.encode('latin-1')
+        if data_start == text_start + len(segment):
+            break
+        data_start = text_start + len(segment)
+
+    data_end = data_start + len(data_bytes) - 1
+    if data_end > 99_999_999:
+        data_start_field, data_end_field = 0, 0
+    else:
+        data_start_field, data_end_field = data_start, data_end
+
+    header = b'FCS3.1    ' + b''.join(f'{value:>8d}'.encode('ascii') for value in (
+        text_start, text_start + len(segment) - 1, data_start_field, data_end_field, 0, 0))
+
+    with open(file_path, 'wb') as f:
+        f.write(header)
+        f.write(segment)
+        f.write(data_bytes)
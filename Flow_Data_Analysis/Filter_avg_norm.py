@@ -1,86 +1,128 @@
 import os
-import pandas as pd
+import argparse
 import datetime
 
+from Batch_engine import run_batch_with_summaries
+from Flow_stream import RunningMean
+from Flow_instrument import instrumented
+from Result_io import write_results
+from Results_store import append_results
+from Replicate_stats import ND_SAMPLE, BC96_NONE_SAMPLE
+from Compact_schema import concat_compact, float64_values
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
 # Define the directories containing sample files and plate map files
 sample_dir = 'Flow_Files'
 platemap_dir = 'Plate_Maps'
 
-# Specify the output directory and file
+# Specify the output directory
 output_dir = 'spreadsheets'
-os.makedirs(output_dir, exist_ok=True)  # Create the directory if it doesn't exist
-
-# Generate a unique filename based on the current timestamp
-current_time = datetime.datetime.now().strftime('%Y%m%d_%H%M')
-output_file_path = os.path.join(output_dir, f'concatenated_averaged_data_{current_time}.xlsx')
-
-# Initialize an empty list to hold the processed DataFrames
-all_data = []
-
-# Iterate over all sample files in the directory
-for sample_file in os.listdir(sample_dir):
-    if sample_file.endswith('.csv'):
-        # Construct the full path to the sample file
-        sample_file_path = os.path.join(sample_dir, sample_file)
-
-        # Extract the base name of the sample file (without the extension)
-        base_name = os.path.splitext(sample_file)[0]
-
-        # Construct the corresponding plate map file path
-        platemap_file_path = os.path.join(platemap_dir, f'{base_name}_plate_map.csv')
-
-        # Check if the plate map file exists
-        if not os.path.exists(platemap_file_path):
-            print(f"Plate map file for {sample_file} not found. Skipping.")
-            continue
-
-        # Read the sample file into a DataFrame
-        sample_df = pd.read_csv(sample_file_path)
 
-        # Read the plate map file into a DataFrame
-        platemap_df = pd.read_csv(platemap_file_path, encoding='ISO-8859-1')  # or 'latin1'
-
-        # Reshape the platemap DataFrame to get well names in format 'A1', 'B2', etc.
-        platemap_df_melted = platemap_df.melt(id_vars=['Unnamed: 0'], var_name='Column', value_name='Sample_Name')
-        platemap_df_melted['Well'] = platemap_df_melted['Unnamed: 0'] + platemap_df_melted['Column'].astype(str)
-
-        # Merge the sample information with the platemap based on well positions
-        df = sample_df.merge(platemap_df_melted[['Well', 'Sample_Name']], left_on='Sample', right_on='Well', how='left')
-
-        # Drop unnecessary columns after merging
-        df = df.drop(columns=['Well'])
-
-        # Filter df for 'Gate' == 'R6' and 'Y Parameter' containing 'methanogen'
-        filtered_df1 = df[(df['Gate'] == 'R6') & (df['Y Parameter'].str.contains('methanogen', case=False, na=False))]
-
-        # Select only the required columns
-        selected_columns = ['Plate', 'Sample_Name', 'Gate', 'Y Parameter', '%Gated']
-        filtered_data = filtered_df1[selected_columns]
-
-        # Group by 'Sample_Name' and calculate the mean for numeric columns
-        averaged_data = filtered_data.groupby(['Sample_Name', 'Plate', 'Gate', 'Y Parameter'], as_index=False).mean()
+# Set to True to normalize each plate against its own ND and gb2004 controls instead of the campaign-wide means
+normalize_per_plate = False
+
+# Set to False to skip appending the averaged table to the results store (flow_results.sqlite)
+store_results = True
+
+
+# Function to compute one plate's control %Gated sums and counts (stored with the plate's cached result)
+def control_stats(averaged_data):
+    controls = averaged_data[averaged_data['Sample_Name'].isin([ND_SAMPLE, BC96_NONE_SAMPLE])]
+    aggregator = RunningMean(['Sample_Name'])
+    aggregator.update(controls.assign(Sample_Name=controls['Sample_Name'].astype(str)))
+    return aggregator.to_records()
+
+
+# Function to merge the per-plate control sums and counts into the campaign-wide ND and bc96_none means
+def control_values(plate_stats):
+    aggregator = RunningMean(['Sample_Name'])
+    for records in plate_stats:
+        aggregator.merge(RunningMean.from_records(['Sample_Name'], records))
+    means = aggregator.result().set_index('Sample_Name')['%Gated']
+    return means.get(ND_SAMPLE, np.nan), means.get(BC96_NONE_SAMPLE, np.nan)
+
+
+# Function to normalize %Gated against the ND and gb2004 (bc96_none) controls.
+# By default the controls are averaged over the whole campaign (from plate_stats when given, so only
+# new plates are scanned); per_plate normalizes each plate against its own controls.
+@instrumented('normalize')
+def normalize_data(concatenated_data, plate_stats=None, per_plate=False):
+    gated = pd.Series(float64_values(concatenated_data['%Gated']), index=concatenated_data.index)
+    if per_plate:
+        # Each plate's ND and bc96_none means, broadcast back onto its rows in one groupby-transform
+        sample_names = concatenated_data['Sample_Name']
+        controls = pd.DataFrame({'ND': gated.where(sample_names == ND_SAMPLE),
+                                 'bc96_none': gated.where(sample_names == BC96_NONE_SAMPLE)})
+        plate_controls = controls.groupby(concatenated_data['Plate'], observed=True).transform('mean')
+        ND_value, bc96_none_value = plate_controls['ND'], plate_controls['bc96_none']
+    elif plate_stats is not None:
+        ND_value, bc96_none_value = control_values(plate_stats)
+    else:
+        ND_value, bc96_none_value = control_values([control_stats(concatenated_data)])
+
+    # Normalize %Gated values for every row in one vectorized expression
+    concatenated_data['Normalized %Gated'] = (ND_value - gated) / (ND_value - bc96_none_value)
+
+    # The CI bounds go through the same transform; it flips their order when ND is above bc96_none
+    if '%Gated CI Low' in concatenated_data.columns:
+        low = (ND_value - concatenated_data['%Gated CI Low']) / (ND_value - bc96_none_value)
+        high = (ND_value - concatenated_data['%Gated CI High']) / (ND_value - bc96_none_value)
+        concatenated_data['Normalized CI Low'] = np.fmin(low, high)
+        concatenated_data['Normalized CI High'] = np.fmax(low, high)
+    return concatenated_data
+
+
+# Function to average and normalize every plate of a campaign and save the table; returns its path (or None)
+def average_and_normalize(sample_dir=sample_dir, platemap_dir=platemap_dir, output_dir=output_dir, workers=1,
+                          rebuild=False, chunksize=None, excel=False, per_plate=normalize_per_plate,
+                          store=store_results):
+    os.makedirs(output_dir, exist_ok=True)  # Create the directory if it doesn't exist
+
+    # Generate a unique filename based on the current timestamp
+    current_time = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+    output_file_path = os.path.join(output_dir, f'concatenated_averaged_data_{current_time}.parquet')
+
+    # Process every sample/plate map pair; only new or changed pairs are read again
+    # Each plate's control sums and counts are computed once and kept with its cached result
+    all_data, plate_stats = run_batch_with_summaries(sample_dir, platemap_dir, summarize=control_stats, workers=workers,
+                                                     rebuild=rebuild, chunksize=chunksize)
+
+    # Concatenate all processed DataFrames into a single DataFrame
+    if not all_data:
+        print("No data to concatenate. Ensure sample and plate map files are correctly paired.")
+        return None
+
+    # The plates share one categorical dictionary per label column instead of repeating the strings on every row
+    concatenated_data = normalize_data(concat_compact(all_data), plate_stats, per_plate=per_plate)
+
+    # Save the concatenated data into a Parquet file
+    write_results(concatenated_data, output_file_path, excel=excel)
+    print(f"Concatenated averaged data saved to {output_file_path}")
 
-        # Append the processed DataFrame to the list
-        all_data.append(averaged_data)
+    # Keep the table in the results store too, so it can be queried across campaigns
+    if store:
+        append_results(concatenated_data, 'averaged', source=output_file_path)
+    return output_file_path
 
-# Concatenate all processed DataFrames into a single DataFrame
-if all_data:
-    concatenated_data = pd.concat(all_data, ignore_index=True)
 
-    # Calculate averaged ND and bc96_none values from the concatenated data
-    ND_data = concatenated_data[concatenated_data['Sample_Name'] == 'ND']
-    ND_value = ND_data['%Gated'].mean()
+def main():
+    parser = argparse.ArgumentParser(description='Average and normalize every plate in Flow_Files.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used for the per-plate stage')
+    parser.add_argument('--rebuild', action='store_true', help='Ignore cached per-plate results and process every plate')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='Stream each sample file in chunks of this many rows (for very large per-event exports)')
+    parser.add_argument('--excel', action='store_true', help='Also write an .xlsx copy of the results (in the background)')
+    parser.add_argument('--per-plate', action='store_true', default=normalize_per_plate,
+                        help="Normalize each plate against its own ND and gb2004 controls")
+    parser.add_argument('--no-store', action='store_true', help='Do not append the table to the results store')
+    args = parser.parse_args()
 
-    bc96_none_data = concatenated_data[concatenated_data['Sample_Name'] == 'gb2004']
-    bc96_none_value = bc96_none_data['%Gated'].mean()
+    average_and_normalize(workers=args.workers, rebuild=args.rebuild, chunksize=args.chunksize, excel=args.excel,
+                          per_plate=args.per_plate, store=not args.no_store)
 
-    # Normalize %Gated values for each row using the calculated ND and bc96_none values
-    concatenated_data['Normalized %Gated'] = concatenated_data['%Gated'].apply(
-        lambda x: (ND_value - x) / (ND_value - bc96_none_value)
-    )
 
-    # Save the concatenated data into an Excel file
-    concatenated_data.to_excel(output_file_path, index=False)
-    print(f"Concatenated averaged data saved to {output_file_path}")
-else:
-    print("No data to concatenate. Ensure sample and plate map files are correctly paired.")
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,70 @@
 import os
-import pandas as pd
+
+from Batch_engine import filter_data
+from Metric_spec import FILTER_SPEC, load_metric_spec
+from Flow_ingest import load_joined_samples
+from Flow_stream import stream_filtered_rows
+from Result_io import write_results, write_chunks, export_excel as export_excel_copy, read_results
+from Results_store import append_results
+from Compact_schema import compact_frame
 
 # Load the sample file and the platemap file
 sample_file_path = '20241204_RFF OP1 col12 rpt_CB.csv'
 platemap_file_path = '20241203_OG1 rpt_RF + TXTL plate map.csv'
 
-# Extract the base name of the sample file (without the extension)
-base_name = os.path.splitext(os.path.basename(sample_file_path))[0]
+# Set to True to also write an .xlsx copy of the results (written in the background)
+export_excel = False
 
-# Read the sample file into a DataFrame
-sample_df = pd.read_csv(sample_file_path)
+# Set to a row count (e.g. 1_000_000) to stream very large per-event exports in chunks of that size
+stream_chunksize = None
 
-# Read the platemap file into a DataFrame
-platemap_df = pd.read_csv(platemap_file_path, encoding='ISO-8859-1')  # or 'latin1' as an alternative
+# Set to a JSON or YAML spec listing the gates to keep (e.g. R3 as well as R6); None keeps R6 on methanogen
+filter_spec_file = None
 
-# Reshape the platemap DataFrame to get well names in format 'A1', 'B2', etc.
-platemap_df_melted = platemap_df.melt(id_vars=['Unnamed: 0'], var_name='Column', value_name='Sample_Name')
-platemap_df_melted['Well'] = platemap_df_melted['Unnamed: 0'] + platemap_df_melted['Column'].astype(str)
+# Set to False to skip appending the filtered rows to the results store (flow_results.sqlite)
+store_results = True
 
-# Merge the sample information with the platemap based on well positions
-df = sample_df.merge(platemap_df_melted[['Well', 'Sample_Name']], left_on='Sample', right_on='Well', how='left')
+# Specify the output directory
+output_dir = '/home/themagikscientist/Flow_Data_Analysis/Spreadsheets'
 
-# Drop unnecessary columns after merging
-df = df.drop(columns=['Well'])
+# Select only the required columns
+selected_columns = ['Plate', 'Sample_Name', 'Gate', 'Y Parameter', '%Gated']
 
-# Filter df for 'Gate' == 'R6' and 'Y Parameter' containing 'methanogen'
-filtered_df1 = df[(df['Gate'] == 'R6') & (df['Y Parameter'].str.contains('methanogen', case=False, na=False))]
 
-# Filter df2 similarly
-# filtered_df2 = df[(df['Gate'] == 'R3') & (df['Y Parameter'].str.contains('methanogen', case=False, na=False))]
+# Function to filter one sample file and save the rows next to its base name
+def filter_file(sample_file_path, platemap_file_path, output_dir=output_dir, export_excel=export_excel,
+                stream_chunksize=stream_chunksize, store=store_results, spec_file=filter_spec_file):
+    spec = load_metric_spec(spec_file) if spec_file else FILTER_SPEC
 
-# Concatenate the filtered dataframes
-#concatenated_df = pd.concat([filtered_df1, filtered_df2])
-# If needed in the future, change Line 39 also
+    # Extract the base name of the sample file (without the extension)
+    base_name = os.path.splitext(os.path.basename(sample_file_path))[0]
 
-# Select only the required columns
-selected_columns = ['Plate', 'Sample_Name', 'Gate', 'Y Parameter', '%Gated']
-filtered_data = filtered_df1[selected_columns]
+    # Specify the output file path using the same base name as the sample file
+    os.makedirs(output_dir, exist_ok=True)  # Create the directory if it doesn't exist
+    output_file_path = os.path.join(output_dir, f'{base_name}_filtered_data.parquet')
 
-# Specify the output file path using the same base name as the sample file
-output_dir = '/home/themagikscientist/Flow_Data_Analysis/Spreadsheets'
-os.makedirs(output_dir, exist_ok=True)  # Create the directory if it doesn't exist
-output_file_path = os.path.join(output_dir, f'{base_name}_filtered_data.xlsx')
+    if stream_chunksize:
+        # Filter and join the plate map chunk by chunk, appending each chunk's rows to the Parquet file
+        chunks = stream_filtered_rows(sample_file_path, platemap_file_path, spec=spec, chunksize=stream_chunksize)
+        write_chunks((chunk[selected_columns] for chunk in chunks), output_file_path)
+        if export_excel or store:
+            filtered_data = compact_frame(read_results(output_file_path))
+        if export_excel:
+            export_excel_copy(filtered_data, os.path.splitext(output_file_path)[0] + '.xlsx')
+    else:
+        # Read the sample file and join it to the platemap based on well positions
+        df = load_joined_samples(sample_file_path, platemap_file_path)
+
+        # Save the filtered results into a Parquet file
+        filtered_data = filter_data(df, spec)
+        write_results(filtered_data, output_file_path, excel=export_excel)
+
+    if store:
+        append_results(filtered_data, 'filtered', source=output_file_path)
+
+    print(f"Filtered data saved to {output_file_path}")
+    return output_file_path
 
-# Save the results into an Excel file
-filtered_data.to_excel(output_file_path, index=False)
 
-print(f"Filtered data saved to {output_file_path}")
+if __name__ == '__main__':
+    filter_file(sample_file_path, platemap_file_path)
@@ -1,91 +1,103 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import os
 
+from Flow_ingest import load_samples, load_plate_index
+from Flow_stream import stream_filtered_rows
+from Metric_spec import FILTER_SPEC
+from Plot_render import MARKERS, new_figure, save_figure, draw_points_and_means
+from Replicate_stats import replicate_stats
+from Compact_schema import compact_frame, strip_decimal_suffix
+from Lazy_import import lazy_import
+
+pd = lazy_import('pandas')
+sns = lazy_import('seaborn')
+
 # User inputs: Sample file and plate map file
 sample_file = '20241205_RFF OG3_plt2_CB.csv'  # User-provided sample file
 plate_map_file = '20241205_OP3_RF + TXTL plate map 2.csv'  # User-provided plate map file
-
-# Load datasets
-sample_data = pd.read_csv(sample_file, encoding='ISO-8859-1')
-plate_map_data = pd.read_csv(plate_map_file, encoding='ISO-8859-1')
-
-# Function to create a mapping from the plate map dataframe
-def create_plate_map_mapping(df):
-    mapping = {}
-    for row in df.itertuples():
-        for col in range(1, len(df.columns)):
-            cell_label = f"{row[1]}{col}"  # e.g., "A1", "B2", etc.
-            mapping[cell_label] = row[col + 1]
-    return mapping
+stream_chunksize = None  # Set to a row count (e.g. 1_000_000) to stream very large per-event exports
 
 # Apply plate map to sample data to enrich it
-def apply_plate_map(sample_data, plate_map):
-    # Creating a mapping from the plate map
-    plate_mapping = create_plate_map_mapping(plate_map)
-    
-    # Add a "Mapped Sample" column to the sample data
-    sample_data['Mapped Sample'] = sample_data['Sample'].map(plate_mapping)
+def apply_plate_map(sample_data, plate_index):
+    # Add a "Mapped Sample" column to the sample data (gathered from the compiled plate map by well index)
+    sample_data['Mapped Sample'] = plate_index.take(sample_data['Well_Index'])
     return sample_data
 
-# Enrich the sample data
-enriched_sample_data = apply_plate_map(sample_data, plate_map_data)
-
-# Filter data based on specific criteria
-filtered_data = enriched_sample_data[
-    (enriched_sample_data['Gate'] == 'R6') & 
-    (enriched_sample_data['Y Parameter'].str.contains('methanogen', case=False, na=False))
-].copy()
-
-# Clean up and format the data
-filtered_data['Sample Info'] = filtered_data['Sample'].apply(lambda x: str(x).split('.')[0])
-filtered_data['Mapped Sample'] = filtered_data['Mapped Sample'].apply(lambda x: str(x).split('.')[0])
-
-# Create a "Category" column for plotting
-filtered_data['Category'] = filtered_data['Mapped Sample']
-
-# Filter out rows with NaN or invalid categories
-filtered_data = filtered_data[~filtered_data['Category'].isna()]
-
-# Calculate mean '%Gated' values for each category
-mean_gated_values = filtered_data.groupby('Category')['%Gated'].mean().reset_index()
-
-# Sort categories for consistent plotting
-sorted_categories = sorted(filtered_data['Category'].unique())
-filtered_data['Category'] = pd.Categorical(filtered_data['Category'], categories=sorted_categories, ordered=True)
-
-# Plotting
-plt.figure(figsize=(15, 8))
-
-# Scatter plot for individual data points
-sns.scatterplot(
-    data=filtered_data, 
-    x='Category', 
-    y='%Gated', 
-    hue='Mapped Sample', 
-    s=100, 
-    style='Mapped Sample', 
-    legend=None
-)
-
-# Draw horizontal lines for mean values
-for _, row in mean_gated_values.iterrows():
-    category_index = sorted_categories.index(row['Category'])
-    plt.hlines(y=row['%Gated'], xmin=category_index - 0.2, xmax=category_index + 0.2, colors='gray', linestyles='--', lw=2)
-
-# Customize plot
-plt.xlabel('', fontsize=14)
-plt.ylabel('% Methanogens', fontsize=14)
-plt.title('Methanogen Flow Cytometry Analysis - Oligo Pool_1892 rd2', fontsize=16)
-plt.xticks(rotation=45, fontsize=12, ha='right')
-plt.yticks(fontsize=12)
-plt.ylim(0, 8)
-
-# Save the plot
-output_filename = os.path.splitext(os.path.basename(sample_file))[0] + '_Methanogen_Flow.png'
-output_path = os.path.join('plots', output_filename)
-os.makedirs('plots', exist_ok=True)
-plt.tight_layout()
-plt.savefig(output_path, dpi=300)
-plt.show()
+# Function to filter enriched data to the filter spec's gates (the R6 gate on a methanogen Y Parameter)
+def filter_methanogen(enriched_sample_data):
+    return FILTER_SPEC.select_rows(enriched_sample_data).copy()
+
+# Function to load, enrich and filter one sample file
+def load_filtered_data(sample_file, plate_map_file, stream_chunksize=None):
+    if stream_chunksize:
+        # Stream the export in chunks, keeping only the R6/methanogen rows (joined to the plate map per chunk)
+        chunks = stream_filtered_rows(sample_file, plate_map_file, columns=('Sample', 'Gate', 'Y Parameter', '%Gated'),
+                                      chunksize=stream_chunksize)
+        return compact_frame(pd.concat([chunk.rename(columns={'Sample_Name': 'Mapped Sample'}) for chunk in chunks],
+                                       ignore_index=True))
+
+    # Load datasets (only the columns this script uses)
+    sample_data = load_samples(sample_file, columns=['Sample', 'Gate', 'Y Parameter', '%Gated', 'Well_Index'])
+    plate_index = load_plate_index(plate_map_file)
+
+    # Enrich the sample data
+    enriched_sample_data = apply_plate_map(sample_data, plate_index)
+
+    # Filter data based on specific criteria
+    return filter_methanogen(enriched_sample_data)
+
+# Function to plot the individual and mean %Gated values of every category and save the figure
+def plot_flow(filtered_data, sample_file, save_dir='plots', show=True):
+    filtered_data = filtered_data.copy()
+
+    # Clean up and format the data (once per distinct sample name, kept categorical)
+    filtered_data['Mapped Sample'] = strip_decimal_suffix(filtered_data['Mapped Sample'])
+
+    # Create a "Category" column for plotting
+    filtered_data['Category'] = filtered_data['Mapped Sample']
+
+    # Filter out rows with NaN or invalid categories
+    filtered_data = filtered_data[~filtered_data['Category'].isna()]
+
+    # Calculate mean '%Gated' values for each category, with their bootstrap confidence intervals
+    mean_gated_values = replicate_stats(filtered_data, keys=['Category'])
+
+    # Sort categories for consistent plotting
+    sorted_categories = sorted(filtered_data['Category'].unique())
+    filtered_data['Category'] = pd.Categorical(filtered_data['Category'], categories=sorted_categories, ordered=True)
+
+    # Plotting (a reused off-screen figure when rendering in batch)
+    fig = new_figure((15, 8))
+    ax = fig.add_subplot()
+
+    # Every point in one scatter call per marker shape and every mean in one hlines call
+    positions = filtered_data['Category'].cat.codes.to_numpy()
+    mean_positions = pd.Categorical(mean_gated_values['Category'], categories=sorted_categories).codes
+    draw_points_and_means(ax, positions, filtered_data['%Gated'], sns.color_palette(n_colors=len(sorted_categories)),
+                          markers=MARKERS, size=100, mean_positions=mean_positions,
+                          mean_values=mean_gated_values['%Gated'], mean_width=0.2,
+                          mean_intervals=(mean_gated_values['%Gated CI Low'], mean_gated_values['%Gated CI High']),
+                          colors='gray', linestyles='--', lw=2)
+
+    # Customize plot
+    ax.set_xlabel('', fontsize=14)
+    ax.set_ylabel('% Methanogens', fontsize=14)
+    ax.set_title('Methanogen Flow Cytometry Analysis - Oligo Pool_1892 rd2', fontsize=16)
+    ax.set_xticks(range(len(sorted_categories)))
+    ax.set_xticklabels(sorted_categories, rotation=45, fontsize=12, ha='right')
+    ax.tick_params(axis='y', labelsize=12)
+    ax.set_ylim(0, 8)
+
+    # Save the plot
+    output_filename = os.path.splitext(os.path.basename(sample_file))[0] + '_Methanogen_Flow.png'
+    output_path = os.path.join(save_dir, output_filename)
+    os.makedirs(save_dir, exist_ok=True)
+    fig.tight_layout()
+    save_figure(fig, output_path, show=show, dpi=300)
+    return output_path
+
+def main():
+    filtered_data = load_filtered_data(sample_file, plate_map_file, stream_chunksize)
+    plot_flow(filtered_data, sample_file)
+
+if __name__ == '__main__':
+    main()
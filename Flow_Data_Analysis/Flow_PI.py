@@ -1,78 +1,94 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import os
-import numpy as np
+
+from Metric_spec import DEFAULT_SPEC, MetricSpec, load_metric_spec
+from Result_io import read_results
+from Results_store import query_results, query_label
+from Plot_render import MARKERS, new_figure, save_figure, draw_points_and_means
+from Replicate_stats import replicate_stats
+from Lazy_import import lazy_import
+
+pd = lazy_import('pandas')
+sns = lazy_import('seaborn')
+np = lazy_import('numpy')
 
 # User inputs: Sample file (mandatory) and plate map file (optional)
-sample_file = 'Spreadsheets/20250313_RFF CTC and diSc3_CB_filtered_data.xlsx'  # User-provided sample file
+sample_file = 'Spreadsheets/20250313_RFF CTC and diSc3_CB_filtered_data.parquet'  # User-provided sample file
 plate_map_file = None  # Set to None if no plate map file is provided
 
-y_axis_column = '% Viable Cells'  # Change this to use a different y-axis value
+# Set to a results store query (e.g. {'kind': 'filtered', 'plate': '20250313_RFF CTC', 'gate': ['R6', 'R9']}) to read
+# the rows by query instead
+results_query = None
+
+y_axis_column = '% Viable Cells'  # Change this to use a different y-axis value (a gate or metric of the spec)
+
+# Gates and metrics (JSON or YAML); None uses R6, R9 and % Viable Cells = (100 - R9) / 100 * R6
+metric_spec_file = None
 
 # User-defined y-axis range
 y_axis_min = 0  # Set the minimum value of the y-axis
 y_axis_max = 6  # Set the maximum value of the y-axis
 
-# Load sample data with auto-format detection
-if sample_file.endswith('.csv'):
-    sample_data = pd.read_csv(sample_file, encoding='ISO-8859-1', delimiter=None, engine='python')
-elif sample_file.endswith('.xlsx'):
-    sample_data = pd.read_excel(sample_file, sheet_name=0)  # Load first sheet
-else:
-    raise ValueError("Unsupported file format. Please provide a CSV or Excel file.")
-
-# Extract R9 and R6 values for viability calculation
-r9_data = sample_data[sample_data['Gate'] == 'R9'][['Sample_Name', '%Gated']].drop_duplicates()
-r6_data = sample_data[sample_data['Gate'] == 'R6'][['Sample_Name', '%Gated']].drop_duplicates()
-
-# Merge R9 and R6 data
-viability_data = pd.merge(r9_data, r6_data, on='Sample_Name', suffixes=('_R9', '_R6'))
-
-# Calculate % Viable Methanogens
-viability_data[y_axis_column] = ((100 - viability_data['%Gated_R9']) / 100) * viability_data['%Gated_R6']
-
-# Merge back with original sample data
-sample_data = sample_data.merge(viability_data[['Sample_Name', y_axis_column]], on='Sample_Name', how='left').drop_duplicates()
-
-# Assign unique markers and colors for each Sample_Name
-unique_samples = sample_data['Sample_Name'].unique()
-markers = ['o', 's', 'D', '^', 'v', '<', '>', 'p', 'X', '*']  # Different marker shapes
-colors = sns.color_palette("husl", len(unique_samples))  # Assign unique colors
-
-# Create figure
-plt.figure(figsize=(10, 8))
-ax = plt.gca()
-
-# Plot each sample with a unique marker and color
-for i, sample in enumerate(unique_samples):
-    sample_subset = sample_data[sample_data['Sample_Name'] == sample]
-    sns.scatterplot(
-        data=sample_subset, x='Sample_Name', y=y_axis_column,
-        s=100, marker=markers[i % len(markers)], color=colors[i % len(colors)], ax=ax
-    )
-
-# Calculate mean values and plot them as horizontal bars
-mean_values = sample_data.groupby('Sample_Name', as_index=False)[y_axis_column].mean()
-x_positions = np.arange(len(unique_samples))  # Get numeric positions of samples on x-axis
-for i, sample in enumerate(unique_samples):
-    mean_y = mean_values.loc[mean_values['Sample_Name'] == sample, y_axis_column].values[0]
-    plt.hlines(y=mean_y, xmin=x_positions[i] - 0.3, xmax=x_positions[i] + 0.3, colors='gray', linestyles='--', lw=1.5)
-
-# Configure plot
-plt.xticks(ticks=x_positions, labels=unique_samples, rotation=45, ha='right')
-plt.xlabel('')
-plt.ylabel(y_axis_column)
-plt.ylim(y_axis_min, y_axis_max)
-plt.title('Methanogen Flow Cytometry Analysis - Metabolic Dye Pilot')
-
-# Add gridlines
-plt.grid(visible=True, which='major', axis='both', linestyle='--', linewidth=0.5, alpha=0.7)
-
-# Save plot
-output_filename = os.path.splitext(os.path.basename(sample_file))[0] + '_Methanogen_Flow.png'
-output_path = os.path.join('plots', output_filename)
-os.makedirs('plots', exist_ok=True)
-plt.tight_layout()
-plt.savefig(output_path, dpi=300)
-plt.show()
+# Function to compute % viable cells (and the spec's other metrics): one row per well, or per sample and plate
+# when the wells are not in the table, with the R9 and R6 values of that same well side by side
+def compute_viability(sample_data, y_axis_column=y_axis_column, spec=None):
+    spec = spec or MetricSpec.from_dict(DEFAULT_SPEC)
+    viability_data = spec.evaluate(sample_data)
+    if y_axis_column not in viability_data.columns:
+        raise ValueError(f"{y_axis_column} is not a gate or metric of the metric spec.")
+    return viability_data.dropna(subset=[y_axis_column])
+
+# Function to plot every sample's viability with its mean and save the figure
+def plot_viability(sample_data, sample_file, y_axis_column=y_axis_column, y_axis_min=y_axis_min, y_axis_max=y_axis_max,
+                   save_dir='plots', show=True):
+    # Rows without a sample name (wells left empty in the plate map) have no mean and no tick, so they are not drawn
+    sample_data = sample_data[sample_data['Sample_Name'].notna()]
+
+    # Assign unique markers and colors for each Sample_Name
+    unique_samples = sample_data['Sample_Name'].unique()
+    colors = sns.color_palette("husl", len(unique_samples))  # Assign unique colors
+
+    # Create figure (a reused off-screen figure when rendering in batch)
+    fig = new_figure((10, 8))
+    ax = fig.add_subplot()
+
+    # Plot every sample in one scatter call per marker shape, with all the means in one hlines call
+    positions = pd.Categorical(sample_data['Sample_Name'], categories=unique_samples).codes
+    mean_values = replicate_stats(sample_data, value_column=y_axis_column).set_index('Sample_Name').reindex(unique_samples)
+    x_positions = np.arange(len(unique_samples))  # Get numeric positions of samples on x-axis
+    draw_points_and_means(ax, positions, sample_data[y_axis_column], colors, markers=MARKERS, size=100,
+                          mean_positions=x_positions, mean_values=mean_values[y_axis_column], mean_width=0.3,
+                          mean_intervals=(mean_values[f'{y_axis_column} CI Low'], mean_values[f'{y_axis_column} CI High']),
+                          colors='gray', linestyles='--', lw=1.5)
+
+    # Configure plot
+    ax.set_xticks(x_positions)
+    ax.set_xticklabels(unique_samples, rotation=45, ha='right')
+    ax.set_xlabel('')
+    ax.set_ylabel(y_axis_column)
+    ax.set_ylim(y_axis_min, y_axis_max)
+    ax.set_title('Methanogen Flow Cytometry Analysis - Metabolic Dye Pilot')
+
+    # Add gridlines
+    ax.grid(visible=True, which='major', axis='both', linestyle='--', linewidth=0.5, alpha=0.7)
+
+    # Save plot
+    output_filename = os.path.splitext(os.path.basename(sample_file))[0] + '_Methanogen_Flow.png'
+    output_path = os.path.join(save_dir, output_filename)
+    os.makedirs(save_dir, exist_ok=True)
+    fig.tight_layout()
+    save_figure(fig, output_path, show=show, dpi=300)
+    return output_path
+
+def main():
+    spec = load_metric_spec(metric_spec_file) if metric_spec_file else None
+    if results_query:
+        # Viability pairs R6 and R9 per well, so the per-well filtered rows are read unless the query says otherwise
+        sample_data = compute_viability(query_results(**dict({'kind': 'filtered'}, **results_query)), spec=spec)
+        plot_viability(sample_data, query_label(**results_query))
+    else:
+        # Load sample data with auto-format detection (Parquet, Feather, CSV or Excel)
+        sample_data = compute_viability(read_results(sample_file), spec=spec)
+        plot_viability(sample_data, sample_file)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import os
+import json
+import hashlib
+
+# Folder holding cached intermediates (manifests, per-plate results, ...)
+cache_dir = os.environ.get('FLOW_CACHE_DIR', '.flow_cache')
+
+
+# Function to compute the content hash of a file, reading it in blocks
+def file_digest(file_path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Function to describe a file by its mtime, size and content hash
+def file_fingerprint(file_path, previous=None):
+    stat = os.stat(file_path)
+
+    # Reuse the recorded hash when the file has not been touched since then
+    if previous and previous.get('mtime') == stat.st_mtime_ns and previous.get('size') == stat.st_size:
+        return previous
+
+    return {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': file_digest(file_path)}
+
+
+# Function to read a JSON manifest, returning an empty one if it is missing or unreadable
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Function to write a JSON manifest atomically so an interrupted run never leaves it half-written
+def save_manifest(manifest_path, manifest):
+    os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
@@ -0,0 +1,371 @@
+import os
+import sys
+import time
+import argparse
+import datetime
+
+import Flow_instrument
+from Flow_cache import cache_dir
+from Flow_instrument import stage
+
+# The stage modules pull in matplotlib/seaborn/Biopython, so each command imports only what it needs
+
+
+def cmd_filter(args):
+    from Filter_data import filter_file
+    filter_file(args.sample_file, args.plate_map_file, output_dir=args.output_dir, export_excel=args.excel,
+                stream_chunksize=args.chunksize, store=not args.no_store, spec_file=args.spec)
+
+
+def cmd_average(args):
+    from Filter_avg_norm import average_and_normalize
+    average_and_normalize(args.sample_dir, args.platemap_dir, args.output_dir, workers=args.workers,
+                          rebuild=args.rebuild, chunksize=args.chunksize, excel=args.excel, per_plate=args.per_plate,
+                          store=not args.no_store)
+
+
+def cmd_flow(args):
+    from Flow import load_filtered_data, plot_flow
+    plot_flow(load_filtered_data(args.sample_file, args.plate_map_file, args.chunksize), args.sample_file,
+              save_dir=args.plots, show=False)
+
+
+# Function to read a command's results table: from the file given, or from the results store when it is 'store'
+def load_results_input(args, **defaults):
+    if args.results_file != 'store':
+        from Result_io import read_results
+        return read_results(args.results_file), args.results_file
+    from Results_store import query_results, query_filters, query_label
+    filters = {name: value for name, value in query_filters(args).items() if value is not None}
+    filters = dict(defaults, **filters)
+    return query_results(**filters, db_path=args.store), query_label(**filters)
+
+
+def cmd_viability(args):
+    from Flow_PI import compute_viability, plot_viability
+    from Metric_spec import load_metric_spec
+    results, name = load_results_input(args, kind='filtered')
+    spec = load_metric_spec(args.spec) if args.spec else None
+    plot_viability(compute_viability(results, args.metric, spec=spec), name, y_axis_column=args.metric,
+                   y_axis_min=args.y_min, y_axis_max=args.y_max, save_dir=args.plots, show=False)
+
+
+def cmd_metrics(args):
+    from Metric_spec import DEFAULT_SPEC, MetricSpec, load_metric_spec
+    results, _ = load_results_input(args, kind='filtered')
+    spec = load_metric_spec(args.spec) if args.spec else MetricSpec.from_dict(DEFAULT_SPEC)
+    wide = spec.evaluate(results)
+    if args.output:
+        from Result_io import write_results
+        write_results(wide, args.output)
+        print(f"{len(wide)} row(s) saved to {args.output}")
+    else:
+        print(wide.to_string(index=False))
+
+
+def cmd_plot_filtered(args):
+    from Plot_filtered import process_data, plot_data
+    results, name = load_results_input(args, kind='filtered', gate='R9')
+    filtered_data, mean_gated_values = process_data(results)
+    plot_data(filtered_data, mean_gated_values, name, save_path=args.plots, show=False)
+
+
+def cmd_heatmap(args):
+    from Heat_map_v2 import safe_load_file, load_sequence, prepare_heatmap, plot_heatmap
+    from Name_matcher import MatchMemo
+    if args.mutation_file == '-' and not args.effect:
+        raise SystemExit("A mutation table is needed unless --effect reads the mutations from the sample names.")
+    match_memo = MatchMemo(args.mutation_file) if args.mutation_file != '-' else None
+    mutation_data = safe_load_file(args.mutation_file) if args.mutation_file != '-' else None
+    if args.results_file == 'store':
+        flow_data = load_results_input(args, kind='averaged')[0]
+    else:
+        flow_data = safe_load_file(args.results_file)
+    data_cleaned, vmin, vmax = prepare_heatmap(flow_data, mutation_data, load_sequence(args.genpept_file),
+                                               memo=match_memo, effect=args.effect)
+    if match_memo is not None:
+        match_memo.save()
+    plot_heatmap(data_cleaned, vmin, vmax, output_folder=args.heatmap_dir, panel_width=args.panel_width)
+
+
+def cmd_variant_effects(args):
+    from Heat_map_v2 import safe_load_file, load_sequence
+    from Variant_effects import write_variant_effects
+    if args.results_file == 'store':
+        flow_data = load_results_input(args, kind='averaged')[0]
+    else:
+        flow_data = safe_load_file(args.results_file)
+    mutation_data = safe_load_file(args.mutation_file) if args.mutation_file else None
+    write_variant_effects(flow_data, mutation_data, load_sequence(args.genpept_file), args.output_dir, args.name)
+
+
+def cmd_query(args):
+    from Results_store import query_results, query_filters, list_runs, pd, np
+    if args.runs:
+        print(list_runs(args.store).to_string(index=False))
+        return
+
+    # pandas and NumPy load on first use; load them before the timer so only the query itself is timed
+    _ = pd.DataFrame, np.ndarray
+    start = time.perf_counter()
+    df = query_results(**query_filters(args), db_path=args.store)
+    seconds = time.perf_counter() - start
+    if args.output:
+        from Result_io import write_results
+        if args.output.endswith('.csv'):
+            df.to_csv(args.output, index=False)
+        else:
+            write_results(df, args.output)
+        print(f"{len(df)} row(s) saved to {args.output} ({seconds * 1000:.1f} ms)")
+    else:
+        print(df.to_string(index=False))
+        print(f"{len(df)} row(s) in {seconds * 1000:.1f} ms")
+
+
+def cmd_heatmap_batch(args):
+    from Heatmap_batch import run_heatmap_batch
+    run_heatmap_batch(args.manifest, workers=args.workers, output_folder=args.heatmap_dir, arrays_folder=args.arrays_dir,
+                      render=not args.no_render)
+
+
+def cmd_render(args):
+    from Plot_render import render_campaign
+    start = time.perf_counter()
+    saved = render_campaign(args.sample_dir, args.platemap_dir, save_dir=args.plots, workers=args.workers)
+    print(f"{len(saved)} plot(s) saved to {args.plots} in {time.perf_counter() - start:.1f} s")
+
+
+def cmd_watch(args):
+    from Flow_watch import PlateWatcher
+    PlateWatcher(args.sample_dir, args.platemap_dir, args.output_dir, args.plots, workers=args.workers,
+                 settle_seconds=args.settle, per_plate=args.per_plate, store=not args.no_store).run(duration=args.duration)
+
+
+def cmd_benchmark(args):
+    from Benchmark_suite import run
+    return run(args)
+
+
+def cmd_gate(args):
+    from Gating import write_gate_summary
+    write_gate_summary(args.fcs_dir, args.gates, args.output, plate=args.plate, workers=args.workers)
+
+
+# Function to run every stage for one experiment, loading and joining the sample and plate map only once
+def cmd_run_all(args):
+    base_name = os.path.splitext(os.path.basename(args.sample_file))[0]
+
+    with stage('load + join'):
+        from Flow_ingest import load_joined_samples
+        joined = load_joined_samples(args.sample_file, args.plate_map_file)
+
+    with stage('filter + save'):
+        from Batch_engine import filter_data
+        from Result_io import write_results
+        filtered_data = filter_data(joined)
+        os.makedirs(args.output_dir, exist_ok=True)
+        filtered_file_path = os.path.join(args.output_dir, f'{base_name}_filtered_data.parquet')
+        write_results(filtered_data, filtered_file_path, excel=args.excel)
+        print(f"Filtered data saved to {filtered_file_path}")
+        if not args.no_store:
+            from Results_store import append_results
+            append_results(filtered_data, 'filtered', source=filtered_file_path)
+
+    with stage('flow plot'):
+        from Flow import filter_methanogen, plot_flow
+        enriched = joined.rename(columns={'Sample_Name': 'Mapped Sample'})
+        print(f"Plot saved to {plot_flow(filter_methanogen(enriched), args.sample_file, save_dir=args.plots, show=False)}")
+
+    # The viability and R9 plots read every gate measured on the methanogen Y Parameter
+    methanogen_rows = joined[joined['Y Parameter'].str.contains('methanogen', case=False, na=False)]
+    gates = set(methanogen_rows['Gate'].astype(str))
+
+    if {'R6', 'R9'} <= gates:
+        with stage('viability plot'):
+            from Flow_PI import compute_viability, plot_viability
+            viability_data = compute_viability(methanogen_rows)
+            output_path = plot_viability(viability_data, f'{base_name}_Viability', save_dir=args.plots, show=False)
+            print(f"Plot saved to {output_path}")
+    else:
+        print("Skipping the viability plot: the R6 and R9 gates are not both present.")
+
+    if 'R9' in gates:
+        with stage('R9 plot'):
+            from Plot_filtered import process_data, plot_data
+            r9_data, mean_gated_values = process_data(methanogen_rows)
+            plot_data(r9_data, mean_gated_values, args.sample_file, save_path=args.plots, show=False)
+    else:
+        print("Skipping the R9 plot: no R9 gate in the data.")
+
+    if args.mutation_file and args.genpept_file:
+        with stage('heatmap'):
+            from Batch_engine import average_data
+            from Heat_map_v2 import safe_load_file, load_sequence, prepare_heatmap, plot_heatmap
+            from Name_matcher import MatchMemo
+            match_memo = MatchMemo(args.mutation_file)
+            data_cleaned, vmin, vmax = prepare_heatmap(average_data(filtered_data), safe_load_file(args.mutation_file),
+                                                       load_sequence(args.genpept_file), memo=match_memo)
+            match_memo.save()
+            plot_heatmap(data_cleaned, vmin, vmax, output_folder=args.heatmap_dir)
+
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='flow-analysis', description='Flow cytometry analysis pipeline.')
+    parser.add_argument('--report', help='Write the run report (JSON) here (default: .flow_cache/reports/)')
+    parser.add_argument('--profile', metavar='PREFIX',
+                        help='Sample call stacks and write them as PREFIX.folded (flamegraph.pl / speedscope format)')
+    parser.add_argument('--cprofile', action='store_true', help='Also run cProfile (written next to --profile as .prof)')
+    parser.add_argument('--trace-memory', action='store_true', help='Record the peak Python allocation of every stage')
+    parser.add_argument('--sample-interval', type=float, default=0.005, help='Seconds between --profile samples')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add(name, handler, help_text):
+        sub = subparsers.add_parser(name, help=help_text, description=help_text)
+        sub.set_defaults(handler=handler)
+        return sub
+
+    sub = add('filter', cmd_filter, 'Filter one sample file to R6/methanogen rows (Filter_data.py).')
+    sub.add_argument('sample_file')
+    sub.add_argument('plate_map_file')
+    sub.add_argument('-o', '--output-dir', default='Spreadsheets')
+    sub.add_argument('--excel', action='store_true', help='Also write an .xlsx copy in the background')
+    sub.add_argument('--chunksize', type=int, help='Stream the sample file in chunks of this many rows')
+    sub.add_argument('--no-store', action='store_true', help='Do not append the rows to the results store')
+    sub.add_argument('--spec', help='JSON or YAML spec of the gates to keep (default: R6 on methanogen)')
+
+    sub = add('average', cmd_average, 'Average and normalize every plate of a campaign (Filter_avg_norm.py).')
+    sub.add_argument('--sample-dir', default='Flow_Files')
+    sub.add_argument('--platemap-dir', default='Plate_Maps')
+    sub.add_argument('-o', '--output-dir', default='spreadsheets')
+    sub.add_argument('--workers', type=int, default=1)
+    sub.add_argument('--rebuild', action='store_true', help='Ignore cached per-plate results')
+    sub.add_argument('--chunksize', type=int, help='Stream each sample file in chunks of this many rows')
+    sub.add_argument('--excel', action='store_true', help='Also write an .xlsx copy in the background')
+    sub.add_argument('--per-plate', action='store_true', help='Normalize each plate against its own ND/gb2004 controls')
+    sub.add_argument('--no-store', action='store_true', help='Do not append the table to the results store')
+
+    sub = add('flow', cmd_flow, 'Plot %%Gated per mapped sample for one plate (Flow.py).')
+    sub.add_argument('sample_file')
+    sub.add_argument('plate_map_file')
+    sub.add_argument('--chunksize', type=int, help='Stream the sample file in chunks of this many rows')
+    sub.add_argument('--plots', default='plots')
+
+    from Results_store import add_query_arguments
+    store_help = "Results table, or 'store' to query the results store with the filter options"
+
+    sub = add('viability', cmd_viability, 'Plot %% viable cells from the R9 and R6 gates (Flow_PI.py).')
+    sub.add_argument('results_file', help=store_help)
+    add_query_arguments(sub)
+    sub.add_argument('--y-min', type=float, default=0)
+    sub.add_argument('--y-max', type=float, default=6)
+    sub.add_argument('--spec', help='JSON or YAML gate/metric spec (default: R6, R9 and %% Viable Cells)')
+    sub.add_argument('--metric', default='% Viable Cells', help='Gate or metric of the spec to plot')
+    sub.add_argument('--plots', default='plots')
+
+    sub = add('metrics', cmd_metrics, 'Compute gate metrics from a spec in one pivot (Metric_spec.py).')
+    sub.add_argument('results_file', help=store_help)
+    sub.add_argument('spec', nargs='?', help='JSON or YAML spec (default: R6, R9 and %% Viable Cells)')
+    sub.add_argument('-o', '--output', help='Save the wide table here (default: print it)')
+    add_query_arguments(sub)
+
+    sub = add('plot-filtered', cmd_plot_filtered, 'Plot the R9 gate of a filtered results table (Plot_filtered.py).')
+    sub.add_argument('results_file', help=store_help)
+    add_query_arguments(sub)
+    sub.add_argument('--plots', default='plots')
+
+    sub = add('heatmap', cmd_heatmap, 'Draw the mutation heatmap (Heat_map_v2.py).')
+    sub.add_argument('results_file', help=store_help)
+    sub.add_argument('mutation_file', help="Mutation table, or '-' with --effect when the sample names spell the mutations")
+    sub.add_argument('genpept_file')
+    sub.add_argument('--heatmap-dir', default='heatmap_output')
+    sub.add_argument('--panel-width', type=int, help='Split the heatmap into stacked panels of this many residues')
+    sub.add_argument('--effect', choices=['marginal', 'additive'],
+                     help='Read the samples as a multi-mutant library (A12V:K45R) and draw each mutation\'s effect')
+    add_query_arguments(sub)
+
+    sub = add('variant-effects', cmd_variant_effects,
+              'Fit mutation and epistasis effects of a multi-mutant library (Variant_effects.py).')
+    sub.add_argument('results_file', help=store_help)
+    sub.add_argument('genpept_file')
+    sub.add_argument('--mutation-file', help='Table of Name and Mutations for samples not named by their mutations')
+    sub.add_argument('--output-dir', default='variant_effects')
+    sub.add_argument('--name', default='variants', help='Prefix of the saved tables')
+    add_query_arguments(sub)
+
+    sub = add('query', cmd_query, 'Query the results store across plates and runs (Results_store.py).')
+    add_query_arguments(sub)
+    sub.add_argument('-o', '--output', help='Save the rows (.parquet, .feather or .csv) instead of printing them')
+    sub.add_argument('--runs', action='store_true', help='List the stored runs instead')
+
+    sub = add('heatmap-batch', cmd_heatmap_batch, 'Build and render heatmaps for a manifest of proteins and rounds.')
+    sub.add_argument('manifest', help='CSV or JSON with flow_file, mutation_file, genpept_file (protein, round, name)')
+    sub.add_argument('--workers', type=int, help='Number of worker processes (default: one per CPU)')
+    sub.add_argument('--heatmap-dir', default='heatmap_output')
+    sub.add_argument('--arrays-dir', default='heatmap_arrays', help='Folder for the stacked <protein>_rounds.npz files')
+    sub.add_argument('--no-render', action='store_true', help='Only build and stack the matrices')
+
+    sub = add('render', cmd_render, 'Render the plots of every plate of a campaign in parallel, off-screen.')
+    sub.add_argument('--sample-dir', default='Flow_Files')
+    sub.add_argument('--platemap-dir', default='Plate_Maps')
+    sub.add_argument('--plots', default='plots')
+    sub.add_argument('--workers', type=int, help='Number of rendering processes (default: one per CPU)')
+
+    sub = add('watch', cmd_watch, 'Process each new plate as soon as its sample file and plate map have landed.')
+    sub.add_argument('--sample-dir', default='Flow_Files')
+    sub.add_argument('--platemap-dir', default='Plate_Maps')
+    sub.add_argument('-o', '--output-dir', default='spreadsheets')
+    sub.add_argument('--plots', default='plots')
+    sub.add_argument('--workers', type=int, default=2, help='Number of plates processed at the same time')
+    sub.add_argument('--settle', type=float, default=2.0, help='Seconds a file must stay unchanged before it is read')
+    sub.add_argument('--per-plate', action='store_true', help='Normalize each plate against its own ND/gb2004 controls')
+    sub.add_argument('--duration', type=float, help='Stop after this many seconds (default: run until Ctrl+C)')
+    sub.add_argument('--no-store', action='store_true', help='Do not append the plates to the results store')
+
+    sub = add('benchmark', cmd_benchmark, 'Time every pipeline stage on a synthetic campaign (Benchmark_suite.py).')
+    from Benchmark_suite import build_parser as build_benchmark_parser
+    build_benchmark_parser(sub)
+
+    sub = add('gate', cmd_gate, 'Gate a folder of FCS files into a gate-summary CSV (Gating.py).')
+    sub.add_argument('fcs_dir')
+    sub.add_argument('gates', help='JSON gate configuration')
+    sub.add_argument('-o', '--output', help="Output CSV (default: Flow_Files/<folder name>.csv)")
+    sub.add_argument('--plate', help='Value of the Plate column (default: the folder name)')
+    sub.add_argument('--workers', type=int, default=1, help='Number of processes used to gate the wells')
+
+    sub = add('run-all', cmd_run_all, 'Run filter, plots and heatmap for one experiment from a single load.')
+    sub.add_argument('sample_file')
+    sub.add_argument('plate_map_file')
+    sub.add_argument('--mutation-file', help='Mutation table; with --genpept-file also draws the heatmap')
+    sub.add_argument('--genpept-file')
+    sub.add_argument('-o', '--output-dir', default='Spreadsheets')
+    sub.add_argument('--plots', default='plots')
+    sub.add_argument('--heatmap-dir', default='heatmap_output')
+    sub.add_argument('--excel', action='store_true', help='Also write an .xlsx copy in the background')
+    sub.add_argument('--no-store', action='store_true', help='Do not append the filtered rows to the results store')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    # Plots are only saved from the command line, never shown
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+    # Stage timers are always on from the command line; stack sampling, cProfile and tracemalloc only when asked
+    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    profile_prefix = args.profile or (f'flow_profile_{timestamp}' if args.cprofile else None)
+    Flow_instrument.start(trace_memory=args.trace_memory, cprofile=args.cprofile,
+                          sample_interval=args.sample_interval if args.profile else None)
+    try:
+        status = args.handler(args)
+    finally:
+        report_path = args.report or os.path.join(cache_dir, 'reports', f'{args.command}_{timestamp}.json')
+        report = Flow_instrument.finish(report_path, profile_prefix, command=' '.join(argv or sys.argv[1:]))
+    if args.command == 'run-all' or args.profile or args.cprofile or args.trace_memory:
+        Flow_instrument.print_report(report)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import os
+
+from Flow_cache import cache_dir, file_fingerprint, load_manifest, save_manifest
+from Flow_instrument import instrumented, stage
+from Plate_index import PlateIndex, well_index
+from Compact_schema import compact_frame
+from Lazy_import import lazy_import
+
+pd = lazy_import('pandas')
+
+# Bump this whenever the cached layout changes so old columnar copies are rebuilt
+INGEST_VERSION = 4
+
+# Columns of a cytometer export stored as categoricals (they repeat on almost every row)
+CATEGORICAL_COLUMNS = ['Plate', 'Sample', 'Gate', 'Y Parameter']
+
+columnar_dir = os.path.join(cache_dir, 'columnar')
+index_path = os.path.join(columnar_dir, 'index.json')
+
+
+# Function to read a raw CSV the way the scripts always have, but with the fast C parser
+@instrumented('csv parse')
+def read_raw_csv(file_path):
+    try:
+        df = pd.read_csv(file_path)
+    except UnicodeDecodeError:
+        df = pd.read_csv(file_path, encoding='ISO-8859-1')  # or 'latin1'
+
+    # A single column usually means another delimiter; let the python parser sniff it this once
+    if df.shape[1] == 1:
+        df = pd.read_csv(file_path, encoding='ISO-8859-1', sep=None, engine='python')
+    return df
+
+
+# Function to make object columns storable in Arrow (mixed numbers and strings become strings)
+def _arrow_safe(df):
+    for column in df.columns:
+        if df[column].dtype == object:
+            values = df[column]
+            df[column] = values.where(values.isna(), values.astype(str))
+    return df
+
+
+# Function to type a cytometer export: categorical labels, float %Gated (float32 when that loses nothing) and a well index
+def _prepare_samples(df):
+    df = _arrow_safe(df)
+    if '%Gated' in df.columns:
+        df['%Gated'] = pd.to_numeric(df['%Gated'], errors='coerce').astype(float)
+    if 'Sample' in df.columns:
+        df['Well_Index'] = well_index(df['Sample'])
+    return compact_frame(df, CATEGORICAL_COLUMNS)
+
+
+# Function to reshape a plate map into one row per well: 'Well', 'Sample_Name' and 'Well_Index'
+def _prepare_plate_map(platemap_df):
+    return PlateIndex.from_layout(platemap_df).to_frame()
+
+
+# Function to compile a plate map into the dense well-slot frame behind a PlateIndex
+def _prepare_plate_index(platemap_df):
+    return PlateIndex.from_layout(platemap_df).to_dense_frame()
+
+
+PREPARE = {
+    'samples': _prepare_samples,
+    'plate_map': _prepare_plate_map,
+    'plate_index': _prepare_plate_index,
+    'table': _arrow_safe,
+}
+
+
+# Function to return the columnar copy of a source file, converting it on first use
+def _columnar_path(file_path, kind):
+    # The fingerprint index lets unchanged files skip re-hashing
+    index = load_manifest(index_path)
+    key = os.path.abspath(file_path)
+    previous = index.get(key)
+    fingerprint = file_fingerprint(file_path, previous)
+    cache_path = os.path.join(columnar_dir, f"{fingerprint['sha256']}_{kind}_v{INGEST_VERSION}.arrow")
+
+    if not os.path.exists(cache_path):
+        os.makedirs(columnar_dir, exist_ok=True)
+        df = PREPARE[kind](read_raw_csv(file_path))
+
+        # Uncompressed Arrow IPC so later loads are zero-copy memory maps; write then rename for concurrent workers
+        import pyarrow.feather as feather
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        feather.write_feather(df, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, cache_path)
+
+    if previous != fingerprint:
+        index[key] = fingerprint
+        save_manifest(index_path, index)
+    return cache_path
+
+
+# Function to load only the requested columns of the cached copy through a memory map
+def _load(file_path, kind, columns=None):
+    import pyarrow.feather as feather
+    cache_path = _columnar_path(file_path, kind)
+    with stage('columnar load') as timed:
+        timed.rows_out = df = feather.read_table(cache_path, columns=columns, memory_map=True).to_pandas()
+    return df
+
+
+# Function to load a cytometer gate-summary export (Sample, Gate, Y Parameter, %Gated, ...)
+def load_samples(file_path, columns=None):
+    return _load(file_path, 'samples', columns)
+
+
+# Function to load a plate map as one row per well ('Well', 'Sample_Name', 'Well_Index')
+def load_plate_map(file_path, columns=None):
+    return _load(file_path, 'plate_map', columns)
+
+
+# Function to load the compiled well -> sample name index of a plate map
+def load_plate_index(file_path):
+    return PlateIndex.from_dense_frame(_load(file_path, 'plate_index'))
+
+
+# Function to load any other CSV (mutation tables, exported results) through the same cache
+def load_table(file_path, columns=None):
+    return _load(file_path, 'table', columns)
+
+
+# Function to load a sample export joined to its plate map: each row gets the 'Sample_Name' of its well
+@instrumented('plate-map join')
+def load_joined_samples(sample_file_path, platemap_file_path, columns=('Plate', 'Sample', 'Gate', 'Y Parameter', '%Gated')):
+    # Read the sample file into a DataFrame, with the well index computed when it was cached
+    sample_df = load_samples(sample_file_path, columns=list(columns) + ['Well_Index'])
+
+    # Gather each row's sample name from the compiled plate map by well index
+    sample_df['Sample_Name'] = load_plate_index(platemap_file_path).take(sample_df.pop('Well_Index'))
+    return sample_df
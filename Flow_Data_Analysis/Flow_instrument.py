@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+import functools
+from collections import Counter
+
+# Stage timers stay switched off (a single flag check per stage) until start() is called
+enabled = False
+_run = None
+
+
+# Timing, call count and row counts of one named stage, summed over every time it ran
+class StageRecord:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.peak_alloc_mb = None
+
+    def to_dict(self):
+        return {'name': self.name, 'calls': self.calls, 'seconds': round(self.seconds, 6),
+                'rows_in': self.rows_in, 'rows_out': self.rows_out, 'peak_alloc_mb': self.peak_alloc_mb}
+
+
+# Everything collected while instrumentation is on
+class Run:
+    def __init__(self, trace_memory=False, cprofile=False, sample_interval=None):
+        self.started = datetime.datetime.now()
+        self.start_time = time.perf_counter()
+        self.stages = {}
+        self.active = []
+        self.trace_memory = trace_memory
+        self.profiler = None
+        self.sampler = None
+
+        if trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        if cprofile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if sample_interval:
+            self.sampler = StackSampler(sample_interval)
+            self.sampler.start()
+
+    def record(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageRecord(name)
+        return self.stages[name]
+
+
+# Context manager timing one stage; set .rows_out (or pass rows_in) to count rows through it
+class Stage:
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.carried_peak = 0
+
+    def __enter__(self):
+        if _run.trace_memory:
+            import tracemalloc
+            # The enclosing stage keeps the peak reached so far before the peak counter is reset for this one
+            if _run.active:
+                _run.active[-1].carried_peak = max(_run.active[-1].carried_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        _run.active.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        _run.active.pop()
+
+        record = _run.record(self.name)
+        record.calls += 1
+        record.seconds += seconds
+        record.rows_in += count_rows(self.rows_in)
+        record.rows_out += count_rows(self.rows_out)
+        if _run.trace_memory:
+            import tracemalloc
+            peak = max(self.carried_peak, tracemalloc.get_traced_memory()[1])
+            record.peak_alloc_mb = round(max(record.peak_alloc_mb or 0, peak / (1 << 20)), 3)
+            if _run.active:
+                _run.active[-1].carried_peak = max(_run.active[-1].carried_peak, peak)
+        return False
+
+
+# Stand-in returned while instrumentation is off: entering, leaving and setting rows_out do nothing
+class _NullStage:
+    rows_in = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+# Function to count the rows of a DataFrame, array or list (an int passes through, anything else counts 0);
+# for a tuple such as (table, unmatched) the first item is counted
+def count_rows(value):
+    if isinstance(value, tuple):
+        value = value[0] if value else None
+    if isinstance(value, int):
+        return value
+    if hasattr(value, 'shape') or isinstance(value, list):
+        return len(value)
+    return 0
+
+
+# Function to open a named stage: "with stage('filter', rows_in=df) as s: ...; s.rows_out = result"
+def stage(name, rows_in=None):
+    if not enabled:
+        return _NULL_STAGE
+    return Stage(name, rows_in)
+
+
+# Decorator timing every call of a function as a stage, counting the rows of the first argument and of the result
+def instrumented(name):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with Stage(name, args[0] if args else None) as timed:
+                result = func(*args, **kwargs)
+                timed.rows_out = result
+            return result
+        return wrapper
+    return decorate
+
+
+# Sampling profiler: a daemon thread records the main thread's call stack every interval seconds
+class StackSampler(threading.Thread):
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.counts = Counter()
+        self.target = threading.main_thread().ident
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+
+            # Prefix the active stages so the flamegraph groups samples by pipeline stage
+            run = _run
+            stages = [f'[{active.name}]' for active in list(run.active)] if run else []
+            self.counts[';'.join(stages + stack[::-1])] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    # Function to write the samples as folded stacks ('frame;frame;frame count'), read by flamegraph.pl and speedscope
+    def write_folded(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+# Function to switch instrumentation on for this process
+def start(trace_memory=False, cprofile=False, sample_interval=None):
+    global enabled, _run
+    _run = Run(trace_memory=trace_memory, cprofile=cprofile, sample_interval=sample_interval)
+    enabled = True
+    return _run
+
+
+# Function to switch instrumentation off and write the report (JSON), folded stacks and cProfile stats
+def finish(report_path=None, profile_path=None, command=None):
+    global enabled, _run
+    run, enabled, _run = _run, False, None
+    if run is None:
+        return None
+
+    report = {
+        'command': command or ' '.join(sys.argv),
+        'started': run.started.isoformat(timespec='seconds'),
+        'total_seconds': round(time.perf_counter() - run.start_time, 6),
+        'stages': [record.to_dict() for record in run.stages.values()],
+    }
+
+    if run.trace_memory:
+        import tracemalloc
+        tracemalloc.stop()
+    if run.sampler is not None:
+        run.sampler.stop()
+        folded_path = f'{profile_path}.folded'
+        run.sampler.write_folded(folded_path)
+        report['folded_stacks'] = folded_path
+        report['samples'] = sum(run.sampler.counts.values())
+    if run.profiler is not None:
+        run.profiler.disable()
+        stats_path = f'{profile_path}.prof'
+        run.profiler.dump_stats(stats_path)
+        report['cprofile_stats'] = stats_path
+
+    if report_path:
+        os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=1)
+        report['report'] = report_path
+    return report
+
+
+# Function to print a report's stages as a table, slowest first
+def print_report(report):
+    print("\nStage timings:")
+    for record in sorted(report['stages'], key=lambda record: record['seconds'], reverse=True):
+        rows = f"{record['rows_in']} -> {record['rows_out']} rows" if record['rows_in'] or record['rows_out'] else ''
+        memory = f"  peak {record['peak_alloc_mb']:.1f} MB" if record['peak_alloc_mb'] is not None else ''
+        print(f"  {record['name']:<22} {record['seconds']:8.3f} s  x{record['calls']:<4} {rows}{memory}")
+    print(f"  {'total':<22} {report['total_seconds']:8.3f} s")
+    for key in ('report', 'folded_stacks', 'cprofile_stats'):
+        if key in report:
+            print(f"  {key.replace('_', ' ')}: {report[key]}")
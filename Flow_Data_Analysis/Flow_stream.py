@@ -0,0 +1,100 @@
+
+from Flow_ingest import load_plate_index
+from Flow_instrument import instrumented
+from Metric_spec import FILTER_SPEC
+from Compact_schema import compact_frame
+from Lazy_import import lazy_import
+
+pd = lazy_import('pandas')
+
+# Rows read per chunk when streaming, unless the caller asks for something else
+DEFAULT_CHUNKSIZE = 500_000
+
+# Text columns are given one fixed dtype so every chunk has the same schema (chunks appended to one Parquet file
+# cannot each pick their own categories); whole tables built from the chunks go through compact_frame
+TEXT_COLUMNS = ['Plate', 'Sample', 'Sample_Name', 'Gate', 'Y Parameter']
+
+
+# Mergeable running mean: per-group sums and counts that can be updated chunk by chunk or combined
+class RunningMean:
+    def __init__(self, keys, value_column='%Gated'):
+        self.keys = keys
+        self.value_column = value_column
+        self.sums = None
+        self.counts = None
+
+    # Function to fold one chunk of rows into the running sums and counts
+    def update(self, df):
+        grouped = df.groupby(self.keys, observed=True)[self.value_column]
+        self._add(grouped.sum(), grouped.count())
+
+    # Function to fold another aggregator (e.g. from another worker) into this one
+    def merge(self, other):
+        if other.sums is not None:
+            self._add(other.sums, other.counts)
+
+    def _add(self, sums, counts):
+        if self.sums is None:
+            self.sums, self.counts = sums, counts
+        else:
+            self.sums = self.sums.add(sums, fill_value=0)
+            self.counts = self.counts.add(counts, fill_value=0)
+
+    # Function to store the sums and counts as JSON-friendly [key..., sum, count] records
+    def to_records(self):
+        if self.sums is None:
+            return []
+        keys = [key if isinstance(key, tuple) else (key,) for key in self.sums.index]
+        return [list(key) + [float(total), int(count)] for key, total, count in zip(keys, self.sums, self.counts)]
+
+    # Function to rebuild an aggregator from records written by to_records
+    @classmethod
+    def from_records(cls, keys, records, value_column='%Gated'):
+        aggregator = cls(keys, value_column)
+        if records:
+            index = pd.MultiIndex.from_tuples([tuple(record[:-2]) for record in records], names=keys)
+            if len(keys) == 1:
+                index = index.get_level_values(0)
+            aggregator._add(pd.Series([record[-2] for record in records], index=index, dtype=float),
+                            pd.Series([record[-1] for record in records], index=index, dtype=float))
+        return aggregator
+
+    # Function to return one row per group with the mean, as groupby(...).mean() would
+    def result(self):
+        if self.sums is None:
+            return pd.DataFrame(columns=self.keys + [self.value_column])
+        means = (self.sums / self.counts.where(self.counts > 0)).sort_index()
+        return means.rename(self.value_column).reset_index()
+
+
+# Function to stream a large export, keeping only the rows of a spec's gates and joining the plate map per chunk
+def stream_filtered_rows(sample_file_path, platemap_file_path, spec=FILTER_SPEC,
+                         columns=('Plate', 'Sample', 'Gate', 'Y Parameter', '%Gated'), chunksize=DEFAULT_CHUNKSIZE):
+    # The plate map is small, so its compiled well -> sample name index is loaded once
+    plate_index = load_plate_index(platemap_file_path)
+
+    reader = pd.read_csv(sample_file_path, encoding='ISO-8859-1', usecols=list(columns), chunksize=chunksize)
+    for chunk in reader:
+        # Keep the spec's gate / Y Parameter rows before anything else is done
+        chunk = spec.select_rows(chunk)
+
+        # Merge the sample information with the platemap based on well positions
+        chunk = chunk.assign(Sample_Name=plate_index.lookup(chunk['Sample']))
+        for column in TEXT_COLUMNS:
+            if column in chunk.columns:
+                chunk[column] = chunk[column].astype('string')
+        chunk['%Gated'] = pd.to_numeric(chunk['%Gated'], errors='coerce').astype(float)
+        yield chunk
+
+
+# Function to compute per-group mean %Gated of a large export in constant memory
+@instrumented('stream aggregate')
+def stream_group_means(sample_file_path, platemap_file_path, keys=('Sample_Name', 'Plate', 'Gate', 'Y Parameter'),
+                       chunksize=DEFAULT_CHUNKSIZE, **filter_options):
+    aggregator = RunningMean(list(keys))
+    for chunk in stream_filtered_rows(sample_file_path, platemap_file_path, chunksize=chunksize, **filter_options):
+        aggregator.update(chunk)
+
+    # Same schema as the in-memory path: categorical labels, and the means kept as float64
+    means = aggregator.result()
+    return compact_frame(means[list(keys)]).assign(**{aggregator.value_column: means[aggregator.value_column]})
@@ -0,0 +1,245 @@
+import os
+import time
+import argparse
+import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from Batch_engine import process_plate, run_batch_with_summaries, store_plate_result
+from Filter_avg_norm import control_stats, normalize_data
+from Flow_instrument import stage
+from Result_io import write_results
+from Results_store import append_results
+from Compact_schema import concat_compact
+
+# Folders watched for new cytometer exports and their plate maps
+sample_dir = 'Flow_Files'
+platemap_dir = 'Plate_Maps'
+
+# Where the campaign table (rewritten after every plate) and the per-plate plots go
+output_dir = 'spreadsheets'
+campaign_file = 'campaign_results.parquet'
+plots_dir = 'plots'
+
+# Seconds between directory scans, and how long a file's size and mtime must stay unchanged before it is read
+poll_interval = 0.5
+settle_seconds = 2.0
+
+# Number of plates processed at the same time
+workers = 2
+
+# Set to False to skip appending each plate's averaged table to the results store (flow_results.sqlite)
+store_results = True
+
+
+# Function to list the CSV files of a folder with their (size, mtime) - one stat per file, no reads
+def snapshot(directory):
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith('.csv') and entry.is_file():
+                stat = entry.stat()
+                files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+# Debounce: remembers when each file last changed and reports those that have been quiet for settle_seconds
+class StabilityTracker:
+    def __init__(self, settle_seconds=settle_seconds):
+        self.settle_seconds = settle_seconds
+        self.seen = {}
+
+    # Function to fold in a new snapshot and return {path: (size, mtime)} of the files that are stable
+    def update(self, files, now):
+        for path, signature in files.items():
+            previous = self.seen.get(path)
+            if previous is None or previous[0] != signature:
+                self.seen[path] = (signature, now)
+        for path in set(self.seen) - set(files):
+            del self.seen[path]
+        return {path: signature for path, (signature, changed) in self.seen.items()
+                if signature[0] > 0 and now - changed >= self.settle_seconds}
+
+
+# Function to prepare a watch worker: headless rendering, with the data and plotting libraries (which the modules
+# only load on first use) imported before the first plate
+def start_worker():
+    from Plot_render import start_batch
+    start_batch()
+    import pandas, pyarrow.feather, seaborn, matplotlib.figure  # noqa: F401
+
+
+# Function to render one plate's plots (run inside a watch worker); a plot that fails does not stop the watch
+def render_plots(sample_file_path, platemap_file_path, plots_dir=plots_dir):
+    from Plot_render import render_plate
+    try:
+        return render_plate(sample_file_path, platemap_file_path, save_dir=plots_dir)
+    except Exception as error:
+        print(f"Plots for {os.path.basename(sample_file_path)} failed: {error}")
+        return []
+
+
+# Watches the sample and plate map folders and processes each plate once both of its files are stable
+class PlateWatcher:
+    def __init__(self, sample_dir=sample_dir, platemap_dir=platemap_dir, output_dir=output_dir, plots_dir=plots_dir,
+                 workers=workers, settle_seconds=settle_seconds, per_plate=False, store=store_results):
+        self.sample_dir = sample_dir
+        self.platemap_dir = platemap_dir
+        self.output_path = os.path.join(output_dir, campaign_file)
+        self.plots_dir = plots_dir
+        self.workers = workers
+        self.per_plate = per_plate
+        self.store = store
+        self.samples = StabilityTracker(settle_seconds)
+        self.plate_maps = StabilityTracker(settle_seconds)
+
+        # Per plate: averaged table, control sums and counts, and the (sample, plate map) signatures it was built from
+        self.results = {}
+        self.plate_stats = {}
+        self.done = {}
+        self.queued = deque()
+        self.plots_queued = deque()
+        self.in_flight = {}
+        self.pool = None
+
+    # Function to load every plate already in the folders (cached plates are not read again) before watching
+    def catch_up(self):
+        from Batch_engine import find_plate_pairs
+        pairs = find_plate_pairs(self.sample_dir, self.platemap_dir)
+        if not pairs:
+            return
+        all_data, plate_stats = run_batch_with_summaries(self.sample_dir, self.platemap_dir, summarize=control_stats,
+                                                         workers=self.workers)
+        for (sample_file, sample_path, platemap_path), averaged_data, stats in zip(pairs, all_data, plate_stats):
+            self.results[sample_file] = averaged_data
+            self.plate_stats[sample_file] = stats
+            self.done[sample_file] = self._signatures(sample_path, platemap_path)
+        self.write_campaign()
+
+        # Stored as one run, as 'average' stores the whole campaign; queries return each plate's newest run
+        if self.store:
+            append_results(concat_compact(all_data), 'averaged', source=self.output_path)
+
+    def _signatures(self, sample_path, platemap_path):
+        return tuple((os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in (sample_path, platemap_path))
+
+    # Function to scan both folders once and queue every plate whose sample and plate map are stable and new or changed
+    # (`now` and `list_files` can be replaced to drive the scan without a real clock or folder)
+    def scan(self, now=None, list_files=snapshot):
+        now = time.monotonic() if now is None else now
+        stable_samples = self.samples.update(list_files(self.sample_dir), now)
+        stable_plate_maps = self.plate_maps.update(list_files(self.platemap_dir), now)
+
+        busy = {job[1] for job in list(self.in_flight.values()) + list(self.queued) if job[0] == 'process'}
+        for sample_path, sample_signature in stable_samples.items():
+            sample_file = os.path.basename(sample_path)
+            base_name = os.path.splitext(sample_file)[0]
+            platemap_path = os.path.join(self.platemap_dir, f'{base_name}_plate_map.csv')
+            if platemap_path not in stable_plate_maps or sample_file in busy:
+                continue
+
+            signatures = (sample_signature, stable_plate_maps[platemap_path])
+            if self.done.get(sample_file) != signatures:
+                self.queued.append(('process', sample_file, sample_path, platemap_path, signatures, now))
+
+    # Function to hand queued jobs to the pool, never more in flight than workers; new plates go before pending plots
+    def submit(self):
+        while (self.queued or self.plots_queued) and len(self.in_flight) < self.workers:
+            job = self.queued.popleft() if self.queued else self.plots_queued.popleft()
+            if job[0] == 'render':
+                future = self.pool.submit(render_plots, job[2], job[3], self.plots_dir)
+            else:
+                future = self.pool.submit(process_plate, job[2], job[3])
+            self.in_flight[future] = job
+
+    # Function to fold finished plates into the campaign table and the batch cache, then queue their plots
+    def collect(self, finished):
+        for future in finished:
+            kind, sample_file, sample_path, platemap_path, signatures, stable_at = self.in_flight.pop(future)
+            try:
+                result = future.result()
+            except Exception as error:
+                # Remember the failed signatures so the plate is retried only once one of its files changes again
+                print(f"{sample_file} could not be processed: {error}")
+                self.done[sample_file] = signatures
+                continue
+
+            if kind == 'render':
+                print(f"{sample_file}: {len(result)} plot(s) saved {time.monotonic() - stable_at:.1f} s after its files settled")
+                continue
+
+            # The numbers are written first; the plots, which take far longer, follow on the pool
+            stats = control_stats(result)
+            store_plate_result(sample_path, platemap_path, result, summaries={control_stats.__name__: stats})
+            self.results[sample_file] = result
+            self.plate_stats[sample_file] = stats
+            self.done[sample_file] = signatures
+            self.write_campaign()
+            if self.store:
+                append_results(result, 'averaged', source=sample_path)
+            print(f"{sample_file}: {len(result)} sample(s) added to {self.output_path} "
+                  f"{time.monotonic() - stable_at:.1f} s after its files settled")
+            if self.plots_dir:
+                self.plots_queued.append(('render', sample_file, sample_path, platemap_path, signatures, stable_at))
+
+    # Function to rewrite the normalized campaign table from the plates processed so far
+    def write_campaign(self):
+        with stage('campaign append'):
+            concatenated_data = concat_compact(self.results.values())
+            normalized = normalize_data(concatenated_data, list(self.plate_stats.values()), per_plate=self.per_plate)
+            os.makedirs(os.path.dirname(self.output_path) or '.', exist_ok=True)
+            # Written beside the table and swapped in, so readers never see a half-written file
+            tmp_path = f'{os.path.splitext(self.output_path)[0]}.{os.getpid()}.tmp.parquet'
+            write_results(normalized, tmp_path)
+            os.replace(tmp_path, self.output_path)
+
+    # Function to watch until interrupted (or for `duration` seconds)
+    def run(self, poll_interval=poll_interval, duration=None):
+        os.makedirs(self.sample_dir, exist_ok=True)
+        os.makedirs(self.platemap_dir, exist_ok=True)
+        self.catch_up()
+        print(f"Watching {self.sample_dir} and {self.platemap_dir} "
+              f"({self.workers} worker(s), started {datetime.datetime.now():%H:%M:%S}); Ctrl+C to stop.")
+
+        # Start every worker now so the first plate does not wait for the plotting imports
+        stop_at = None if duration is None else time.monotonic() + duration
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=start_worker)
+        wait([self.pool.submit(time.sleep, 0.1) for _ in range(self.workers)])
+        try:
+            while stop_at is None or time.monotonic() < stop_at:
+                self.scan()
+                self.submit()
+                if self.in_flight:
+                    # Wake as soon as a plate finishes, or at the next scan
+                    finished, _ = wait(list(self.in_flight), timeout=poll_interval, return_when=FIRST_COMPLETED)
+                    self.collect(finished)
+                else:
+                    time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            print("Stopping; waiting for the plates in progress.")
+        finally:
+            finished, _ = wait(list(self.in_flight))
+            self.collect(finished)
+            self.pool.shutdown()
+        return self.output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process new plates as they land in Flow_Files and Plate_Maps.')
+    parser.add_argument('--sample-dir', default=sample_dir)
+    parser.add_argument('--platemap-dir', default=platemap_dir)
+    parser.add_argument('-o', '--output-dir', default=output_dir)
+    parser.add_argument('--plots', default=plots_dir)
+    parser.add_argument('--workers', type=int, default=workers, help='Number of plates processed at the same time')
+    parser.add_argument('--settle', type=float, default=settle_seconds,
+                        help='Seconds a file must stay unchanged before it is read')
+    parser.add_argument('--per-plate', action='store_true', help="Normalize each plate against its own controls")
+    parser.add_argument('--no-store', action='store_true', help='Do not append the plates to the results store')
+    args = parser.parse_args()
+
+    PlateWatcher(args.sample_dir, args.platemap_dir, args.output_dir, args.plots, workers=args.workers,
+                 settle_seconds=args.settle, per_plate=args.per_plate, store=not args.no_store).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from Fcs_reader import read_fcs, read_fcs_dir
+from Flow_instrument import instrumented
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+GATE_TYPES = ('threshold', 'rectangle', 'polygon')
+
+
+# Function to read a gate configuration (a JSON list of gates) and order it so parents come first
+def load_gates(config_path):
+    with open(config_path) as f:
+        gates = json.load(f)
+    return order_gates(gates)
+
+
+# Function to check gate definitions and sort them parents-first
+def order_gates(gates):
+    by_name = {}
+    for gate in gates:
+        if gate.get('type') not in GATE_TYPES:
+            raise ValueError(f"Gate {gate.get('name')}: type must be one of {', '.join(GATE_TYPES)}.")
+        if gate['name'] in by_name:
+            raise ValueError(f"Gate {gate['name']} is defined twice.")
+        by_name[gate['name']] = gate
+
+    ordered = []
+    visiting = set()
+
+    def visit(name):
+        if any(g['name'] == name for g in ordered):
+            return
+        if name in visiting:
+            raise ValueError(f"Gate {name} is its own ancestor.")
+        if name not in by_name:
+            raise ValueError(f"Unknown parent gate {name}.")
+        visiting.add(name)
+        parent = by_name[name].get('parent')
+        if parent:
+            visit(parent)
+        visiting.discard(name)
+        ordered.append(by_name[name])
+
+    for gate in gates:
+        visit(gate['name'])
+    return ordered
+
+
+# Function to test many points against one polygon at once (even-odd ray casting, one pass per edge)
+def points_in_polygon(x, y, vertices):
+    vertices = np.asarray(vertices, dtype=float)
+    inside = np.zeros(len(x), dtype=bool)
+
+    # Points outside the bounding box can be skipped outright
+    (x_min, y_min), (x_max, y_max) = vertices.min(axis=0), vertices.max(axis=0)
+    candidates = np.flatnonzero((x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max))
+    px, py = x[candidates], y[candidates]
+
+    hits = np.zeros(len(candidates), dtype=bool)
+    xj, yj = vertices[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for xi, yi in vertices:
+            straddles = (yi > py) != (yj > py)
+            hits ^= straddles & (px < (xj - xi) * (py - yi) / (yj - yi) + xi)
+            xj, yj = xi, yi
+
+    inside[candidates] = hits
+    return inside
+
+
+# Function to compute one gate's own membership mask (before the parent gate is applied)
+def gate_mask(events, gate):
+    if gate['type'] == 'threshold':
+        values = np.asarray(events[gate['channel']])
+        mask = np.ones(len(values), dtype=bool)
+        if gate.get('min') is not None:
+            mask &= values >= gate['min']
+        if gate.get('max') is not None:
+            mask &= values <= gate['max']
+        return mask
+
+    x = np.asarray(events[gate['x']])
+    y = np.asarray(events[gate['y']])
+    if gate['type'] == 'rectangle':
+        (x_low, x_high), (y_low, y_high) = gate['x_range'], gate['y_range']
+        return (x >= x_low) & (x <= x_high) & (y >= y_low) & (y <= y_high)
+    return points_in_polygon(x, y, gate['vertices'])
+
+
+# Function to compute every gate's event membership; a gate only keeps events that are in its parent
+def gate_events(events, gates):
+    masks = {}
+    for gate in gates:
+        mask = gate_mask(events, gate)
+        if gate.get('parent'):
+            mask &= masks[gate['parent']]
+        masks[gate['name']] = mask
+    return masks
+
+
+# Function to name the Y Parameter of a gate: configured, or the plotted channel with its stain label
+def y_parameter(fcs, gate):
+    if gate.get('y_parameter'):
+        return gate['y_parameter']
+    channel = gate.get('channel') or gate['y']
+    label = fcs.labels[fcs.channels.index(channel)] if channel in fcs.channels else ''
+    return f'{channel} {label}'.strip()
+
+
+# Function to gate one FCS file into long-format 'Sample, Gate, Y Parameter, %Gated' rows
+def gate_summary(fcs, gates, plate=None):
+    if isinstance(fcs, str):
+        fcs = read_fcs(fcs)
+    masks = gate_events(fcs.events, gates)
+
+    rows = []
+    for gate in gates:
+        # %Gated is relative to the parent population (or to all events for a top-level gate)
+        parent_count = masks[gate['parent']].sum() if gate.get('parent') else len(fcs)
+        gated = 100.0 * masks[gate['name']].sum() / parent_count if parent_count else np.nan
+        rows.append({'Plate': plate, 'Sample': fcs.well, 'Gate': gate['name'],
+                     'Y Parameter': y_parameter(fcs, gate), '%Gated': gated, 'Count': int(masks[gate['name']].sum())})
+
+    summary = pd.DataFrame(rows)
+    return summary if plate is not None else summary.drop(columns=['Plate'])
+
+
+# Function to gate every well of a plate, spread over a process pool when workers > 1
+@instrumented('gating')
+def gate_plate(fcs_dir, gates, workers=1, plate=None):
+    paths = [fcs.path for fcs in read_fcs_dir(fcs_dir).values()]
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            summaries = list(pool.map(gate_summary, paths, [gates] * len(paths), [plate] * len(paths)))
+    else:
+        summaries = [gate_summary(path, gates, plate) for path in paths]
+    return pd.concat(summaries, ignore_index=True)
+
+
+# Function to gate a plate folder and save its summary CSV; the plate defaults to the folder name and the output to
+# Flow_Files/<plate>.csv, next to the cytometer exports the other scripts read
+def write_gate_summary(fcs_dir, config_path, output_file_path=None, plate=None, workers=1):
+    plate = plate or os.path.basename(os.path.normpath(fcs_dir))
+    output_file_path = output_file_path or os.path.join('Flow_Files', f'{plate}.csv')
+    os.makedirs(os.path.dirname(output_file_path) or '.', exist_ok=True)
+
+    summary = gate_plate(fcs_dir, load_gates(config_path), workers=workers, plate=plate)
+    summary.to_csv(output_file_path, index=False)
+    print(f"Gate summary for {summary['Sample'].nunique()} wells saved to {output_file_path}")
+    return output_file_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gate a folder of FCS files into a gate-summary CSV.')
+    parser.add_argument('fcs_dir', help='Folder holding one FCS file per well')
+    parser.add_argument('gates', help='JSON gate configuration')
+    parser.add_argument('-o', '--output', help="Output CSV (default: Flow_Files/<folder name>.csv)")
+    parser.add_argument('--plate', help='Value of the Plate column (default: the folder name)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to gate the wells')
+    args = parser.parse_args()
+
+    write_gate_summary(args.fcs_dir, args.gates, args.output, plate=args.plate, workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,51 @@
 #!/usr/bin/env python3
 
 import os
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from Bio import SeqIO
-from difflib import get_close_matches
 from datetime import datetime
 
+from Flow_ingest import load_table
+from Result_io import read_results
+from Results_store import query_results
+from Heatmap_matrix import amino_acids, build_heatmap_data
+from Variant_effects import build_variant_heatmap
+from Name_matcher import MatchMemo
+from Flow_instrument import instrumented
+from Plot_render import new_figure, save_figure
+from Lazy_import import lazy_import
+
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+matplotlib = lazy_import('matplotlib')
+SeqIO = lazy_import('Bio.SeqIO')
+
 # File paths
-flow_data_file = 'spreadsheets/concatenated_averaged_data_20250103_0949.xlsx'  # Raw flow cytometry data
+flow_data_file = 'spreadsheets/concatenated_averaged_data_20250103_0949.parquet'  # Raw flow cytometry data
 mutation_data_file = '11_25_2004_1mut.csv'  # Mutation data
 snapgene_file = 'gb2004_CDS.gpt'  # GenPept file from SnapGene
 
+# Set to a results store query (e.g. {'kind': 'averaged', 'since': '2025-01-01'}) to read the flow data by query instead
+flow_data_query = None
+
 # Designated folder to save the heatmap
 output_folder = 'heatmap_output'
-os.makedirs(output_folder, exist_ok=True)  # Create the folder if it doesn't exist
+
+# Above this many columns the cells are too narrow to read, so values are not written on them
+annotate_max_columns = 100
+
+# Set to a column count (e.g. 200) to split long proteins into stacked panels of that width
+panel_width = None
+
+# Set to 'marginal' or 'additive' for multi-mutant libraries (samples named like A12V:K45R): every variant then counts
+# towards each of its mutations instead of only single mutants being drawn (see Variant_effects.py)
+variant_effect = None
 
 # Function to safely load a file (CSV or Excel)
 def safe_load_file(file_path):
     try:
         if file_path.endswith('.csv'):
-            return pd.read_csv(file_path, encoding='ISO-8859-1', compression='infer', engine='python')
+            return load_table(file_path)
+        elif file_path.endswith(('.parquet', '.feather', '.arrow')):
+            return read_results(file_path)
         elif file_path.endswith('.xlsx') or file_path.endswith('.xls'):
             return pd.read_excel(file_path, engine='openpyxl')
         else:
@@ -40,138 +63,158 @@ def safe_load_file(file_path):
             print(f"Failed to load {file_path}: {e}")
             exit(1)
 
-# Load the raw flow cytometry data
-flow_data = safe_load_file(flow_data_file)
-flow_data['%Gated'] = pd.to_numeric(flow_data['%Gated'], errors='coerce')  # Ensure numeric values
-
-
-# Load the mutation data
-mutation_data = safe_load_file(mutation_data_file)
-
-
-# Parse the GenPept file to extract sequence information
-genpept_record = SeqIO.read(snapgene_file, "genbank")
-sequence = str(genpept_record.seq)
-
-
-# Normalize the columns for matching
-flow_data['Sample_Name'] = flow_data['Sample_Name'].str.strip().str.lower()
-mutation_data['Name'] = mutation_data['Name'].str.strip().str.lower()
-
-# Function to find closest matches for debugging
-def find_closest_match(sample_name, mutation_names):
-    matches = get_close_matches(sample_name, mutation_names, n=1, cutoff=0.6)
-    return matches[0] if matches else None
-
-
-# Prepare a list of all possible amino acids
-amino_acids = list("ACDEFGHIKLMNPQRSTVWY") + ["null"]
-
-# Create a DataFrame to organize the heatmap data
-heatmap_data = pd.DataFrame(index=amino_acids, columns=[f"{aa}{i+1}" for i, aa in enumerate(sequence)])
-heatmap_data = heatmap_data.astype(float)  # Ensure all values are floats
-
-# Debug: Track unmatched samples
-unmatched_samples = []
-closest_matches = []
-
-for _, row in flow_data.iterrows():
-    sample_name = row['Sample_Name']
-    try:
-        flow_value = float(row['%Gated'])  # Convert to float explicitly
-    except ValueError:
-        flow_value = np.nan  # Assign NaN for invalid values
-
-    # Exact matching for sample names
-    matching_mutation = mutation_data[mutation_data['Name'] == sample_name]
-    if not matching_mutation.empty:
-        position = matching_mutation.iloc[0]['Mutated Residue']
-        amino_acid = matching_mutation.iloc[0]['Mutant AA']
-        if str(position).isdigit() and 1 <= int(position) <= len(sequence):
-            original_aa = sequence[int(position) - 1]
-            column_name = f"{original_aa}{position}"
-            if column_name in heatmap_data.columns and amino_acid in heatmap_data.index:
-                heatmap_data.at[amino_acid, column_name] = flow_value
+# Function to parse the GenPept file to extract sequence information
+@instrumented('genpept parse')
+def load_sequence(snapgene_file):
+    genpept_record = SeqIO.read(snapgene_file, "genbank")
+    return str(genpept_record.seq)
+
+
+# Function to turn flow data and a mutation table into the cleaned heatmap matrix and its colour range.
+# With effect set ('marginal' or 'additive') the samples are read as a multi-mutant library and the mutation
+# table is optional.
+def prepare_heatmap(flow_data, mutation_data, sequence, memo=None, effect=variant_effect):
+    flow_data = flow_data.copy()
+    flow_data['%Gated'] = pd.to_numeric(flow_data['%Gated'], errors='coerce')  # Ensure numeric values
+
+    # Normalize the columns for matching
+    flow_data['Sample_Name'] = flow_data['Sample_Name'].str.strip().str.lower()
+    if mutation_data is not None:
+        mutation_data = mutation_data.copy()
+        mutation_data['Name'] = mutation_data['Name'].str.strip().str.lower()
+
+    if effect:
+        # Sparse variant x mutation matrix: each mutation's value is fitted over every variant that carries it
+        heatmap_data, unmatched, _ = build_variant_heatmap(flow_data, mutation_data, sequence, effect, memo=memo)
     else:
-        closest_match = find_closest_match(sample_name, mutation_data['Name'].tolist())
-        if closest_match:
-            matching_mutation = mutation_data[mutation_data['Name'] == closest_match]
-            if not matching_mutation.empty:
-                position = matching_mutation.iloc[0]['Mutated Residue']
-                amino_acid = matching_mutation.iloc[0]['Mutant AA']
-                if str(position).isdigit() and 1 <= int(position) <= len(sequence):
-                    original_aa = sequence[int(position) - 1]
-                    column_name = f"{original_aa}{position}"
-                    if column_name in heatmap_data.columns and amino_acid in heatmap_data.index:
-                        heatmap_data.at[amino_acid, column_name] = flow_value
-        else:
-            unmatched_samples.append(sample_name)
-            closest_matches.append((sample_name, closest_match))
-
-# Debug: Print unmatched samples and their closest matches
-if unmatched_samples:
-    print("Warning: The following samples were not matched:")
-    for sample, match in zip(unmatched_samples, closest_matches):
-        print(f"Unmatched Sample: {sample}, Closest Match: {match}")
-
-
-# Ensure all amino acids are represented, even if they have no data
-data_cleaned = heatmap_data.reindex(index=amino_acids, columns=heatmap_data.columns)
-
-# Always add 'bc96_none' and 'ND' columns at the end of the x-axis
-for special_column in ['bc96_none', 'ND']:
-    if special_column not in data_cleaned.columns:
-        data_cleaned[special_column] = np.nan  # Add missing special columns
-
-    # Assign flow values for 'bc96_none' and 'ND' to the "null" row if they exist in flow data
-    flow_value = flow_data.loc[flow_data['Sample_Name'] == special_column.lower(), '%Gated'].max()
-    if not np.isnan(flow_value):
-        data_cleaned.at['null', special_column] = flow_value
-
-# Reorder columns to ensure 'bc96_none' and 'ND' are at the end
-columns = [col for col in data_cleaned.columns if col not in ['bc96_none', 'ND']]
-columns += ['bc96_none', 'ND']
-data_cleaned = data_cleaned[columns]
-
-# Determine vmin and vmax for the heatmap
-nd_value = data_cleaned.at['null', 'ND'] if 'ND' in data_cleaned.columns else np.nan
-bc96_none_value = data_cleaned.at['null', 'bc96_none'] if 'bc96_none' in data_cleaned.columns else np.nan
-vmin = bc96_none_value - 1 if not np.isnan(bc96_none_value) else 0
-vmax = nd_value + 1 if not np.isnan(nd_value) else 10
-
-# Check if cleaned data is empty
-if data_cleaned.empty:
-    print("No valid data available for the heatmap after processing. Exiting.")
-else:
-   
-
-    # Create the heatmap
-    plt.figure(figsize=(25, 10))
-    ax = sns.heatmap(
-        data_cleaned,
-        cmap="viridis",
-        cbar=True,
-        linewidths=0.5,
-        annot=True,
-        fmt=".2f",
-        mask=data_cleaned.isnull(),
-        vmin=vmin,
-        vmax=vmax,
-    )
+        # Build the amino acid x residue matrix with one join and one vectorized scatter;
+        # fuzzy matches already resolved against the mutation file are reused from the memo
+        heatmap_data, unmatched = build_heatmap_data(flow_data, mutation_data, sequence, memo=memo)
+
+    # Debug: Track unmatched samples
+    unmatched_samples = [sample for sample, _ in unmatched]
+    closest_matches = unmatched
+
+    # Debug: Print unmatched samples and their closest matches
+    if unmatched_samples:
+        print("Warning: The following samples were not matched:")
+        for sample, match in zip(unmatched_samples, closest_matches):
+            print(f"Unmatched Sample: {sample}, Closest Match: {match}")
+
+    # Ensure all amino acids are represented, even if they have no data
+    data_cleaned = heatmap_data.reindex(index=amino_acids, columns=heatmap_data.columns)
+
+    # Always add 'bc96_none' and 'ND' columns at the end of the x-axis
+    for special_column in ['bc96_none', 'ND']:
+        if special_column not in data_cleaned.columns:
+            data_cleaned[special_column] = np.nan  # Add missing special columns
+
+        # Assign flow values for 'bc96_none' and 'ND' to the "null" row if they exist in flow data
+        flow_value = flow_data.loc[flow_data['Sample_Name'] == special_column.lower(), '%Gated'].max()
+        if not np.isnan(flow_value):
+            data_cleaned.at['null', special_column] = flow_value
+
+    # Reorder columns to ensure 'bc96_none' and 'ND' are at the end
+    columns = [col for col in data_cleaned.columns if col not in ['bc96_none', 'ND']]
+    columns += ['bc96_none', 'ND']
+    data_cleaned = data_cleaned[columns]
+
+    # Determine vmin and vmax for the heatmap
+    nd_value = data_cleaned.at['null', 'ND'] if 'ND' in data_cleaned.columns else np.nan
+    bc96_none_value = data_cleaned.at['null', 'bc96_none'] if 'bc96_none' in data_cleaned.columns else np.nan
+    vmin = bc96_none_value - 1 if not np.isnan(bc96_none_value) else 0
+    vmax = nd_value + 1 if not np.isnan(nd_value) else 10
+
+    return data_cleaned, vmin, vmax
+
+
+# Function to write each measured value on its cell, in black or white depending on the cell colour
+def annotate_cells(ax, values, image):
+    rows, columns = np.nonzero(~np.isnan(values))
+    cell_values = values[rows, columns]
+    red, green, blue, _ = image.cmap(image.norm(cell_values)).T
+    dark = (0.2126 * red + 0.7152 * green + 0.0722 * blue) <= 0.408  # same cut-off sns.heatmap uses
+    for row, column, value, is_dark in zip(rows, columns, cell_values, dark):
+        ax.text(column, row, f"{value:.2f}", ha='center', va='center', fontsize=7,
+                color='white' if is_dark else 'black')
+
+
+# Function to draw the heatmap and save it under a timestamped name.
+# The matrix is drawn as one image (empty cells left blank); long proteins skip the per-cell text, and
+# panel_width splits them into stacked windows of that many columns.
+def plot_heatmap(data_cleaned, vmin, vmax, output_folder=output_folder, name='gb2004_rd4',
+                 title="Flow Cytometry Heatmap_gb2004 rd", panel_width=panel_width,
+                 annotate_max_columns=annotate_max_columns):
+    # Check if cleaned data is empty
+    if data_cleaned.empty:
+        print("No valid data available for the heatmap after processing. Exiting.")
+        return None
+
+    os.makedirs(output_folder, exist_ok=True)  # Create the folder if it doesn't exist
+
+    values = data_cleaned.to_numpy(dtype=float)
+    column_labels = [str(column) for column in data_cleaned.columns]
+    row_labels = [str(row) for row in data_cleaned.index]
+    n_columns = len(column_labels)
+    windows = [(start, min(start + panel_width, n_columns)) for start in range(0, n_columns, panel_width)] \
+        if panel_width else [(0, n_columns)]
+
+    # Create the heatmap: one image per panel, empty cells transparent
+    fig = new_figure((25, 10) if len(windows) == 1 else (25, 4 * len(windows) + 1))
+    axes = fig.subplots(len(windows), 1, squeeze=False)[:, 0]
+    cmap = matplotlib.colormaps['viridis'].with_extremes(bad=(0, 0, 0, 0))
+
+    for ax, (start, stop) in zip(axes, windows):
+        window = values[:, start:stop]
+        width = stop - start
+        image = ax.imshow(np.ma.masked_invalid(window), cmap=cmap, vmin=vmin, vmax=vmax, aspect='auto',
+                          interpolation='nearest')
+
+        # Label every column while they fit, otherwise every n-th one
+        step = max(1, int(np.ceil(width / annotate_max_columns)))
+        ax.set_xticks(np.arange(0, width, step))
+        ax.set_xticklabels(column_labels[start:stop:step], rotation=90)
+        ax.set_yticks(np.arange(len(row_labels)))
+        ax.set_yticklabels(row_labels)
+        ax.set_ylabel("Mutated Amino Acids", fontsize=14)
+
+        if width <= annotate_max_columns:
+            annotate_cells(ax, window, image)
+
+            # Thin white lines between the cells
+            ax.set_xticks(np.arange(-0.5, width, 1), minor=True)
+            ax.set_yticks(np.arange(-0.5, len(row_labels), 1), minor=True)
+            ax.grid(which='minor', color='white', linewidth=0.5)
+            ax.tick_params(which='minor', length=0)
+
+    fig.colorbar(image, ax=list(axes))
 
     # Customize the plot
-    plt.title("Flow Cytometry Heatmap_gb2004 rd", fontsize=16)
-    plt.xlabel("Protein Sequence (Original Amino Acids)", fontsize=14)
-    plt.ylabel("Mutated Amino Acids", fontsize=14)
+    axes[0].set_title(title, fontsize=16)
+    axes[-1].set_xlabel("Protein Sequence (Original Amino Acids)", fontsize=14)
 
     # Generate a unique filename using a timestamp
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_file_name = f"gb2004_rd4_{timestamp}.png"
+    output_file_name = f"{name}_{timestamp}.png"
     output_file_path = os.path.join(output_folder, output_file_name)
 
     # Save the heatmap to the designated folder
-    plt.tight_layout()
-    plt.savefig(output_file_path)
+    save_figure(fig, output_file_path, bbox_inches='tight')
     print(f"Heatmap saved to {output_file_path}")
+    return output_file_path
+
+
+def main():
+    # Load the raw flow cytometry data and the mutation data
+    flow_data = query_results(**flow_data_query) if flow_data_query else safe_load_file(flow_data_file)
+    mutation_data = safe_load_file(mutation_data_file)
+    sequence = load_sequence(snapgene_file)
+
+    match_memo = MatchMemo(mutation_data_file)
+    data_cleaned, vmin, vmax = prepare_heatmap(flow_data, mutation_data, sequence, memo=match_memo)
+    match_memo.save()
+    plot_heatmap(data_cleaned, vmin, vmax)
+
 
-    
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from Flow_cache import cache_dir, file_fingerprint, load_manifest, save_manifest
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Example manifest (CSV or JSON) with one row per heatmap:
+#   flow_file,mutation_file,genpept_file,protein,round
+#   spreadsheets/rd3.parquet,11_25_2004_1mut.csv,gb2004_CDS.gpt,gb2004,3
+# 'protein' defaults to the GenPept file name and 'round' to the row's order within its protein; an optional
+# 'effect' column ('marginal' or 'additive') reads that row's samples as a multi-mutant library (A12V:K45R)
+manifest_file = 'heatmap_manifest.csv'
+output_folder = 'heatmap_output'
+arrays_folder = 'heatmap_arrays'
+
+sequence_dir = os.path.join(cache_dir, 'sequences')
+sequence_index_path = os.path.join(sequence_dir, 'index.json')
+
+
+# Function to read a heatmap manifest and fill in the protein, round and output name of every entry
+def load_heatmap_manifest(manifest_path):
+    if manifest_path.endswith('.json'):
+        with open(manifest_path) as f:
+            entries = pd.DataFrame(json.load(f))
+    else:
+        entries = pd.read_csv(manifest_path)
+
+    missing = {'flow_file', 'mutation_file', 'genpept_file'} - set(entries.columns)
+    if missing:
+        raise ValueError(f"Manifest {manifest_path} is missing the column(s): {', '.join(sorted(missing))}.")
+
+    # Relative paths are read relative to the manifest
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    for column in ['flow_file', 'mutation_file', 'genpept_file']:
+        entries[column] = [path if os.path.isabs(path) else os.path.join(base_dir, path) for path in entries[column]]
+
+    if 'protein' not in entries.columns:
+        entries['protein'] = np.nan
+    entries['protein'] = entries['protein'].fillna(
+        entries['genpept_file'].map(lambda path: os.path.splitext(os.path.basename(path))[0]))
+    if 'round' not in entries.columns:
+        entries['round'] = entries.groupby('protein').cumcount() + 1
+    entries['round'] = entries['round'].fillna(entries.groupby('protein').cumcount() + 1).astype(int)
+    if 'name' not in entries.columns:
+        entries['name'] = np.nan
+    entries['name'] = entries['name'].fillna(entries['protein'] + '_rd' + entries['round'].astype(str))
+    if 'effect' not in entries.columns:
+        entries['effect'] = None
+    entries['effect'] = entries['effect'].astype(object).where(entries['effect'].notna(), None)
+    return entries.to_dict('records')
+
+
+# Function to parse a GenPept sequence once and keep it, keyed by the file's content hash
+def cached_sequence(genpept_path):
+    index = load_manifest(sequence_index_path)
+    key = os.path.abspath(genpept_path)
+    previous = index.get(key)
+    fingerprint = file_fingerprint(genpept_path, previous)
+    cache_path = os.path.join(sequence_dir, f"{fingerprint['sha256']}.seq")
+
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            sequence = f.read()
+    else:
+        from Heat_map_v2 import load_sequence
+        sequence = load_sequence(genpept_path)
+        os.makedirs(sequence_dir, exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(sequence)
+        os.replace(tmp_path, cache_path)
+
+    if previous != fingerprint:
+        index[key] = fingerprint
+        save_manifest(sequence_index_path, index)
+    return sequence
+
+
+# Function to build one entry's heatmap matrix and render it (run inside a worker process)
+def build_and_render(entry, output_folder=output_folder, render=True):
+    from Heat_map_v2 import safe_load_file, prepare_heatmap, plot_heatmap
+    from Name_matcher import MatchMemo
+
+    match_memo = MatchMemo(entry['mutation_file'])
+    data_cleaned, vmin, vmax = prepare_heatmap(safe_load_file(entry['flow_file']), safe_load_file(entry['mutation_file']),
+                                               cached_sequence(entry['genpept_file']), memo=match_memo,
+                                               effect=entry.get('effect'))
+    match_memo.save()
+
+    image_path = None
+    if render:
+        image_path = plot_heatmap(data_cleaned, vmin, vmax, output_folder=output_folder, name=entry['name'],
+                                  title=f"Flow Cytometry Heatmap_{entry['protein']} rd{entry['round']}")
+    return data_cleaned, vmin, vmax, image_path
+
+
+# Function to save every round of one protein as a stacked (rounds x 21 x L) array file
+def save_stacked_rounds(protein, entries, matrices, arrays_folder=arrays_folder):
+    order = np.argsort([entry['round'] for entry in entries], kind='stable')
+    entries = [entries[i] for i in order]
+    matrices = [matrices[i] for i in order]
+
+    # The residue columns are stacked; the trailing bc96_none and ND controls (on the 'null' row) are kept apart
+    data_cleaned = matrices[0][0]
+    residue_columns = [column for column in data_cleaned.columns if column not in ('bc96_none', 'ND')]
+    for entry, (matrix, _, _) in zip(entries, matrices):
+        if list(matrix.columns) != list(data_cleaned.columns):
+            raise ValueError(f"{entry['name']} does not use the same sequence as the other rounds of {protein}.")
+    values = np.stack([matrix[residue_columns].to_numpy(dtype=float) for matrix, _, _ in matrices])
+    controls = np.array([[matrix.at['null', 'bc96_none'], matrix.at['null', 'ND']] for matrix, _, _ in matrices],
+                        dtype=float)
+
+    os.makedirs(arrays_folder, exist_ok=True)
+    output_path = os.path.join(arrays_folder, f'{protein}_rounds.npz')
+    np.savez_compressed(
+        output_path,
+        values=values,
+        controls=controls,
+        control_names=np.array(['bc96_none', 'ND']),
+        rounds=np.array([entry['round'] for entry in entries]),
+        amino_acids=np.array(data_cleaned.index, dtype=str),
+        residues=np.array(residue_columns, dtype=str),
+        flow_files=np.array([entry['flow_file'] for entry in entries], dtype=str),
+        vmin=np.array([vmin for _, vmin, _ in matrices], dtype=float),
+        vmax=np.array([vmax for _, _, vmax in matrices], dtype=float),
+    )
+    return output_path
+
+
+# Function to load a stacked rounds file back as (values, metadata)
+def load_stacked_rounds(path):
+    with np.load(path) as arrays:
+        return arrays['values'], {key: arrays[key] for key in arrays.files if key != 'values'}
+
+
+# Function to build and render every heatmap of a manifest in a process pool, then stack each protein's rounds
+def run_heatmap_batch(manifest_path, workers=None, output_folder=output_folder, arrays_folder=arrays_folder,
+                      render=True):
+    entries = load_heatmap_manifest(manifest_path)
+
+    # Parse each distinct GenPept file once up front, so the workers only read the cached sequence
+    for genpept_path in dict.fromkeys(entry['genpept_file'] for entry in entries):
+        cached_sequence(genpept_path)
+
+    workers = workers or os.cpu_count()
+    if workers > 1 and len(entries) > 1:
+        from Plot_render import start_batch
+        with ProcessPoolExecutor(max_workers=workers, initializer=start_batch) as pool:
+            results = list(pool.map(build_and_render, entries, [output_folder] * len(entries), [render] * len(entries)))
+    else:
+        results = [build_and_render(entry, output_folder, render) for entry in entries]
+
+    # Rounds of the same protein share a sequence, so their matrices stack into one array
+    stacked = {}
+    for protein in dict.fromkeys(entry['protein'] for entry in entries):
+        picked = [i for i, entry in enumerate(entries) if entry['protein'] == protein]
+        stacked[protein] = save_stacked_rounds(protein, [entries[i] for i in picked],
+                                               [results[i][:3] for i in picked], arrays_folder)
+        print(f"{len(picked)} round(s) of {protein} stacked in {stacked[protein]}")
+    return results, stacked
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and render the heatmaps of many proteins and rounds.')
+    parser.add_argument('manifest', nargs='?', default=manifest_file,
+                        help='CSV or JSON listing flow_file, mutation_file, genpept_file (and optionally protein, round, name)')
+    parser.add_argument('--workers', type=int, help='Number of worker processes (default: one per CPU)')
+    parser.add_argument('--heatmap-dir', default=output_folder)
+    parser.add_argument('--arrays-dir', default=arrays_folder, help='Folder for the stacked <protein>_rounds.npz files')
+    parser.add_argument('--no-render', action='store_true', help='Only build and stack the matrices')
+    args = parser.parse_args()
+
+    run_heatmap_batch(args.manifest, workers=args.workers, output_folder=args.heatmap_dir,
+                      arrays_folder=args.arrays_dir, render=not args.no_render)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+from difflib import get_close_matches
+
+from Name_matcher import NameMatcher
+from Flow_instrument import instrumented
+from Compact_schema import float64_values
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Prepare a list of all possible amino acids
+amino_acids = list("ACDEFGHIKLMNPQRSTVWY") + ["null"]
+
+
+# Function to find closest matches for debugging
+def find_closest_match(sample_name, mutation_names):
+    matches = get_close_matches(sample_name, mutation_names, n=1, cutoff=0.6)
+    return matches[0] if matches else None
+
+
+# Function to resolve every sample name to a mutation name: exact matches first, then the closest fuzzy match
+@instrumented('name matching')
+def resolve_sample_names(sample_names, mutation_names, memo=None):
+    sample_names = pd.Series(sample_names).reset_index(drop=True)
+    known_names = pd.Index(mutation_names).dropna()
+    exact = sample_names.isin(known_names) & sample_names.notna()
+
+    # Each distinct unmatched name is fuzzy-matched once, however many rows carry it
+    missing = sample_names[~exact & sample_names.notna()].unique()
+    fuzzy = {}
+    if len(missing):
+        fuzzy = NameMatcher(known_names.unique()).match_many(missing, memo)
+
+    return sample_names.where(exact, sample_names.map(fuzzy))
+
+
+# Function to build the amino acid x residue matrix of flow values for single mutants
+@instrumented('heatmap matrix')
+def build_heatmap_data(flow_data, mutation_data, sequence, memo=None):
+    length = len(sequence)
+
+    # Create a DataFrame to organize the heatmap data
+    columns = [f"{aa}{i+1}" for i, aa in enumerate(sequence)]
+
+    # Index the mutation table by name, keeping the first row of each name
+    mutations = mutation_data[mutation_data['Name'].notna()].drop_duplicates('Name')
+    mutation_index = pd.Index(mutations['Name'])
+
+    # Work out each mutation's matrix cell once: a digit-only position inside the sequence and a known amino acid
+    position_text = mutations['Mutated Residue'].astype(str)
+    position = pd.to_numeric(position_text.where(position_text.str.isdigit()), errors='coerce')
+    valid_position = position.between(1, length).to_numpy()
+    aa_row = pd.Index(amino_acids).get_indexer(mutations['Mutant AA'])
+    cell_valid = valid_position & (aa_row >= 0)
+    cell_column = np.where(valid_position, position.fillna(0).to_numpy(dtype=np.int64) - 1, -1)
+
+    # Resolve every flow sample to a mutation with a single join
+    sample_names = flow_data['Sample_Name'].reset_index(drop=True)
+    resolved = resolve_sample_names(sample_names, mutations['Name'], memo)
+    codes = mutation_index.get_indexer(resolved)
+    flow_values = float64_values(flow_data['%Gated'])
+
+    # Debug: Track unmatched samples
+    unmatched = [(name, None) for name in sample_names[codes < 0]]
+
+    # Scatter all values in one step; when several samples land on one cell the last one wins
+    hit = (codes >= 0) & cell_valid[np.maximum(codes, 0)]
+    rows = aa_row[codes[hit]]
+    cols = cell_column[codes[hit]]
+    values = flow_values[hit]
+    last = ~pd.Series(rows * length + cols).duplicated(keep='last').to_numpy()
+
+    matrix = np.full((len(amino_acids), length), np.nan)
+    matrix[rows[last], cols[last]] = values[last]
+
+    heatmap_data = pd.DataFrame(matrix, index=amino_acids, columns=columns)
+    return heatmap_data, unmatched
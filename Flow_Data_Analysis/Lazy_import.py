@@ -0,0 +1,17 @@
+import sys
+import importlib.util
+
+
+# Function to import a module on first use: the module object is returned right away, but its code (and everything
+# it imports) only runs when one of its attributes is first read. A module that is not installed still fails here.
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,193 @@
+import os
+import ast
+import json
+import argparse
+
+from Flow_instrument import instrumented
+from Compact_schema import float64_values
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Example spec (JSON, or YAML when PyYAML is installed):
+#   {"gates": [{"gate": "R6", "y_parameter": "methanogen"},
+#              {"gate": "R9", "y_parameter": "methanogen"}],
+#    "metrics": {"% Viable Cells": "(100 - R9) / 100 * R6"}}
+# A gate entry may also be a bare gate name (any Y Parameter) and may set "name" to use in expressions;
+# metrics can use the gates and any metric listed before them (by name, when it is a valid identifier)
+# The default spec (viability) reads R6 and R9 on whatever Y Parameter they were gated on, as Flow_PI always has
+DEFAULT_SPEC = {
+    'gates': ['R6', 'R9'],
+    'metrics': {'% Viable Cells': '(100 - R9) / 100 * R6'},
+}
+
+# Operators and NumPy functions (by name, looked up when an expression is compiled) an expression may use
+BINARY_OPERATORS = {ast.Add: 'add', ast.Sub: 'subtract', ast.Mult: 'multiply', ast.Div: 'divide', ast.Pow: 'power'}
+UNARY_OPERATORS = {ast.USub: 'negative', ast.UAdd: 'positive'}
+FUNCTIONS = {'abs': 'abs', 'sqrt': 'sqrt', 'log': 'log', 'log2': 'log2', 'log10': 'log10', 'exp': 'exp',
+             'min': 'fmin', 'max': 'fmax', 'clip': 'clip'}
+
+
+# Function to compile a metric expression into a function of {name: column array}, allowing only arithmetic,
+# numbers, known names and the FUNCTIONS above (no attribute access, indexing or arbitrary calls)
+def compile_expression(text, names):
+    try:
+        tree = ast.parse(text, mode='eval')
+    except SyntaxError as error:
+        raise ValueError(f"Metric expression '{text}' is not valid: {error.msg}.") from None
+
+    def build(node):
+        if isinstance(node, ast.Expression):
+            return build(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            value = float(node.value)
+            return lambda columns: value
+        if isinstance(node, ast.Name):
+            if node.id not in names:
+                raise ValueError(f"Metric expression '{text}' uses {node.id}, which is not a gate or an earlier metric.")
+            name = node.id
+            return lambda columns: columns[name]
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            operator, left, right = getattr(np, BINARY_OPERATORS[type(node.op)]), build(node.left), build(node.right)
+            return lambda columns: operator(left(columns), right(columns))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            operator, operand = getattr(np, UNARY_OPERATORS[type(node.op)]), build(node.operand)
+            return lambda columns: operator(operand(columns))
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS
+                and not node.keywords):
+            function, arguments = getattr(np, FUNCTIONS[node.func.id]), [build(argument) for argument in node.args]
+            return lambda columns: function(*(argument(columns) for argument in arguments))
+        if isinstance(node, ast.Call):
+            raise ValueError(f"Metric expression '{text}' calls {ast.unparse(node.func)}; "
+                             f"only {', '.join(FUNCTIONS)} are allowed.")
+        raise ValueError(f"Metric expression '{text}' uses '{ast.unparse(node)}', which is not allowed.")
+
+    return build(tree)
+
+
+# Gates to pick out of a long gate-summary table and metrics computed from them, all in one pivot
+class MetricSpec:
+    def __init__(self, gates, metrics=None, value_column='%Gated'):
+        self.gates = []
+        for gate in gates:
+            if isinstance(gate, str):
+                gate = {'gate': gate}
+            if 'gate' not in gate:
+                raise ValueError(f"Gate entry {gate} has no 'gate'.")
+            self.gates.append({'name': gate.get('name', gate['gate']), 'gate': gate['gate'],
+                               'y_parameter': gate.get('y_parameter')})
+        names = [gate['name'] for gate in self.gates]
+        if len(set(names)) != len(names):
+            raise ValueError("Two gate entries have the same name; give one of them a 'name'.")
+
+        # Each metric may use the gates and the metrics listed before it
+        self.metrics = {}
+        for name, expression in (metrics or {}).items():
+            self.metrics[name] = compile_expression(expression, set(names) | set(self.metrics))
+        self.value_column = value_column
+
+    @classmethod
+    def from_dict(cls, spec):
+        return cls(spec['gates'], spec.get('metrics'), spec.get('value_column', '%Gated'))
+
+    # Function to tell, for each distinct (Gate, Y Parameter) pair, which gate entries it belongs to.
+    # Each column is factorized on its own (free for categoricals) and the patterns are tested on the distinct values only.
+    def _match_pairs(self, df):
+        gate_codes, gate_values = pd.factorize(df['Gate'])
+        y_codes, y_values = pd.factorize(df['Y Parameter'])
+
+        # Code 0 stands for a missing gate or Y Parameter; a missing Y Parameter only matches gates without a pattern
+        codes = (gate_codes + 1) * (len(y_values) + 1) + (y_codes + 1)
+        gate_values = np.array(['', *map(str, gate_values)], dtype=object)
+        y_values = pd.Series(['', *map(str, y_values)], dtype=object)
+        matches = []
+        for gate in self.gates:
+            gate_match = gate_values == gate['gate']
+            gate_match[0] = False
+            y_match = np.ones(len(y_values), dtype=bool)
+            if gate['y_parameter']:
+                y_match = y_values.str.contains(gate['y_parameter'], case=False, na=False).to_numpy(dtype=bool, copy=True)
+                y_match[0] = False
+            matches.append(np.outer(gate_match, y_match).ravel())
+        return codes, matches
+
+    # Function to keep only the rows of the spec's gates (the long table, unchanged otherwise)
+    def select_rows(self, df):
+        codes, matches = self._match_pairs(df)
+        return df[np.logical_or.reduce(matches)[codes]] if matches else df.iloc[:0]
+
+    # Function to pivot the long table into one row per key (gate values as columns, replicate rows averaged)
+    # and compute every metric on the resulting columns with vectorized arithmetic
+    @instrumented('metric pivot')
+    def evaluate(self, df, keys=None):
+        keys = [key for key in (keys or default_keys(df)) if key in df.columns]
+        codes, matches = self._match_pairs(df)
+        values = float64_values(df[self.value_column])
+
+        # One factorization of the keys gives every row its output row
+        selected = np.logical_or.reduce(matches)[codes] if matches else np.zeros(len(df), dtype=bool)
+        key_frame = df.loc[selected, keys]
+        row_codes = key_frame.groupby(keys, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+        key_table = key_frame.drop_duplicates(ignore_index=True)
+        selected_codes, selected_values = codes[selected], values[selected]
+
+        # Wide Sample x Gate matrix: mean of each gate's values per key (NaN where a gate was not measured)
+        matrix = np.full((len(key_table), len(self.gates)), np.nan)
+        for column, match in enumerate(matches):
+            rows = match[selected_codes] & ~np.isnan(selected_values)
+            counts = np.bincount(row_codes[rows], minlength=len(key_table))
+            sums = np.bincount(row_codes[rows], weights=selected_values[rows], minlength=len(key_table))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                matrix[:, column] = np.where(counts > 0, sums / counts, np.nan)
+
+        columns = {gate['name']: matrix[:, column] for column, gate in enumerate(self.gates)}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for name, metric in self.metrics.items():
+                columns[name] = np.broadcast_to(metric(columns), len(key_table)).astype(float)
+
+        return key_table.assign(**columns)
+
+
+# Rows the filter, average and flow steps keep: the R6 gate on a methanogen Y Parameter
+FILTER_SPEC = MetricSpec([{'gate': 'R6', 'y_parameter': 'methanogen'}])
+
+
+# Function to choose the pivot keys: plate and sample name, plus the well when present so replicate wells stay apart
+def default_keys(df):
+    return [key for key in ('Plate', 'Sample_Name', 'Sample') if key in df.columns]
+
+
+# Function to read a spec from a JSON or YAML file
+def load_metric_spec(spec_path):
+    with open(spec_path) as f:
+        if spec_path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("Reading a YAML spec needs PyYAML (pip install pyyaml); "
+                                  "or write the spec as JSON.") from None
+            return MetricSpec.from_dict(yaml.safe_load(f))
+        return MetricSpec.from_dict(json.load(f))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute gate metrics from a results table with a spec.')
+    parser.add_argument('results_file')
+    parser.add_argument('spec', nargs='?', help='JSON or YAML spec (default: R6, R9 and %% Viable Cells)')
+    parser.add_argument('-o', '--output', help='Save the wide table here (default: print it)')
+    args = parser.parse_args()
+
+    from Result_io import read_results, write_results
+    spec = load_metric_spec(args.spec) if args.spec else MetricSpec.from_dict(DEFAULT_SPEC)
+    wide = spec.evaluate(read_results(args.results_file))
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        write_results(wide, args.output)
+        print(f"{len(wide)} row(s) saved to {args.output}")
+    else:
+        print(wide.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import os
+from difflib import SequenceMatcher
+
+from Flow_cache import cache_dir, file_digest, load_manifest, save_manifest
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+
+
+# Function to turn a string into an array of character codes
+def _char_codes(text):
+    return np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+
+
+# Fuzzy name matcher giving the same answer as get_close_matches(name, candidates, n=1, cutoff).
+# Candidates are indexed once as a character-count matrix, so difflib's quick_ratio() bound is computed
+# for all of them in one NumPy step and only the survivors are scored with ratio(), best bound first.
+class NameMatcher:
+    def __init__(self, candidates, cutoff=0.6):
+        self.cutoff = cutoff
+        self.candidates = list(dict.fromkeys(c for c in candidates if isinstance(c, str)))
+        self.lengths = np.array([len(c) for c in self.candidates], dtype=np.int64)
+
+        # Character-count matrix: one row per candidate, one column per character seen in any candidate
+        codes = _char_codes(''.join(self.candidates))
+        self.alphabet, char_ids = np.unique(codes, return_inverse=True)
+        row_ids = np.repeat(np.arange(len(self.candidates)), self.lengths)
+        self.counts = np.zeros((len(self.candidates), len(self.alphabet)), dtype=np.int32)
+        np.add.at(self.counts, (row_ids, char_ids), 1)
+
+    # Function to return the closest candidate to a name, or None below the cutoff
+    def match(self, name):
+        if not isinstance(name, str) or not self.candidates:
+            return None
+
+        # Count the query's characters in the candidates' alphabet (unknown characters can never match)
+        codes = _char_codes(name)
+        positions = np.searchsorted(self.alphabet, codes).clip(max=max(len(self.alphabet) - 1, 0))
+        known = self.alphabet[positions] == codes if len(self.alphabet) else np.zeros(len(codes), dtype=bool)
+        query = np.bincount(positions[known], minlength=len(self.alphabet))
+
+        # quick_ratio() for every candidate at once; ratio() can never exceed it
+        total = self.lengths + len(name)
+        shared = np.minimum(self.counts, query).sum(axis=1)
+        bound = np.where(total > 0, 2.0 * shared / np.maximum(total, 1), 1.0)
+
+        survivors = np.flatnonzero(bound >= self.cutoff)
+        survivors = survivors[np.argsort(-bound[survivors], kind='stable')]
+
+        matcher = SequenceMatcher()
+        matcher.set_seq2(name)
+        best = None
+        for i in survivors:
+            # Ties are broken by the larger name (as heapq.nlargest does in get_close_matches)
+            if best is not None and bound[i] < best[0]:
+                break
+            matcher.set_seq1(self.candidates[i])
+            score = matcher.ratio()
+            if score >= self.cutoff and (best is None or (score, self.candidates[i]) > best):
+                best = (score, self.candidates[i])
+        return best[1] if best else None
+
+    # Function to match many names, consulting and filling an optional memo first
+    def match_many(self, names, memo=None):
+        matches = {}
+        for name in names:
+            if memo is not None and name in memo:
+                matches[name] = memo[name]
+            else:
+                matches[name] = self.match(name)
+                if memo is not None:
+                    memo[name] = matches[name]
+        return matches
+
+
+# Persistent memo of resolved matches, keyed by the content hash of the file the candidate names came from
+class MatchMemo(dict):
+    def __init__(self, source_file_path, cutoff=0.6):
+        digest = file_digest(source_file_path)
+        self.path = os.path.join(cache_dir, 'matches', f'{digest}_{cutoff}.json')
+        super().__init__(load_manifest(self.path))
+        self.changed = False
+
+    def __setitem__(self, name, match):
+        self.changed = True
+        super().__setitem__(name, match)
+
+    # Function to write the memo back if new matches were resolved
+    def save(self):
+        if self.changed:
+            save_manifest(self.path, dict(self))
+            self.changed = False
@@ -0,0 +1,109 @@
+import re
+
+from Compact_schema import strip_decimal_suffix
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Wells are numbered row-major with room for the 32 rows x 48 columns of a 1536-well plate
+MAX_PLATE_ROWS = 32
+MAX_PLATE_COLUMNS = 48
+PLATE_SLOTS = MAX_PLATE_ROWS * MAX_PLATE_COLUMNS
+WELL_PATTERN = re.compile(r'^([A-Z]{1,2})0*(\d+)$')
+
+# Supported plate formats: well count -> (rows, columns)
+LAYOUTS = {96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+
+
+# Function to turn one well name such as 'A1' or 'AF48' into its row-major index (-1 when not a well)
+def _parse_well(well):
+    match = WELL_PATTERN.match(str(well).strip().upper())
+    if not match:
+        return -1
+    letters, number = match.groups()
+
+    # 'A'..'Z' are rows 0-25, 'AA'..'AF' continue at 26 for 1536-well plates
+    row = ord(letters[-1]) - 65 + (26 * (ord(letters[0]) - 64) if len(letters) == 2 else 0)
+    column = int(number)
+    if row >= MAX_PLATE_ROWS or not 1 <= column <= MAX_PLATE_COLUMNS:
+        return -1
+    return row * MAX_PLATE_COLUMNS + column - 1
+
+
+# Function to compute the well index of every row, parsing each distinct well name only once
+def well_index(wells):
+    codes, uniques = pd.factorize(pd.Series(wells))
+    lookup = np.array([_parse_well(well) for well in uniques] + [-1], dtype=np.int32)
+    return lookup[codes]  # missing names have code -1, which picks the trailing -1
+
+
+# Function to name the well at a row-major index ('A1', 'P24', 'AF48')
+def well_name(index):
+    row, column = divmod(int(index), MAX_PLATE_COLUMNS)
+    letters = chr(65 + row) if row < 26 else 'A' + chr(65 + row - 26)
+    return f'{letters}{column + 1}'
+
+
+# Array-backed well -> sample name lookup: one categorical code per well slot of a 1536-well grid
+class PlateIndex:
+    def __init__(self, names):
+        self.names = pd.Categorical(names)
+        if len(self.names) != PLATE_SLOTS:
+            raise ValueError(f"A plate index needs one entry per well slot ({PLATE_SLOTS}), got {len(self.names)}.")
+
+        # A trailing -1 code makes well index -1 (not a well) gather a missing name
+        self._codes = np.append(self.names.codes, -1)
+
+        # Smallest standard plate holding every named well
+        rows, columns = np.divmod(np.flatnonzero(self.names.codes >= 0), MAX_PLATE_COLUMNS)
+        self.layout = next((wells for wells, (n_rows, n_columns) in LAYOUTS.items()
+                            if not len(rows) or (rows.max() < n_rows and columns.max() < n_columns)), 1536)
+
+    # Function to build the index from a plate-map layout (row letters in the first column, column numbers as headers)
+    @classmethod
+    def from_layout(cls, platemap_df):
+        row_starts = well_index(platemap_df.iloc[:, 0].astype(str) + '1')
+        column_numbers = pd.to_numeric(pd.Series(platemap_df.columns[1:]).astype(str), errors='coerce').to_numpy()
+
+        # Every cell's slot is its row start plus its column offset
+        slots = row_starts[:, None] + (column_numbers - 1)[None, :]
+        valid = ((row_starts >= 0)[:, None] & (column_numbers >= 1)[None, :] &
+                 (column_numbers <= MAX_PLATE_COLUMNS)[None, :])
+
+        values = platemap_df.iloc[:, 1:].to_numpy(dtype=object)
+        names = np.full(PLATE_SLOTS, None, dtype=object)
+        filled = valid & ~pd.isna(values)
+
+        # A map column read as numbers holds 12.0 for sample 12; those cells are named as Flow.py names them ('12')
+        labels = pd.Series([str(value) for value in values[filled]], dtype=object)
+        numeric = np.array([not isinstance(value, str) for value in values[filled]], dtype=bool)
+        if numeric.any():
+            labels[numeric] = strip_decimal_suffix(labels[numeric]).astype(str)
+        names[slots[filled].astype(np.int64)] = labels.to_numpy()
+        return cls(names)
+
+    # Function to rebuild the index from its cached dense frame
+    @classmethod
+    def from_dense_frame(cls, df):
+        return cls(df['Sample_Name'])
+
+    # Function to store the index as one 'Sample_Name' row per well slot (cached as Arrow)
+    def to_dense_frame(self):
+        return pd.DataFrame({'Sample_Name': self.names})
+
+    # Function to list the wells of the plate layout: 'Well', 'Sample_Name' and 'Well_Index'
+    def to_frame(self):
+        n_rows, n_columns = LAYOUTS[self.layout]
+        indices = (np.arange(n_rows)[:, None] * MAX_PLATE_COLUMNS + np.arange(n_columns)[None, :]).ravel()
+        return pd.DataFrame({'Well': [well_name(index) for index in indices],
+                             'Sample_Name': self.take(indices),
+                             'Well_Index': indices.astype(np.int32)})
+
+    # Function to gather the sample name of every well index (-1 gives a missing name)
+    def take(self, indices):
+        return pd.Categorical.from_codes(self._codes[np.asarray(indices)], categories=self.names.categories)
+
+    # Function to look up the sample name of every well name
+    def lookup(self, wells):
+        return self.take(well_index(wells))
@@ -1,9 +1,19 @@
 import os
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 import re
-from natsort import natsorted, ns
+
+from Metric_spec import MetricSpec
+from Result_io import read_results
+from Results_store import query_results, query_label
+from Flow_instrument import stage
+from Plot_render import MARKERS, new_figure, close_figure, draw_points_and_means
+from Replicate_stats import replicate_stats
+from Lazy_import import lazy_import
+
+pd = lazy_import('pandas')
+sns = lazy_import('seaborn')
+
+# Gate plotted by this script (from any Y Parameter)
+PLOT_SPEC = MetricSpec(['R9'])
 
 # Function to extract the alphabetical and numerical components of a sample name
 def split_alpha_num(name):
@@ -16,11 +26,21 @@ def split_alpha_num(name):
 
 # Function to load and process the data
 def load_and_process_data(excel_file):
-    # Read Excel into a pandas DataFrame
-    data = pd.read_excel(excel_file)
-    
-    # Filter for R6 gate data
-    filtered_data = data[data['Gate'] == 'R9']
+    # Read the results (Parquet, Feather, CSV or Excel) into a pandas DataFrame
+    data = read_results(excel_file)
+    return process_data(data)
+
+# Function to load the R9 rows from the results store by query (the per-well filtered rows unless kind is given)
+# and process them
+def query_and_process_data(**filters):
+    query = dict(filters, gate='R9')
+    query.setdefault('kind', 'filtered')
+    return process_data(query_results(**query))
+
+# Function to sort the R9 rows of a results table and average them per sample
+def process_data(data):
+    # Filter for R9 gate data
+    filtered_data = PLOT_SPEC.select_rows(data)
     
     # Apply alphabetical + numerical sorting using a DataFrame helper column
     filtered_data = filtered_data.copy()
@@ -33,62 +53,65 @@ def load_and_process_data(excel_file):
     # Drop the helper columns after sorting
     filtered_data = filtered_data.drop(columns=['AlphaPart', 'NumPart'])
 
-    # Calculate the mean '%Gated' for each 'Sample_Name'
-    mean_gated_values = filtered_data.groupby('Sample_Name')['%Gated'].mean().reset_index()
+    # Calculate the mean '%Gated' for each 'Sample_Name', with its replicate statistics
+    mean_gated_values = replicate_stats(filtered_data)
 
     return filtered_data, mean_gated_values
 
 # (Rest of the code remains unchanged)
 
 
-def plot_data(filtered_data, mean_gated_values, excel_file, save_path=None):
-    plt.figure(figsize=(17, 8))  # Adjust width (14) to create more space
-    
-    sns.scatterplot(data=filtered_data, 
-                    x='Sample_Name', 
-                    y='%Gated', 
-                    hue='Sample_Name', 
-                    style='Sample_Name', 
-                    s=100, 
-                    palette='bright', 
-                    markers=True, 
-                    legend=False)
-    
+def plot_data(filtered_data, mean_gated_values, excel_file, save_path=None, show=True):
+    fig = new_figure((17, 8))  # Adjust width (14) to create more space
+    ax = fig.add_subplot()
+
+    # Rows without a sample name (wells left empty in the plate map) have no mean and no tick, so they are not drawn
+    filtered_data = filtered_data[filtered_data['Sample_Name'].notna()]
     unique_samples = filtered_data['Sample_Name'].unique()
-    sample_position = {sample: i for i, sample in enumerate(unique_samples)}
-    
-    for _, row in mean_gated_values.iterrows():
-        sample_name = row['Sample_Name']
-        sample_x_pos = sample_position[sample_name]
-        plt.hlines(y=row['%Gated'], xmin=sample_x_pos - 0.2, xmax=sample_x_pos + 0.2, 
-                   colors='gray', linestyles='-', lw=2)
-    
-    plt.xlabel('', fontsize=14)
-    plt.ylabel('% Dead Methanogens', fontsize=14)
-    plt.title('Methanogen Flow Cytometry Analysis - Metabolic Dye Pilot - R9', fontsize=16)
-    plt.xticks(ticks=range(len(unique_samples)), labels=unique_samples, rotation=50, fontsize=12, ha='right')
-    plt.subplots_adjust(bottom=0.5)
-    plt.yticks(fontsize=12)
-    plt.ylim(0, 7)
+    positions = pd.Categorical(filtered_data['Sample_Name'], categories=unique_samples).codes
+    mean_positions = pd.Categorical(mean_gated_values['Sample_Name'], categories=unique_samples).codes
+
+    # Every point in one scatter call per marker shape and every mean in one hlines call
+    draw_points_and_means(ax, positions, filtered_data['%Gated'], sns.color_palette('bright', len(unique_samples)),
+                          markers=MARKERS, size=100, mean_positions=mean_positions,
+                          mean_values=mean_gated_values['%Gated'], mean_width=0.2,
+                          mean_intervals=(mean_gated_values['%Gated CI Low'], mean_gated_values['%Gated CI High']),
+                          colors='gray', linestyles='-', lw=2)
+
+    ax.set_xlabel('', fontsize=14)
+    ax.set_ylabel('% Dead Methanogens', fontsize=14)
+    ax.set_title('Methanogen Flow Cytometry Analysis - Metabolic Dye Pilot - R9', fontsize=16)
+    ax.set_xticks(range(len(unique_samples)))
+    ax.set_xticklabels(unique_samples, rotation=50, fontsize=12, ha='right')
+    fig.subplots_adjust(bottom=0.5)
+    ax.tick_params(axis='y', labelsize=12)
+    ax.set_ylim(0, 7)
 
     # Add gridlines
-    plt.grid(visible=True, which='major', axis='both', linestyle='--', linewidth=0.5, alpha=0.7)
-    
-    plt.tight_layout()
+    ax.grid(visible=True, which='major', axis='both', linestyle='--', linewidth=0.5, alpha=0.7)
 
+    fig.tight_layout()
+
+    file_path = None
     if save_path:
         os.makedirs(save_path, exist_ok=True)
         file_name = os.path.splitext(os.path.basename(excel_file))[0]
         file_path = os.path.join(save_path, f'{file_name}_R9_plot.png')
-        plt.savefig(file_path, bbox_inches='tight', dpi=300)
+        with stage('savefig'):
+            fig.savefig(file_path, bbox_inches='tight', dpi=300)
         print(f"Plot saved to {file_path}")
-    
-    plt.show()
+
+    close_figure(fig, show)
+    return file_path
 
 # Main function to load data and generate plot
-def main(excel_file, save_path=None):
-    # Load and process the data
-    filtered_data, mean_gated_values = load_and_process_data(excel_file)
+def main(excel_file, save_path=None, results_query=None):
+    # Load and process the data, from the results store when a query is given
+    if results_query:
+        filtered_data, mean_gated_values = query_and_process_data(**results_query)
+        excel_file = query_label(**results_query)
+    else:
+        filtered_data, mean_gated_values = load_and_process_data(excel_file)
     
     # Plot the data and save to file if save_path is provided
     plot_data(filtered_data, mean_gated_values, excel_file, save_path)
@@ -97,6 +120,9 @@ def main(excel_file, save_path=None):
     print("Plot has been generated and displayed.")
 
 # Example usage
-excel_file = 'Spreadsheets/20250313_RFF CTC and diSc3_CB_filtered_data.xlsx'  # Use the correct path to your Excel file
+excel_file = 'Spreadsheets/20250313_RFF CTC and diSc3_CB_filtered_data.parquet'  # Use the correct path to your results file
 save_path = 'plots'  # Folder where the plot will be saved
-main(excel_file, save_path)
+results_query = None  # Or a results store query, e.g. {'kind': 'filtered', 'sample': 'gb2004*', 'since': '2025-01-01'}
+
+if __name__ == '__main__':
+    main(excel_file, save_path, results_query)
@@ -0,0 +1,133 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from Flow_instrument import stage
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+
+# Marker shapes cycled through per category
+MARKERS = ['o', 's', 'D', '^', 'v', '<', '>', 'p', 'X', '*']
+
+# In batch mode figures are drawn off-screen on one Figure per process that is cleared and reused
+batch_mode = False
+_batch_figure = None
+
+
+# Function to switch this process to headless batch rendering (Agg backend, reused figure, no plt.show())
+def start_batch():
+    global batch_mode
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+    batch_mode = True
+
+
+# Function to get a blank figure of the given size: the reused one in batch mode, a new pyplot figure otherwise
+def new_figure(figsize):
+    global _batch_figure
+    if batch_mode:
+        from matplotlib.figure import Figure
+        if _batch_figure is None:
+            _batch_figure = Figure()
+        _batch_figure.clf()
+        _batch_figure.set_size_inches(figsize)
+        return _batch_figure
+
+    import matplotlib.pyplot as plt
+    return plt.figure(figsize=figsize)
+
+
+# Function to save a figure and, outside batch mode, show and close it
+def save_figure(fig, output_path, show=False, **savefig_options):
+    with stage('savefig'):
+        fig.savefig(output_path, **savefig_options)
+    close_figure(fig, show)
+
+
+# Function to release a figure: a pyplot figure is shown if asked and closed, the reused batch figure is kept
+def close_figure(fig, show=False):
+    if fig is not _batch_figure:
+        import matplotlib.pyplot as plt
+        if show:
+            plt.show()
+        plt.close(fig)
+
+
+# Function to draw every point and every mean bar of a categorical plot in a handful of vectorized calls.
+# positions[i] is the x slot of point i (negative for points without a slot); palette colors and markers are cycled per slot.
+def draw_points_and_means(ax, positions, values, palette, markers=None, size=100,
+                          mean_positions=None, mean_values=None, mean_width=0.2, mean_intervals=None,
+                          **hline_options):
+    positions = np.asarray(positions)
+    values = np.asarray(values, dtype=float)
+    placed = positions >= 0
+    positions, values = positions[placed], values[placed]
+
+    # One scatter call per marker shape (at most len(MARKERS)), covering every category that uses it
+    if len(positions):
+        palette = np.asarray(palette, dtype=float)
+        point_colors = palette[positions % len(palette)]
+        markers = markers or ['o']
+        point_markers = np.asarray(markers, dtype=object)[positions % len(markers)]
+        for marker in dict.fromkeys(markers):
+            selected = point_markers == marker
+            if selected.any():
+                ax.scatter(positions[selected], values[selected], c=point_colors[selected], marker=marker, s=size)
+
+    # All mean bars in one hlines call
+    if mean_values is not None and len(mean_values):
+        mean_positions = np.asarray(mean_positions, dtype=float)
+        ax.hlines(np.asarray(mean_values, dtype=float), mean_positions - mean_width, mean_positions + mean_width,
+                  **hline_options)
+
+        # Confidence intervals of the means as error bars: every bar in one vlines call and every cap in one hlines call
+        if mean_intervals is not None:
+            low, high = (np.asarray(bound, dtype=float) for bound in mean_intervals)
+            shown = ~(np.isnan(low) | np.isnan(high))
+            color = hline_options.get('colors', 'gray')
+            ax.vlines(mean_positions[shown], low[shown], high[shown], colors=color, lw=1)
+            ax.hlines(np.concatenate([low[shown], high[shown]]), np.tile(mean_positions[shown] - mean_width / 3, 2),
+                      np.tile(mean_positions[shown] + mean_width / 3, 2), colors=color, lw=1)
+
+
+# Function to render every plot of one plate (run inside a batch worker); returns the saved paths
+def render_plate(sample_file, plate_map_file, save_dir='plots'):
+    from Flow_ingest import load_joined_samples
+    from Flow import filter_methanogen, plot_flow
+    from Flow_PI import compute_viability, plot_viability
+    from Plot_filtered import process_data, plot_data
+
+    joined = load_joined_samples(sample_file, plate_map_file)
+    base_name = os.path.splitext(os.path.basename(sample_file))[0]
+
+    enriched = joined.rename(columns={'Sample_Name': 'Mapped Sample'})
+    saved = [plot_flow(filter_methanogen(enriched), sample_file, save_dir=save_dir, show=False)]
+
+    # The viability and R9 plots read every gate measured on the methanogen Y Parameter
+    methanogen_rows = joined[joined['Y Parameter'].str.contains('methanogen', case=False, na=False)]
+    gates = set(methanogen_rows['Gate'].astype(str))
+    if {'R6', 'R9'} <= gates:
+        saved.append(plot_viability(compute_viability(methanogen_rows), f'{base_name}_Viability',
+                                    save_dir=save_dir, show=False))
+    if 'R9' in gates:
+        r9_data, mean_gated_values = process_data(methanogen_rows)
+        saved.append(plot_data(r9_data, mean_gated_values, sample_file, save_path=save_dir, show=False))
+    return saved
+
+
+# Function to render the plots of every plate of a campaign concurrently in a process pool
+def render_campaign(sample_dir='Flow_Files', platemap_dir='Plate_Maps', save_dir='plots', workers=None):
+    from Batch_engine import find_plate_pairs
+
+    pairs = find_plate_pairs(sample_dir, platemap_dir)
+    sample_files = [sample_file for _, sample_file, _ in pairs]
+    plate_map_files = [plate_map_file for _, _, plate_map_file in pairs]
+
+    workers = workers or os.cpu_count()
+    if workers > 1 and len(pairs) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=start_batch) as pool:
+            results = list(pool.map(render_plate, sample_files, plate_map_files, [save_dir] * len(pairs)))
+    else:
+        start_batch()
+        results = [render_plate(s, p, save_dir) for s, p in zip(sample_files, plate_map_files)]
+    return [path for paths in results for path in paths]
@@ -0,0 +1,122 @@
+
+from Flow_instrument import instrumented
+from Compact_schema import float64_values
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Control samples: ND is the untreated reference, gb2004 the bc96_none control
+ND_SAMPLE = 'ND'
+BC96_NONE_SAMPLE = 'gb2004'
+
+# Bootstrap settings: resamples per sample, coverage of the interval, and the seed that makes every run identical
+BOOTSTRAP_RESAMPLES = 2000
+CONFIDENCE = 0.95
+SEED = 0
+
+# Modified z-score (median and MAD of a sample's replicates) above which a replicate is flagged as an outlier
+OUTLIER_THRESHOLD = 3.5
+
+# Most resampled values held in memory at once; samples are bootstrapped in blocks below this size
+MAX_DRAWS = 1 << 23
+
+
+# Function to bootstrap the mean of every group at once: groups with the same replicate count are stacked into a
+# (groups x replicates) matrix and resampled as one (groups x resamples x replicates) index array per block
+def bootstrap_mean_ci(values, codes, n_groups, resamples=BOOTSTRAP_RESAMPLES, confidence=CONFIDENCE, seed=SEED):
+    rng = np.random.default_rng(seed)
+    low = np.full(n_groups, np.nan)
+    high = np.full(n_groups, np.nan)
+
+    order = np.argsort(codes, kind='stable')
+    sorted_values = values[order]
+    counts = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    tails = [(1 - confidence) / 2, 1 - (1 - confidence) / 2]
+
+    # A single replicate has no spread to resample, so its interval stays NaN
+    for n in np.unique(counts[counts > 1]):
+        groups = np.flatnonzero(counts == n)
+        matrix = sorted_values[starts[groups][:, None] + np.arange(n)]
+        index_type = np.uint8 if n <= 256 else np.int64
+        block_size = max(1, MAX_DRAWS // (resamples * n))
+        for block in range(0, len(groups), block_size):
+            block_values = matrix[block:block + block_size]
+            picks = rng.integers(0, n, size=(len(block_values), resamples, n), dtype=index_type)
+            means = np.take_along_axis(block_values[:, None, :], picks, axis=2).mean(axis=2)
+            low[groups[block:block + block_size]], high[groups[block:block + block_size]] = np.quantile(means, tails, axis=1)
+    return low, high
+
+
+# Function to flag replicates far from their group's median (|0.6745 (x - median) / MAD| > threshold);
+# groups of fewer than three replicates are never flagged
+def flag_outliers(values, codes, threshold=OUTLIER_THRESHOLD):
+    grouped = pd.Series(values).groupby(codes)
+    median = grouped.transform('median').to_numpy()
+    deviation = np.abs(values - median)
+    mad = pd.Series(deviation).groupby(codes).transform('median').to_numpy()
+    count = grouped.transform('count').to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = 0.6745 * deviation / mad
+    # With a MAD of zero, any value off the median is an outlier
+    score = np.where(mad == 0, np.where(deviation > 0, np.inf, 0), score)
+    return (count >= 3) & (score > threshold)
+
+
+# Function to compute replicate statistics for every group of a long table at once: replicate count, mean, SD, CV,
+# bootstrap CI of the mean, outlier count and z-scores against the ND and gb2004 controls of the same block
+# (the same keys apart from Sample_Name, e.g. the same plate and gate)
+@instrumented('replicate stats')
+def replicate_stats(df, keys=('Sample_Name',), value_column='%Gated', resamples=BOOTSTRAP_RESAMPLES,
+                    confidence=CONFIDENCE, seed=SEED, controls=(ND_SAMPLE, BC96_NONE_SAMPLE)):
+    keys = list(keys)
+    values = float64_values(df[value_column])
+
+    # Rows with a missing key (e.g. a well left empty in the plate map) belong to no group and are dropped
+    valid = ~np.isnan(values) & df[keys].notna().all(axis=1).to_numpy()
+    grouper = df[valid].groupby(keys, observed=True, sort=True)
+    codes = grouper.ngroup().to_numpy()
+    stats = grouper.size().index.to_frame(index=False)
+    values = values[valid]
+    n_groups = len(stats)
+
+    # Counts, means and SDs from per-group sums, in one bincount each
+    counts = np.bincount(codes, minlength=n_groups)
+    means = np.bincount(codes, weights=values, minlength=n_groups) / counts
+    squares = np.bincount(codes, weights=(values - means[codes]) ** 2, minlength=n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sd = np.sqrt(squares / (counts - 1))
+        cv = 100 * sd / np.abs(means)
+    low, high = bootstrap_mean_ci(values, codes, n_groups, resamples, confidence, seed)
+
+    stats[value_column] = means
+    stats['Replicates'] = counts
+    stats[f'{value_column} SD'] = sd
+    stats[f'{value_column} CV'] = cv
+    stats[f'{value_column} CI Low'] = low
+    stats[f'{value_column} CI High'] = high
+    stats['Outliers'] = np.bincount(codes, weights=flag_outliers(values, codes), minlength=n_groups).astype(int)
+
+    if 'Sample_Name' in keys:
+        block_keys = [key for key in keys if key != 'Sample_Name']
+        for control in controls:
+            stats[f'Z vs {control}'] = control_z_scores(stats, control, block_keys, value_column)
+    return stats
+
+
+# Function to express every group's mean in SDs of a control's replicates, within the same block
+def control_z_scores(stats, control, block_keys, value_column='%Gated'):
+    sample_names = stats['Sample_Name'].astype(str)
+    control_rows = stats[sample_names == control]
+    if block_keys:
+        reference = stats[block_keys].merge(control_rows[block_keys + [value_column, f'{value_column} SD']],
+                                            on=block_keys, how='left')
+        control_mean = reference[value_column].to_numpy()
+        control_sd = reference[f'{value_column} SD'].to_numpy()
+    else:
+        control_mean = control_rows[value_column].mean() if len(control_rows) else np.nan
+        control_sd = control_rows[f'{value_column} SD'].mean() if len(control_rows) else np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (stats[value_column].to_numpy() - control_mean) / control_sd
+
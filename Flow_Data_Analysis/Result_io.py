@@ -0,0 +1,73 @@
+import os
+import threading
+
+from Flow_ingest import load_table
+from Flow_instrument import instrumented, stage
+from Compact_schema import widen_float32
+from Lazy_import import lazy_import
+
+pd = lazy_import('pandas')
+
+
+# Function to write a result table to Excel on a background thread
+def export_excel(df, excel_path):
+    # Work on a private copy so the caller can keep modifying its frame (Excel cells hold float64 only)
+    df = widen_float32(df.copy())
+
+    def write():
+        df.to_excel(excel_path, index=False)
+        print(f"Excel export saved to {excel_path}")
+
+    # Not a daemon thread: the interpreter waits for the export to finish before exiting
+    thread = threading.Thread(target=write, name=f'excel-export-{os.path.basename(excel_path)}')
+    thread.start()
+    return thread
+
+
+# Function to save a result table as Parquet, optionally adding an .xlsx copy in the background
+@instrumented('write results')
+def write_results(df, output_file_path, excel=False):
+    if output_file_path.endswith('.parquet'):
+        df.to_parquet(output_file_path, index=False)
+    elif output_file_path.endswith(('.feather', '.arrow')):
+        df.reset_index(drop=True).to_feather(output_file_path)
+    else:
+        raise ValueError(f"Unsupported output format for {output_file_path}.")
+
+    excel_path = os.path.splitext(output_file_path)[0] + '.xlsx'
+    return export_excel(df, excel_path) if excel else None
+
+
+# Function to write a stream of DataFrame chunks into one Parquet file without holding them all in memory
+def write_chunks(chunks, output_file_path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    writer = None
+    rows = 0
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output_file_path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+# Function to load a result table whatever format it was saved in
+@instrumented('read results')
+def read_results(file_path, columns=None):
+    if file_path.endswith('.parquet'):
+        return pd.read_parquet(file_path, columns=columns)
+    elif file_path.endswith(('.feather', '.arrow')):
+        return pd.read_feather(file_path, columns=columns)
+    elif file_path.endswith('.csv'):
+        return load_table(file_path, columns=columns)
+    elif file_path.endswith(('.xlsx', '.xls')):
+        with stage('excel read'):
+            return pd.read_excel(file_path, sheet_name=0, usecols=columns)  # Load first sheet
+    else:
+        raise ValueError("Unsupported file format. Please provide a Parquet, Feather, CSV or Excel file.")
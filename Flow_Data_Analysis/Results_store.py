@@ -0,0 +1,246 @@
+import os
+import re
+import sqlite3
+import argparse
+import datetime
+
+from Flow_instrument import instrumented
+from Compact_schema import widen_float32
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# SQLite file holding every filtered and averaged table written so far (kept outside the disposable .flow_cache)
+store_path = os.environ.get('FLOW_RESULTS_STORE', 'flow_results.sqlite')
+
+# Columns every stored table has; any other column of an appended table is added to the store on first use
+RUN_COLUMNS = ['run_id', 'kind', 'run_date']
+BASE_COLUMNS = RUN_COLUMNS + ['Plate', 'Sample_Name', 'Gate', 'Y Parameter', '%Gated']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    run_date TEXT NOT NULL,
+    source TEXT,
+    rows INTEGER
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    run_date TEXT NOT NULL,
+    "Plate" TEXT,
+    "Sample_Name" TEXT,
+    "Gate" TEXT,
+    "Y Parameter" TEXT,
+    "%Gated" REAL
+);
+CREATE TABLE IF NOT EXISTS latest_plate_runs (
+    kind TEXT NOT NULL,
+    "Plate" TEXT NOT NULL,
+    run_id INTEGER NOT NULL,
+    PRIMARY KEY (kind, "Plate")
+);
+CREATE INDEX IF NOT EXISTS results_sample ON results ("Sample_Name", "Gate", run_date);
+CREATE INDEX IF NOT EXISTS results_plate ON results ("Plate", kind, run_id);
+CREATE INDEX IF NOT EXISTS results_gate ON results ("Gate", run_date);
+CREATE INDEX IF NOT EXISTS results_run_date ON results (run_date);
+'''
+
+# Kind of table a query returns when none is given; the filtered and averaged copies of a plate are never mixed
+DEFAULT_KIND = 'averaged'
+
+# Query filters and the column each one applies to
+FILTER_COLUMNS = {'sample': 'Sample_Name', 'plate': 'Plate', 'gate': 'Gate', 'y_parameter': 'Y Parameter',
+                  'kind': 'kind', 'run_id': 'run_id'}
+
+
+# Function to open the store, creating its tables and indexes the first time
+def connect(db_path=None):
+    # NumPy scalars (e.g. integer columns) are written as plain Python numbers
+    for numpy_type, python_type in [(np.int64, int), (np.int32, int), (np.float32, float), (np.bool_, bool)]:
+        sqlite3.register_adapter(numpy_type, python_type)
+    db_path = db_path or store_path
+    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+    connection = sqlite3.connect(db_path)
+    # WAL lets plots and queries read while a run is being appended
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+
+# Function to add the columns of a table that the store does not have yet
+def _add_missing_columns(connection, df):
+    existing = {row[1] for row in connection.execute('PRAGMA table_info(results)')}
+    for column in df.columns:
+        if column not in existing:
+            if pd.api.types.is_integer_dtype(df[column]) or pd.api.types.is_bool_dtype(df[column]):
+                column_type = 'INTEGER'  # counts such as Replicates and Outliers come back as integers
+            elif pd.api.types.is_numeric_dtype(df[column]):
+                column_type = 'REAL'
+            else:
+                column_type = 'TEXT'
+            connection.execute(f'ALTER TABLE results ADD COLUMN {_quote(column)} {column_type}')
+
+
+# Function to append a filtered ('filtered') or averaged ('averaged') results table as a new run; returns its run_id.
+# Each plate's newest run of a kind is what queries return unless all_runs is asked for.
+@instrumented('store append')
+def append_results(df, kind, source=None, run_date=None, db_path=None):
+    run_date = (run_date or datetime.datetime.now()).isoformat(timespec='seconds')
+    df = widen_float32(df.reset_index(drop=True))
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(df[column]):
+            df[column] = df[column].astype(object).where(df[column].notna(), None)
+
+    with connect(db_path) as connection:
+        _add_missing_columns(connection, df)
+        run_id = connection.execute('INSERT INTO runs (kind, run_date, source, rows) VALUES (?, ?, ?, ?)',
+                                    (kind, run_date, source, len(df))).lastrowid
+
+        columns = RUN_COLUMNS + list(df.columns)
+        placeholders = ', '.join('?' * len(columns))
+        rows = ((run_id, kind, run_date, *values) for values in df.itertuples(index=False, name=None))
+        connection.executemany(f'INSERT INTO results ({", ".join(map(_quote, columns))}) VALUES ({placeholders})', rows)
+
+        if 'Plate' in df.columns:
+            connection.executemany('INSERT OR REPLACE INTO latest_plate_runs (kind, "Plate", run_id) VALUES (?, ?, ?)',
+                                   ((kind, plate, run_id) for plate in df['Plate'].dropna().unique()))
+        refresh_statistics(connection)
+    connection.close()
+    return run_id
+
+
+# Function to re-run ANALYZE once the store has grown by a quarter since the last time, so the query planner
+# keeps picking the sample, plate or date index that matches a query
+def refresh_statistics(connection, growth=1.25):
+    total_rows = connection.execute('SELECT COALESCE(SUM(rows), 0) FROM runs').fetchone()[0]
+    analyzed_rows = 0
+    if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+        stat = connection.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = 'results' LIMIT 1").fetchone()
+        analyzed_rows = int(stat[0].split()[0]) if stat else 0
+    if total_rows > growth * analyzed_rows:
+        connection.execute('ANALYZE')
+
+
+# Function to turn one filter value into SQL: a list matches any of its items, '*' and '?' are wildcards
+def _condition(column, value):
+    if isinstance(value, (list, tuple, set)):
+        value = list(value)
+        return f'r.{_quote(column)} IN ({", ".join("?" * len(value))})', value
+    if isinstance(value, str) and ('*' in value or '?' in value):
+        return f'r.{_quote(column)} GLOB ?', [value]
+    return f'r.{_quote(column)} = ?', [value]
+
+
+# Function to query the store: e.g. query_results(sample='gb2004*', gate='R6', since='2025-01-01').
+# Only each plate's newest run of a kind is returned unless all_runs is True; with_run adds run_id, kind and run_date.
+# Without a kind only averaged tables are returned (kind='filtered' for the per-well rows); a run_id keeps its own kind.
+@instrumented('store query')
+def query_results(sample=None, plate=None, gate=None, y_parameter=None, kind=None, run_id=None, since=None,
+                  until=None, all_runs=False, with_run=False, columns=None, db_path=None):
+    if kind is None and run_id is None:
+        kind = DEFAULT_KIND
+    conditions, parameters = [], []
+    for name, value in [('sample', sample), ('plate', plate), ('gate', gate), ('y_parameter', y_parameter),
+                        ('kind', kind), ('run_id', run_id)]:
+        if value is not None:
+            condition, values = _condition(FILTER_COLUMNS[name], value)
+            conditions.append(condition)
+            parameters.extend(values)
+    if since:
+        conditions.append('r.run_date >= ?')
+        parameters.append(str(since))
+    if until:
+        # A bare date includes the whole of that day
+        conditions.append('r.run_date <= ?')
+        parameters.append(str(until) + ('T23:59:59' if len(str(until)) == 10 else ''))
+
+    join = ''
+    if not all_runs and run_id is None:
+        join = 'JOIN latest_plate_runs l ON l.kind = r.kind AND l."Plate" = r."Plate" AND l.run_id = r.run_id'
+    selected = ', '.join(f'r.{_quote(column)}' for column in columns) if columns else 'r.*'
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+
+    with connect(db_path) as connection:
+        cursor = connection.execute(f'SELECT {selected} FROM results r {join} {where}', parameters)
+        df = pd.DataFrame.from_records(cursor.fetchall(), columns=[d[0] for d in cursor.description])
+    connection.close()
+
+    # Columns that only other kinds of table carry come back empty, so they are dropped
+    if not columns and len(df):
+        df = df[[column for column in df.columns if column in BASE_COLUMNS or df[column].notna().any()]]
+        if not with_run:
+            df = df.drop(columns=RUN_COLUMNS, errors='ignore')
+    return df
+
+
+# Function to list the runs held in the store, newest first
+def list_runs(db_path=None):
+    with connect(db_path) as connection:
+        runs = pd.read_sql_query('SELECT * FROM runs ORDER BY run_id DESC', connection)
+    connection.close()
+    return runs
+
+
+# Function to build a file-name-safe label for a query, used to name plots drawn from it
+def query_label(**filters):
+    parts = [f'{name}-{",".join(map(str, value)) if isinstance(value, (list, tuple)) else value}'
+             for name, value in filters.items() if value not in (None, False)]
+    return re.sub(r'[^A-Za-z0-9_.,=+-]+', '_', '_'.join(['store'] + parts))
+
+
+# Function to add the query filters to an argument parser (shared by the query command and the plotting commands)
+def add_query_arguments(parser):
+    parser.add_argument('--sample', action='append', help="Sample_Name, '*' wildcards allowed (repeat for several)")
+    parser.add_argument('--plate', action='append', help='Plate (repeat for several)')
+    parser.add_argument('--gate', action='append', help='Gate (repeat for several)')
+    parser.add_argument('--y-parameter', help='Y Parameter')
+    parser.add_argument('--kind', choices=['filtered', 'averaged'],
+                        help='Filtered (per-well) or averaged tables (default: averaged; viability, metrics and '
+                             'plot-filtered read filtered)')
+    parser.add_argument('--run-id', type=int, help='One stored run')
+    parser.add_argument('--since', help='Runs on or after this date (YYYY-MM-DD)')
+    parser.add_argument('--until', help='Runs on or before this date (YYYY-MM-DD)')
+    parser.add_argument('--all-runs', action='store_true', help="Every stored run, not only each plate's newest")
+    parser.add_argument('--store', default=None, help=f'Results store (default: {store_path})')
+    return parser
+
+
+# Function to pick the query filters out of parsed arguments
+def query_filters(args):
+    def one_or_many(values):
+        return values[0] if values and len(values) == 1 else values
+
+    return {'sample': one_or_many(args.sample), 'plate': one_or_many(args.plate), 'gate': one_or_many(args.gate),
+            'y_parameter': args.y_parameter, 'kind': args.kind, 'run_id': args.run_id, 'since': args.since,
+            'until': args.until, 'all_runs': args.all_runs}
+
+
+def main():
+    parser = add_query_arguments(argparse.ArgumentParser(description='Query the results store.'))
+    parser.add_argument('-o', '--output', help='Save the rows (.parquet, .feather or .csv) instead of printing them')
+    parser.add_argument('--runs', action='store_true', help='List the stored runs instead')
+    args = parser.parse_args()
+
+    if args.runs:
+        print(list_runs(args.store).to_string(index=False))
+        return
+    df = query_results(**query_filters(args), db_path=args.store)
+    if args.output and args.output.endswith('.csv'):
+        df.to_csv(args.output, index=False)
+    elif args.output:
+        from Result_io import write_results
+        write_results(df, args.output)
+    else:
+        print(df.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
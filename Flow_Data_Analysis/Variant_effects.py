@@ -0,0 +1,259 @@
+import os
+import argparse
+
+from Heatmap_matrix import amino_acids, resolve_sample_names
+from Flow_instrument import instrumented
+from Compact_schema import float64_values
+from Lazy_import import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# A variant name lists its mutations split by ':' (also '+', ';' or ','), each as an optional wild-type letter,
+# the 1-based residue and the mutant amino acid: 'A12V', 'A12V:K45R', '12V+45R'. 'wt' is the unmutated protein.
+MUTATION_SEPARATORS = r'[:+;,]'
+MUTATION_PATTERN = r'^([A-Za-z]?)(\d+)([A-Za-z])$'
+WILD_TYPE_NAMES = ['wt', 'wildtype', 'wild_type', 'wild-type']
+
+# Heatmap values a variant library can be drawn with: the plain mean of every variant carrying a mutation, or the
+# mutation's effect in an additive model fitted over all variants (drawn as the single mutant it predicts)
+EFFECT_KINDS = ['marginal', 'additive']
+
+# Ridge damping of the additive fit; keeps mutations that only ever appear together from taking arbitrary values
+ADDITIVE_DAMP = 0.01
+
+# Pairs of mutations reported in the epistasis table: seen together in at least this many multi-mutants
+MIN_PAIR_COUNT = 2
+
+# Columns per residue in the feature space: one per row of the heatmap
+N_AA = len(amino_acids)
+
+
+# Function to split every variant name into its mutations: one row per mutation with the variant it belongs to,
+# its heatmap row and residue (0-based), and whether it is a valid mutation of this sequence (known amino acid,
+# residue inside the sequence, and a wild-type letter, when given, that matches the sequence)
+def parse_variants(names, sequence):
+    names = pd.Series(np.asarray(names, dtype=object)).astype(str).str.strip()
+    tokens = names.str.split(MUTATION_SEPARATORS).explode().str.strip()
+    tokens = tokens[~tokens.str.lower().isin(WILD_TYPE_NAMES) & (tokens != '')]
+
+    # A library repeats the same mutations across many variants, so each distinct one is parsed once
+    token_codes, unique_tokens = pd.factorize(tokens)
+    parts = pd.Series(unique_tokens, dtype=object).str.extract(MUTATION_PATTERN)
+    position = pd.to_numeric(parts[1], errors='coerce').fillna(0).to_numpy(dtype=np.int64) - 1
+    aa_row = pd.Index(amino_acids[:-1]).get_indexer(parts[2].str.upper())
+    in_sequence = (position >= 0) & (position < len(sequence))
+
+    wild_type = parts[0].fillna('').str.upper().to_numpy(dtype=object)
+    residues = np.array(list(sequence.upper()), dtype=object)
+    sequence_aa = residues[np.where(in_sequence, position, 0)]
+    valid = in_sequence & (aa_row >= 0) & ((wild_type == '') | (wild_type == sequence_aa))
+
+    return pd.DataFrame({'variant': tokens.index.to_numpy(), 'position': position[token_codes],
+                         'aa_row': aa_row[token_codes], 'valid': valid[token_codes]})
+
+
+# Function to encode variant names as a sparse variants x (residue, amino acid) indicator matrix in CSR form;
+# column position * N_AA + aa_row is the heatmap cell of a mutation. Each distinct name is parsed once.
+# Returns the matrix (one row per name given), which rows parsed, and their mutation counts.
+def variant_matrix(names, sequence):
+    from scipy import sparse
+
+    codes, unique_names = pd.factorize(pd.Series(np.asarray(names, dtype=object)), use_na_sentinel=False)
+    parsed = parse_variants(unique_names, sequence)
+
+    # A variant with any mutation that does not parse is left out entirely; 'wt' has none and parses
+    variant, valid = parsed['variant'].to_numpy(), parsed['valid'].to_numpy()
+    bad = np.bincount(variant[~valid], minlength=len(unique_names)) > 0
+    has_mutation = np.bincount(variant, minlength=len(unique_names)) > 0
+    wild_type = pd.Series(unique_names, dtype=object).astype(str).str.strip().str.lower().isin(WILD_TYPE_NAMES)
+    parsed_ok = ~bad & (has_mutation | wild_type.to_numpy())
+
+    kept = parsed[parsed_ok[variant]]
+    columns = kept['position'].to_numpy() * N_AA + kept['aa_row'].to_numpy()
+    unique_matrix = sparse.csr_matrix((np.ones(len(kept)), (kept['variant'].to_numpy(), columns)),
+                                      shape=(len(unique_names), len(sequence) * N_AA))
+    unique_matrix.data[:] = 1  # the same mutation listed twice still counts once
+    unique_matrix.eliminate_zeros()
+
+    matrix = unique_matrix[codes]
+    return matrix, parsed_ok[codes], np.diff(matrix.indptr)
+
+
+# Function to label every feature column as a mutation ('A12V')
+def feature_labels(sequence):
+    residues = np.repeat(np.array(list(sequence), dtype=object), N_AA)
+    numbers = np.repeat(np.arange(1, len(sequence) + 1), N_AA).astype(str).astype(object)
+    return residues + numbers + np.tile(np.array(amino_acids, dtype=object), len(sequence))
+
+
+# Marginal and additive effects of every mutation of a variant library, with the epistasis left over.
+# Only the per-mutation vectors (one value per residue and amino acid) are ever dense.
+class VariantEffects:
+    def __init__(self, sequence, parsed, counts, marginal, additive, intercept, variants, pairs, positions):
+        self.sequence = sequence
+        self.parsed = parsed
+        self.counts = counts
+        self.marginal = marginal
+        self.additive = additive
+        self.intercept = intercept
+        self.variants = variants
+        self.pairs = pairs
+        self.positions = positions
+
+    # Function to lay a per-mutation vector out as the amino acid x residue heatmap matrix
+    def heatmap(self, kind='marginal'):
+        if kind not in EFFECT_KINDS:
+            raise ValueError(f"Unknown effect '{kind}'; use one of {', '.join(EFFECT_KINDS)}.")
+        values = self.marginal if kind == 'marginal' else self.intercept + self.additive
+        columns = [f"{aa}{i+1}" for i, aa in enumerate(self.sequence)]
+        return pd.DataFrame(values.reshape(len(self.sequence), N_AA).T, index=amino_acids, columns=columns)
+
+    # Function to list every observed mutation with its variant count and both effects
+    def mutation_table(self):
+        observed = np.flatnonzero(self.counts)
+        return pd.DataFrame({'Mutation': feature_labels(self.sequence)[observed],
+                             'Residue': observed // N_AA + 1,
+                             'Variants': self.counts[observed].astype(int),
+                             'Marginal': self.marginal[observed],
+                             'Additive Effect': self.additive[observed]})
+
+
+# Function to fit the effects of a variant library from one value per variant (replicates may repeat a name).
+# Marginal effect: mean value of the variants carrying a mutation (X^T y / X^T 1).
+# Additive effect: damped least squares of value ~ intercept + X beta, solved iteratively on the sparse X.
+# Epistasis: each multi-mutant's residual from that fit, and for every pair of mutations seen together the mean
+# residual of the multi-mutants carrying both (X^T diag(r) X over the multi-mutants only), plus the mean and mean
+# absolute residual of the multi-mutants mutated at each residue.
+@instrumented('variant effects')
+def fit_variant_effects(names, values, sequence, damp=ADDITIVE_DAMP, min_pair_count=MIN_PAIR_COUNT):
+    from scipy import sparse
+    from scipy.sparse.linalg import lsqr
+
+    names = pd.Series(np.asarray(names, dtype=object))
+    values = np.asarray(values, dtype=float)
+    matrix, parsed_ok, n_mutations = variant_matrix(names, sequence)
+    rows = np.flatnonzero(parsed_ok & np.isfinite(values))
+    matrix, values, n_mutations = matrix[rows], values[rows], n_mutations[rows]
+    n_features = matrix.shape[1]
+
+    counts = np.asarray(matrix.sum(axis=0)).ravel()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        marginal = np.where(counts > 0, matrix.T @ values / counts, np.nan)
+
+    # The fit only sees the observed mutations; the intercept is a column of ones in front of them
+    observed = np.flatnonzero(counts)
+    design = sparse.hstack([sparse.csr_matrix(np.ones((len(rows), 1))), matrix[:, observed]], format='csr')
+    additive = np.full(n_features, np.nan)
+    intercept, predicted = np.nan, np.full(len(rows), np.nan)
+    if len(rows):
+        solution = lsqr(design, values, damp=damp)[0]
+        intercept, additive[observed] = solution[0], solution[1:]
+        predicted = design @ solution
+    residual = values - predicted
+
+    variants = pd.DataFrame({'Variant': names.to_numpy()[rows], 'Mutation Count': n_mutations,
+                             '%Gated': values, 'Additive': predicted, 'Epistasis': residual})
+
+    # Pairwise epistasis from the multi-mutants: co-occurrence counts and residual sums in two sparse products
+    multi = np.flatnonzero(n_mutations >= 2)
+    multi_matrix = matrix[multi]
+    weighted = multi_matrix.multiply(residual[multi][:, None]).tocsr()
+    pair_counts = sparse.triu(multi_matrix.T @ multi_matrix, k=1).tocoo()
+    pair_sums = sparse.triu(multi_matrix.T @ weighted, k=1).tocsr()
+    keep = pair_counts.data >= min_pair_count
+    first, second, pair_n = pair_counts.row[keep], pair_counts.col[keep], pair_counts.data[keep]
+    labels = feature_labels(sequence)
+    pairs = pd.DataFrame({'Mutation 1': labels[first], 'Mutation 2': labels[second],
+                          'Residue 1': first // N_AA + 1, 'Residue 2': second // N_AA + 1,
+                          'Variants': pair_n.astype(int),
+                          'Mean Epistasis': np.asarray(pair_sums[first, second]).ravel() / pair_n})
+    pairs = pairs.sort_values('Mean Epistasis', key=np.abs, ascending=False, ignore_index=True)
+
+    # Per residue: the multi-mutant x mutation matrix collapsed onto residues (several amino acids at one residue count once)
+    residue_map = sparse.csr_matrix((np.ones(n_features), (np.arange(n_features), np.arange(n_features) // N_AA)),
+                                    shape=(n_features, len(sequence)))
+    by_residue = (multi_matrix @ residue_map).tocsr()
+    by_residue.data[:] = 1
+    residue_n = np.asarray(by_residue.sum(axis=0)).ravel()
+    seen = np.flatnonzero(residue_n)
+    positions = pd.DataFrame({'Residue': seen + 1, 'Wild Type': np.array(list(sequence), dtype=object)[seen],
+                              'Multi-mutants': residue_n[seen].astype(int),
+                              'Mean Epistasis': (by_residue.T @ residual[multi])[seen] / residue_n[seen],
+                              'Mean |Epistasis|': (by_residue.T @ np.abs(residual[multi]))[seen] / residue_n[seen]})
+
+    return VariantEffects(sequence, parsed_ok, counts, marginal, additive, intercept, variants, pairs, positions)
+
+
+# Function to give every flow sample its mutation list: names that already spell their mutations ('a12v:k45r')
+# are used as they are; the rest are looked up in the mutation table, by its 'Mutations' column or by the
+# single mutation of its 'Mutated Residue' and 'Mutant AA' columns
+def sample_mutations(sample_names, mutation_data, sequence, memo=None):
+    sample_names = pd.Series(np.asarray(sample_names, dtype=object))
+    _, parsed_ok, _ = variant_matrix(sample_names, sequence)
+    mutations = sample_names.where(parsed_ok)
+
+    if mutation_data is not None and 'Name' in mutation_data.columns:
+        table = mutation_data[mutation_data['Name'].notna()].drop_duplicates('Name')
+        if 'Mutations' in table.columns:
+            listed = table['Mutations'].astype(str)
+        else:
+            listed = table['Mutated Residue'].astype(str) + table['Mutant AA'].astype(str)
+        lookup = pd.Series(listed.to_numpy(), index=table['Name'].to_numpy())
+
+        unresolved = mutations.isna() & sample_names.notna()
+        if unresolved.any():
+            resolved = resolve_sample_names(sample_names[unresolved], table['Name'], memo)
+            mutations[unresolved] = resolved.map(lookup).to_numpy()
+    return mutations
+
+
+# Function to build the amino acid x residue heatmap of a multi-mutant library, in the same layout as
+# build_heatmap_data: every variant is counted towards each of its mutations without densifying the variants
+@instrumented('variant heatmap')
+def build_variant_heatmap(flow_data, mutation_data, sequence, kind='marginal', memo=None):
+    sample_names = flow_data['Sample_Name'].reset_index(drop=True)
+    mutations = sample_mutations(sample_names, mutation_data, sequence, memo)
+    effects = fit_variant_effects(mutations.fillna(''), float64_values(flow_data['%Gated']), sequence)
+    unmatched = [(name, None) for name in sample_names[~effects.parsed]]
+    return effects.heatmap(kind), unmatched, effects
+
+
+# Function to fit a library's effects and save them as CSV tables: <name>_mutations (marginal and additive effect
+# of every mutation), <name>_pairs (epistasis of mutation pairs), <name>_positions and <name>_variants
+def write_variant_effects(flow_data, mutation_data, sequence, output_folder='variant_effects', name='variants', memo=None):
+    flow_data = flow_data.assign(Sample_Name=flow_data['Sample_Name'].str.strip().str.lower())
+    if mutation_data is not None:
+        mutation_data = mutation_data.assign(Name=mutation_data['Name'].str.strip().str.lower())
+    _, unmatched, effects = build_variant_heatmap(flow_data, mutation_data, sequence, memo=memo)
+    print(f"{len(effects.variants)} variant row(s), {int((effects.counts > 0).sum())} mutation(s), "
+          f"{len(effects.pairs)} mutation pair(s); {len(unmatched)} sample row(s) without parsable mutations")
+
+    os.makedirs(output_folder, exist_ok=True)
+    tables = {'mutations': effects.mutation_table(), 'pairs': effects.pairs,
+              'positions': effects.positions, 'variants': effects.variants}
+    paths = []
+    for suffix, table in tables.items():
+        path = os.path.join(output_folder, f'{name}_{suffix}.csv')
+        table.to_csv(path, index=False)
+        print(f"Saved {path}")
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit mutation and epistasis effects of a multi-mutant library.')
+    parser.add_argument('results_file', help='Averaged results with Sample_Name (e.g. A12V:K45R) and %%Gated')
+    parser.add_argument('genpept_file')
+    parser.add_argument('--mutation-file', help='Table of Name and Mutations for samples not named by their mutations')
+    parser.add_argument('--output-dir', default='variant_effects')
+    parser.add_argument('--name', default='variants')
+    args = parser.parse_args()
+
+    from Heat_map_v2 import safe_load_file, load_sequence
+    mutation_data = safe_load_file(args.mutation_file) if args.mutation_file else None
+    write_variant_effects(safe_load_file(args.results_file), mutation_data, load_sequence(args.genpept_file),
+                          args.output_dir, args.name)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from Batch_engine import run_batch
+from Benchmark_suite import generate_campaign
+
+STATISTICS = ['Replicates', '%Gated SD', '%Gated CV', '%Gated CI Low', '%Gated CI High', 'Outliers', 'Z vs ND']
+
+
+@pytest.fixture
+def campaign(tmp_path):
+    campaign = generate_campaign(str(tmp_path / 'campaign'), plates=2, wells=96, gates=4, length=60, variants=40)
+    campaign['cache_dir'] = str(tmp_path / 'cache')
+    return campaign
+
+
+def run(campaign, chunksize=None, rebuild=False):
+    return run_batch(campaign['sample_dir'], campaign['platemap_dir'], cache_dir=campaign['cache_dir'],
+                     rebuild=rebuild, chunksize=chunksize)
+
+
+def test_full_run_carries_replicate_statistics(campaign):
+    for result in run(campaign):
+        assert set(STATISTICS) <= set(result.columns)
+
+
+def test_switching_mode_rebuilds_the_plates(campaign, capsys):
+    streamed = run(campaign, chunksize=100, rebuild=True)
+    for result in streamed:
+        assert not set(STATISTICS) & set(result.columns)
+    capsys.readouterr()
+
+    # A plain run after a streamed one must not reuse the means-only results
+    full = run(campaign)
+    assert '0 plate(s) unchanged, 2 to process' in capsys.readouterr().out
+    for result in full:
+        assert set(STATISTICS) <= set(result.columns)
+
+    # Same mode again: everything comes from the cache, with the statistics intact
+    again = run(campaign)
+    assert '2 plate(s) unchanged, 0 to process' in capsys.readouterr().out
+    for result in again:
+        assert set(STATISTICS) <= set(result.columns)
+
+    # Streamed again after full: rebuilt as streamed, and the old results are cleaned up
+    run(campaign, chunksize=100)
+    assert '0 plate(s) unchanged, 2 to process' in capsys.readouterr().out
+    cached = os.listdir(os.path.join(campaign['cache_dir'], 'plates'))
+    assert len(cached) == 2 and all(name.endswith('_streamed.pkl') for name in cached)
+
+
+def test_streamed_and_full_means_agree(campaign):
+    streamed = run(campaign, chunksize=100)
+    full = run(campaign)
+    keys = ['Sample_Name', 'Plate', 'Gate', 'Y Parameter']
+    for s, f in zip(streamed, full):
+        merged = s.astype({key: str for key in keys}).merge(f.astype({key: str for key in keys}), on=keys)
+        assert len(merged) == len(f)
+        assert (abs(merged['%Gated_x'] - merged['%Gated_y']) < 1e-6).all()
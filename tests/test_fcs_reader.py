@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from Fcs_reader import event_dtype, normalize_well, read_fcs, read_fcs_dir, write_fcs
+
+
+# Synthetic events of three channels
+def events(n=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    return {'FSC-A': rng.uniform(0, 1e5, n), 'SSC-A': rng.uniform(0, 1e5, n), 'FL1-A': rng.normal(500, 50, n)}
+
+
+def test_round_trip_channels_and_values(tmp_path):
+    path = str(tmp_path / 'plate_A01.fcs')
+    written = events()
+    write_fcs(path, written, text={'$P3S': 'methanogen'})
+
+    fcs = read_fcs(path)
+    assert fcs.version == 'FCS3.1'
+    assert fcs.channels == ['FSC-A', 'SSC-A', 'FL1-A']
+    assert fcs.labels == ['', '', 'methanogen']
+    assert len(fcs) == 1000
+    for name, values in written.items():
+        assert fcs.channel(name).dtype == np.dtype('<f4')
+        assert np.array_equal(fcs.channel(name), values.astype(np.float32))
+
+
+def test_to_frame_carries_the_well(tmp_path):
+    path = str(tmp_path / 'run_B07.fcs')
+    write_fcs(path, events(10))
+    frame = read_fcs(path).to_frame(['FL1-A'])
+    assert list(frame.columns) == ['Sample', 'FL1-A']
+    assert (frame['Sample'] == 'B7').all()
+
+
+def test_data_offsets_read_from_text(tmp_path):
+    # Files past 99,999,999 bytes leave the header offsets at 0 and give them only as $BEGINDATA/$ENDDATA
+    path = tmp_path / 'large.fcs'
+    write_fcs(str(path), events(100), text={'$WELLID': 'C3'})
+    raw = bytearray(path.read_bytes())
+    raw[26:42] = b'       0       0'
+    path.write_bytes(bytes(raw))
+
+    fcs = read_fcs(str(path))
+    assert len(fcs) == 100
+    assert np.array_equal(fcs.channel('FSC-A'), events(100)['FSC-A'].astype(np.float32))
+
+
+def test_duplicate_channel_names_are_numbered(tmp_path):
+    path = str(tmp_path / 'dup.fcs')
+    write_fcs(path, events(5), text={'$P2N': 'FSC-A'})
+    assert read_fcs(path).channels == ['FSC-A', 'FSC-A_2', 'FL1-A']
+
+
+def test_integer_dtype():
+    text = {'$DATATYPE': 'I', '$BYTEORD': '4,3,2,1', '$P1B': '16', '$P2B': '32'}
+    assert event_dtype(text, ['a', 'b']) == np.dtype([('a', '>u2'), ('b', '>u4')])
+    with pytest.raises(ValueError):
+        event_dtype({'$DATATYPE': 'I', '$P1B': '10'}, ['a'])
+
+
+@pytest.mark.parametrize('value, well', [('A1', 'A1'), ('A01', 'A1'), ('h12', 'H12'), ('plate3_AF048', 'AF48'),
+                                         ('Well B09', 'B9'), ('no well', None)])
+def test_normalize_well(value, well):
+    assert normalize_well(value) == well
+
+
+def test_well_keyword_wins_over_file_name(tmp_path):
+    path = str(tmp_path / 'sample_A01.fcs')
+    write_fcs(path, events(5), text={'$WELLID': 'D04'})
+    assert read_fcs(path).well == 'D4'
+
+
+def test_read_fcs_dir_keys_by_well(tmp_path):
+    for well in ['A01', 'A02', 'B01']:
+        write_fcs(str(tmp_path / f'plate_{well}.fcs'), events(5))
+    (tmp_path / 'notes.txt').write_text('not an FCS file')
+    assert sorted(read_fcs_dir(str(tmp_path))) == ['A1', 'A2', 'B1']
+
+
+def test_read_fcs_dir_rejects_duplicate_wells(tmp_path):
+    write_fcs(str(tmp_path / 'plate_A01.fcs'), events(5))
+    write_fcs(str(tmp_path / 'plate_A01_reacquired.fcs'), events(5), text={'$WELLID': 'A1'})
+    with pytest.raises(ValueError, match='both well A1'):
+        read_fcs_dir(str(tmp_path))
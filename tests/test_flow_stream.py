@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from Batch_engine import process_plate
+from Benchmark_suite import generate_campaign
+from Flow_stream import RunningMean, stream_filtered_rows
+
+LABELS = ['Sample_Name', 'Plate', 'Gate', 'Y Parameter']
+
+
+@pytest.fixture
+def plate(tmp_path):
+    campaign = generate_campaign(str(tmp_path), plates=1, wells=96, gates=4, length=60, variants=40)
+    return campaign['pairs'][0]
+
+
+def test_streamed_means_use_the_compact_schema(plate):
+    streamed = process_plate(*plate, chunksize=100)
+    full = process_plate(*plate)
+    for column in LABELS:
+        assert isinstance(streamed[column].dtype, pd.CategoricalDtype)
+        assert set(streamed[column].astype(str)) == set(full[column].astype(str))
+    assert streamed['%Gated'].dtype == full['%Gated'].dtype == np.float64
+
+
+def test_chunks_keep_one_schema(plate):
+    chunks = list(stream_filtered_rows(*plate, chunksize=50))
+    assert len(chunks) > 1
+    assert len({tuple(map(str, chunk.dtypes)) for chunk in chunks}) == 1
+
+
+def test_running_mean_merges_like_one_groupby():
+    df = pd.DataFrame({'Sample_Name': list('aabbc'), '%Gated': [1.0, 3.0, 2.0, 6.0, 5.0]})
+    first, second = RunningMean(['Sample_Name']), RunningMean(['Sample_Name'])
+    first.update(df.iloc[:3])
+    second.update(df.iloc[3:])
+    first.merge(RunningMean.from_records(['Sample_Name'], second.to_records()))
+    result = first.result().set_index('Sample_Name')['%Gated']
+    assert result.to_dict() == {'a': 2.0, 'b': 4.0, 'c': 5.0}
@@ -0,0 +1,123 @@
+import os
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from Batch_engine import process_plate
+from Benchmark_suite import generate_campaign
+from Flow_watch import PlateWatcher, StabilityTracker, snapshot
+from Results_store import list_runs, query_results
+
+
+@pytest.fixture
+def campaign(tmp_path, monkeypatch):
+    # The batch cache and the results store default to paths relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return generate_campaign(str(tmp_path / 'campaign'), plates=2, wells=96, gates=4, length=60, variants=40)
+
+
+def watcher(campaign, store=True):
+    return PlateWatcher(campaign['sample_dir'], campaign['platemap_dir'], 'out', plots_dir=None, store=store)
+
+
+# Function to hand a plate to `collect` as if the pool had just finished it
+def finish(plate_watcher, sample_path, platemap_path):
+    future = Future()
+    future.set_result(process_plate(sample_path, platemap_path))
+    sample_file = os.path.basename(sample_path)
+    plate_watcher.in_flight[future] = ('process', sample_file, sample_path, platemap_path, (), time.monotonic())
+    plate_watcher.collect([future])
+
+
+def test_catch_up_stores_the_campaign(campaign):
+    watcher(campaign).catch_up()
+    runs = list_runs()
+    assert len(runs) == 1 and runs['kind'].iloc[0] == 'averaged'
+    assert query_results()['Plate'].nunique() == 2
+
+
+def test_each_new_plate_is_stored(campaign):
+    plate_watcher = watcher(campaign)
+    for sample_path, platemap_path in campaign['pairs']:
+        finish(plate_watcher, sample_path, platemap_path)
+    assert len(list_runs()) == 2
+    assert os.path.exists(plate_watcher.output_path)
+
+
+def test_no_store(campaign):
+    plate_watcher = watcher(campaign, store=False)
+    plate_watcher.catch_up()
+    finish(plate_watcher, *campaign['pairs'][0])
+    assert not os.path.exists('flow_results.sqlite')
+
+
+def test_snapshot_lists_csv_files(tmp_path):
+    (tmp_path / 'plate1.csv').write_text('a,b\n1,2\n')
+    (tmp_path / 'notes.txt').write_text('not a plate')
+    (tmp_path / 'sub.csv').mkdir()
+    files = snapshot(str(tmp_path))
+    assert list(files) == [str(tmp_path / 'plate1.csv')]
+    assert files[str(tmp_path / 'plate1.csv')][0] == 8
+
+
+def test_growing_file_is_not_stable():
+    tracker = StabilityTracker(settle_seconds=2)
+    for second in range(10):
+        # The cytometer is still writing: the size changes every second
+        assert tracker.update({'p.csv': (100 * (second + 1), second)}, now=second) == {}
+    assert tracker.update({'p.csv': (1000, 9)}, now=10.9) == {}
+    assert tracker.update({'p.csv': (1000, 9)}, now=11) == {'p.csv': (1000, 9)}
+
+
+def test_file_stable_for_settle_seconds():
+    tracker = StabilityTracker(settle_seconds=2)
+    assert tracker.update({'p.csv': (500, 1)}, now=0) == {}
+    assert tracker.update({'p.csv': (500, 1)}, now=1.9) == {}
+    assert tracker.update({'p.csv': (500, 1)}, now=2) == {'p.csv': (500, 1)}
+    # An empty file is never reported, however long it stays unchanged
+    assert tracker.update({'p.csv': (500, 1), 'empty.csv': (0, 1)}, now=100) == {'p.csv': (500, 1)}
+
+
+def test_removed_file_is_forgotten():
+    tracker = StabilityTracker(settle_seconds=2)
+    tracker.update({'p.csv': (500, 1)}, now=0)
+    assert tracker.update({}, now=1) == {}
+    assert 'p.csv' not in tracker.seen
+    # Copied back in: the wait starts again
+    assert tracker.update({'p.csv': (500, 1)}, now=2.5) == {}
+    assert tracker.update({'p.csv': (500, 1)}, now=4.5) == {'p.csv': (500, 1)}
+
+
+# Function to build a fake `list_files` from {folder: {file name: (size, mtime)}}
+def folders(contents):
+    return lambda directory: {os.path.join(directory, name): signature
+                              for name, signature in contents.get(directory, {}).items()}
+
+
+def test_sample_without_plate_map_waits():
+    plate_watcher = PlateWatcher('samples', 'maps', 'out', plots_dir=None, settle_seconds=2, store=False)
+    contents = {'samples': {'plate1.csv': (500, 1)}}
+    plate_watcher.scan(now=0, list_files=folders(contents))
+    plate_watcher.scan(now=10, list_files=folders(contents))
+    assert not plate_watcher.queued
+
+    # The plate map arrives: the plate is queued once the map has settled too
+    contents['maps'] = {'plate1_plate_map.csv': (200, 11)}
+    plate_watcher.scan(now=11, list_files=folders(contents))
+    assert not plate_watcher.queued
+    plate_watcher.scan(now=13, list_files=folders(contents))
+    assert [job[1] for job in plate_watcher.queued] == ['plate1.csv']
+
+    # Already queued: a later scan does not queue it again
+    plate_watcher.scan(now=20, list_files=folders(contents))
+    assert len(plate_watcher.queued) == 1
+
+
+def test_sample_removed_during_wait_is_not_queued():
+    plate_watcher = PlateWatcher('samples', 'maps', 'out', plots_dir=None, settle_seconds=2, store=False)
+    contents = {'samples': {'plate1.csv': (500, 1)}, 'maps': {'plate1_plate_map.csv': (200, 1)}}
+    plate_watcher.scan(now=0, list_files=folders(contents))
+    del contents['samples']['plate1.csv']
+    plate_watcher.scan(now=5, list_files=folders(contents))
+    assert not plate_watcher.queued
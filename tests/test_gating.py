@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import Flow_cli
+from Fcs_reader import write_fcs
+from Gating import gate_plate, gate_summary, order_gates, points_in_polygon, write_gate_summary
+
+# A concave polygon with a horizontal edge, a vertical edge and a notch
+POLYGON = [(0, 0), (6, 0), (6, 4), (4, 4), (3, 2), (2, 4), (0, 4)]
+
+
+# Function to test one point by walking every edge in plain Python (even-odd rule, edges crossing the ray
+# counted half-open in y so a vertex on the ray is counted once)
+def brute_force_inside(px, py, vertices):
+    inside = False
+    for (xi, yi), (xj, yj) in zip(vertices, vertices[-1:] + vertices[:-1]):
+        if (yi > py) != (yj > py) and px < (xj - xi) * (py - yi) / (yj - yi) + xi:
+            inside = not inside
+    return inside
+
+
+def test_points_in_polygon_matches_brute_force():
+    rng = np.random.default_rng(0)
+    # Points on a half-unit grid land on every edge and vertex; random points fill the rest
+    grid_x, grid_y = np.meshgrid(np.arange(-1, 7.5, 0.5), np.arange(-1, 5.5, 0.5))
+    x = np.concatenate([grid_x.ravel(), rng.uniform(-1, 7, 2000)])
+    y = np.concatenate([grid_y.ravel(), rng.uniform(-1, 5, 2000)])
+    expected = [brute_force_inside(px, py, POLYGON) for px, py in zip(x, y)]
+    assert points_in_polygon(x, y, POLYGON).tolist() == expected
+
+
+def test_points_on_the_boundary():
+    square = [(0, 0), (2, 0), (2, 2), (0, 2)]
+    x = np.array([1.0, 0.0, 1.0, 2.0, 1.0, 0.0, 2.0, 2.0, 0.0])
+    y = np.array([1.0, 1.0, 0.0, 1.0, 2.0, 0.0, 0.0, 2.0, 2.0])
+    # Left and bottom edges (and the corner they share) are inside, right and top edges are outside,
+    # so two squares sharing an edge never both claim a point on it
+    assert points_in_polygon(x, y, square).tolist() == [True, True, True, False, False, True, False, False, False]
+
+
+@pytest.fixture
+def well(tmp_path):
+    rng = np.random.default_rng(1)
+    fsc = np.concatenate([rng.uniform(0, 100, 600), rng.uniform(200, 300, 400)])
+    fl1 = np.concatenate([rng.uniform(0, 10, 300), rng.uniform(50, 60, 700)])
+    path = str(tmp_path / 'plate_A01.fcs')
+    write_fcs(path, {'FSC-A': fsc, 'SSC-A': fsc, 'FL1-A': fl1}, text={'$P3S': 'methanogen'})
+    return path, fsc, fl1
+
+
+def test_child_gate_is_relative_to_its_parent(well):
+    path, fsc, fl1 = well
+    gates = order_gates([
+        {'name': 'R9', 'type': 'threshold', 'channel': 'FL1-A', 'min': 40, 'parent': 'R6'},
+        {'name': 'R6', 'type': 'rectangle', 'x': 'FSC-A', 'y': 'SSC-A', 'x_range': [150, 350],
+         'y_range': [150, 350]},
+    ])
+    assert [gate['name'] for gate in gates] == ['R6', 'R9']
+
+    summary = gate_summary(path, gates).set_index('Gate')
+    in_parent = (fsc >= 150) & (fsc <= 350)
+    in_child = in_parent & (fl1 >= 40)
+    assert summary.loc['R6', '%Gated'] == pytest.approx(100.0 * in_parent.sum() / len(fsc))
+    assert summary.loc['R9', '%Gated'] == pytest.approx(100.0 * in_child.sum() / in_parent.sum())
+    assert summary.loc['R9', 'Count'] == in_child.sum()
+    assert summary.loc['R9', 'Y Parameter'] == 'FL1-A methanogen'
+    assert (summary['Sample'] == 'A1').all()
+
+
+def test_gate_plate_names_the_plate(well, tmp_path):
+    path, _, _ = well
+    write_fcs(str(tmp_path / 'plate_B02.fcs'), {'FSC-A': np.arange(10.0), 'SSC-A': np.arange(10.0),
+                                                'FL1-A': np.arange(10.0)})
+    gates = order_gates([{'name': 'R1', 'type': 'threshold', 'channel': 'FL1-A', 'min': 5}])
+    summary = gate_plate(str(tmp_path), gates, plate='plate7')
+    assert sorted(summary['Sample']) == ['A1', 'B2']
+    assert (summary['Plate'] == 'plate7').all()
+    assert summary.set_index('Sample').loc['B2', '%Gated'] == 50.0
+
+
+@pytest.mark.parametrize('gates, message', [
+    ([{'name': 'a', 'type': 'threshold', 'parent': 'b'}, {'name': 'b', 'type': 'threshold', 'parent': 'a'}],
+     'its own ancestor'),
+    ([{'name': 'a', 'type': 'threshold', 'parent': 'missing'}], 'Unknown parent gate missing'),
+    ([{'name': 'a', 'type': 'threshold'}, {'name': 'a', 'type': 'threshold'}], 'defined twice'),
+    ([{'name': 'a', 'type': 'ellipse'}], 'type must be one of'),
+])
+def test_invalid_gate_configurations(gates, message):
+    with pytest.raises(ValueError, match=message):
+        order_gates(gates)
+
+
+@pytest.fixture
+def plate_folder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    folder = tmp_path / 'plate7'
+    folder.mkdir()
+    write_fcs(str(folder / 'plate7_A01.fcs'), {'FSC-A': np.arange(10.0), 'SSC-A': np.arange(10.0),
+                                               'FL1-A': np.arange(10.0)})
+    (tmp_path / 'gates.json').write_text('[{"name": "R1", "type": "threshold", "channel": "FL1-A", "min": 5}]')
+    return str(folder)
+
+
+def test_write_gate_summary_defaults(plate_folder):
+    assert write_gate_summary(plate_folder, 'gates.json') == os.path.join('Flow_Files', 'plate7.csv')
+    summary = pd.read_csv(os.path.join('Flow_Files', 'plate7.csv'))
+    assert summary[['Plate', 'Sample', 'Gate', '%Gated']].values.tolist() == [['plate7', 'A1', 'R1', 50.0]]
+
+
+def test_cli_gate_uses_the_same_defaults(plate_folder):
+    Flow_cli.main(['gate', plate_folder, 'gates.json', '--plate', 'p1'])
+    assert pd.read_csv(os.path.join('Flow_Files', 'p1.csv'))['Plate'].tolist() == ['p1']
+    Flow_cli.main(['gate', plate_folder, 'gates.json', '-o', 'out/summary.csv'])
+    assert pd.read_csv(os.path.join('out', 'summary.csv'))['Plate'].tolist() == ['plate7']
@@ -0,0 +1,10 @@
+import pytest
+
+from Benchmark_suite import IMPORT_BUDGETS, eager_imports
+
+
+# Import times depend on the machine and its load, so they are only reported by `benchmark --imports`;
+# what each entry module loads at import does not
+@pytest.mark.parametrize('module', sorted(IMPORT_BUDGETS))
+def test_no_heavy_library_loaded_at_import(module):
+    assert eager_imports(module) == []
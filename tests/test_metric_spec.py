@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from Flow_PI import compute_viability
+from Metric_spec import DEFAULT_SPEC, FILTER_SPEC, MetricSpec
+
+
+# Two wells of one sample with R6 on the methanogen channel and R9 (the PI gate) on another one
+def gate_rows(r9_channel='PI'):
+    return pd.DataFrame({
+        'Plate': ['p1'] * 4,
+        'Sample': ['A1', 'A1', 'A2', 'A2'],
+        'Sample_Name': ['s1'] * 4,
+        'Gate': ['R6', 'R9', 'R6', 'R9'],
+        'Y Parameter': ['methanogen', r9_channel, 'methanogen', r9_channel],
+        '%Gated': [80.0, 10.0, 60.0, 50.0],
+    })
+
+
+def test_viability_pairs_gates_per_well():
+    viability = compute_viability(gate_rows('methanogen')).set_index('Sample')
+    assert viability.loc['A1', '% Viable Cells'] == pytest.approx(72.0)
+    assert viability.loc['A2', '% Viable Cells'] == pytest.approx(30.0)
+
+
+def test_default_spec_reads_r9_on_any_channel():
+    viability = compute_viability(gate_rows('PI'))
+    assert len(viability) == 2
+    assert np.allclose(sorted(viability['% Viable Cells']), [30.0, 72.0])
+
+
+def test_filter_spec_keeps_methanogen_r6_only():
+    rows = FILTER_SPEC.select_rows(gate_rows('PI'))
+    assert set(rows['Gate']) == {'R6'}
+    assert len(rows) == 2
+
+
+def test_metric_expressions_are_restricted():
+    with pytest.raises(ValueError):
+        MetricSpec.from_dict({'gates': ['R6'], 'metrics': {'bad': '__import__("os")'}})
+    with pytest.raises(ValueError):
+        MetricSpec.from_dict({'gates': ['R6'], 'metrics': {'bad': 'R7 + 1'}})
+    assert MetricSpec.from_dict(DEFAULT_SPEC).gates[1]['y_parameter'] is None
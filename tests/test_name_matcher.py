@@ -0,0 +1,74 @@
+import random
+from difflib import get_close_matches
+
+import pytest
+
+from Name_matcher import MatchMemo, NameMatcher
+
+
+# Function to draw a short name from a small alphabet, so equal scores and scores near the cutoff are common
+def random_name(rng, alphabet='abc_1'):
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 8)))
+
+
+@pytest.mark.parametrize('cutoff', [0.6, 0.75])
+def test_matches_get_close_matches(cutoff):
+    rng = random.Random(0)
+    for _ in range(200):
+        candidates = [random_name(rng) for _ in range(rng.randint(1, 30))]
+        matcher = NameMatcher(candidates, cutoff=cutoff)
+        for _ in range(10):
+            name = random_name(rng)
+            expected = get_close_matches(name, candidates, n=1, cutoff=cutoff)
+            assert matcher.match(name) == (expected[0] if expected else None), (name, candidates)
+
+
+def test_ties_and_cutoff():
+    # 'xab' and 'xba' both score 0.8 against 'xa': the larger name wins the tie, as in get_close_matches
+    matcher = NameMatcher(['xab', 'xba', 'zzzz'])
+    assert matcher.match('xa') == get_close_matches('xa', ['xab', 'xba', 'zzzz'], n=1)[0] == 'xba'
+    # ratio('abcde', 'abcxx') is exactly 0.6: kept at the cutoff, dropped just above it
+    assert NameMatcher(['abcxx']).match('abcde') == 'abcxx'
+    assert NameMatcher(['abcxx'], cutoff=0.61).match('abcde') is None
+    assert NameMatcher([]).match('abc') is None
+    assert NameMatcher(['abc', None, 3.0]).match(None) is None
+
+
+@pytest.fixture
+def names_file(tmp_path, monkeypatch):
+    # The memo lives under the cache folder, relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / 'mutations.csv'
+    path.write_text('Name\ngb2004_1\ngb2004_2\n')
+    return str(path)
+
+
+def test_memo_round_trip(names_file):
+    memo = MatchMemo(names_file)
+    assert memo == {} and not memo.changed
+    matches = NameMatcher(['gb2004_1', 'gb2004_2']).match_many(['gb2004-1', 'unrelated'], memo)
+    assert matches == {'gb2004-1': 'gb2004_1', 'unrelated': None}
+    assert memo.changed
+    memo.save()
+    assert not memo.changed
+
+    reloaded = MatchMemo(names_file)
+    assert reloaded == {'gb2004-1': 'gb2004_1', 'unrelated': None}
+
+    # Names found in the memo are not matched again
+    class NoMatching(NameMatcher):
+        def match(self, name):
+            raise AssertionError(name)
+    assert NoMatching(['gb2004_1']).match_many(['gb2004-1'], reloaded) == {'gb2004-1': 'gb2004_1'}
+    assert not reloaded.changed
+
+
+def test_memo_invalidated_by_new_names_or_cutoff(names_file):
+    memo = MatchMemo(names_file)
+    memo['gb2004-1'] = 'gb2004_1'
+    memo.save()
+
+    assert MatchMemo(names_file, cutoff=0.8) == {}
+    with open(names_file, 'a') as f:
+        f.write('gb2004_3\n')
+    assert MatchMemo(names_file) == {}
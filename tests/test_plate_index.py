@@ -0,0 +1,64 @@
+import string
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Plate_index import MAX_PLATE_COLUMNS, PlateIndex, well_index, well_name
+
+ROW_LETTERS = list(string.ascii_uppercase) + ['AA', 'AB', 'AC', 'AD', 'AE', 'AF']
+
+
+# Function to write a plate-map layout of n_rows x n_columns, each cell named after its well
+def layout(n_rows, n_columns):
+    rows = ROW_LETTERS[:n_rows]
+    cells = {str(column): [f's_{row}{column}' for row in rows] for column in range(1, n_columns + 1)}
+    return pd.DataFrame({'Row': rows, **cells})
+
+
+@pytest.mark.parametrize('wells, n_rows, n_columns', [(96, 8, 12), (384, 16, 24), (1536, 32, 48)])
+def test_layouts(wells, n_rows, n_columns):
+    index = PlateIndex.from_layout(layout(n_rows, n_columns))
+    assert index.layout == wells
+
+    frame = index.to_frame()
+    assert len(frame) == wells
+    assert frame['Well'].iloc[-1] == f'{ROW_LETTERS[n_rows - 1]}{n_columns}'
+    assert (frame['Sample_Name'].astype(str) == 's_' + frame['Well']).all()
+    assert (well_index(frame['Well']) == frame['Well_Index']).all()
+
+
+def test_double_letter_rows():
+    assert well_index(['Z1', 'AA1', 'AF48', 'af48']).tolist() == [25 * MAX_PLATE_COLUMNS, 26 * MAX_PLATE_COLUMNS,
+                                                                  32 * MAX_PLATE_COLUMNS - 1, 32 * MAX_PLATE_COLUMNS - 1]
+    assert [well_name(i) for i in well_index(['AA1', 'AF48'])] == ['AA1', 'AF48']
+    index = PlateIndex.from_layout(layout(32, 48))
+    assert list(index.lookup(['AA1', 'AF48', 'P24'])) == ['s_AA1', 's_AF48', 's_P24']
+
+
+@pytest.mark.parametrize('well', ['AG1', 'BA1', 'ZZ1', 'A0', 'A49', 'AAA1', '1A', 'A', '', None, np.nan])
+def test_rejects_wells_outside_the_grid(well):
+    assert well_index([well]).tolist() == [-1]
+
+
+def test_zero_padded_wells():
+    h9 = 7 * MAX_PLATE_COLUMNS + 8
+    assert well_index(['A01', 'A1', 'a001', ' H09 ', 'H9']).tolist() == [0, 0, 0, h9, h9]
+    index = PlateIndex.from_layout(layout(8, 12))
+    assert list(index.lookup(['A01', 'A1', 'H012'])) == ['s_A1', 's_A1', 's_H12']
+
+
+def test_numeric_cells_are_named_without_decimals():
+    # An empty cell makes pandas read the column as float, so sample 12 arrives as 12.0
+    platemap_df = pd.DataFrame({'Row': ['A', 'B'], '1': [12.0, np.nan], '2': ['gb2004.1', 'ND'], '3': [7, 8]})
+    index = PlateIndex.from_layout(platemap_df)
+    # Text cells keep their dots; only the numeric ones are cut
+    assert list(index.lookup(['A1', 'A2', 'A3', 'B3'])) == ['12', 'gb2004.1', '7', '8']
+    assert pd.isna(index.lookup(['B1'])[0])
+
+
+def test_rows_past_af_are_left_out():
+    platemap_df = pd.DataFrame({'Row': ['A', 'AG', 'BA'], '1': ['kept', 'dropped', 'dropped']})
+    index = PlateIndex.from_layout(platemap_df)
+    assert list(index.names.categories) == ['kept']
+    assert index.layout == 96
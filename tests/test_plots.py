@@ -0,0 +1,32 @@
+import os
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import numpy as np
+import pandas as pd
+
+from Flow_PI import compute_viability, plot_viability
+from Plot_filtered import process_data, plot_data
+
+
+# Gate-summary rows of four wells, the last one left empty in the plate map (no Sample_Name)
+def gate_rows():
+    wells = ['A1', 'A2', 'A3', 'A4']
+    names = ['s1', 's1', 'ND', np.nan]
+    rows = [{'Plate': 'p1', 'Sample': well, 'Sample_Name': name, 'Gate': gate, 'Y Parameter': 'methanogen',
+             '%Gated': value}
+            for well, name in zip(wells, names) for gate, value in [('R6', 80.0), ('R9', 3.0)]]
+    return pd.DataFrame(rows)
+
+
+def test_plot_viability_with_unmapped_well(tmp_path):
+    viability = compute_viability(gate_rows())
+    path = plot_viability(viability, 'plate.csv', save_dir=str(tmp_path), show=False)
+    assert os.path.exists(path)
+
+
+def test_plot_filtered_with_unmapped_well(tmp_path):
+    filtered_data, mean_gated_values = process_data(gate_rows())
+    assert sorted(mean_gated_values['Sample_Name']) == ['ND', 's1']
+    path = plot_data(filtered_data, mean_gated_values, 'plate.csv', save_path=str(tmp_path), show=False)
+    assert os.path.exists(path)
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+from Batch_engine import average_data
+from Replicate_stats import replicate_stats
+
+
+# Filtered rows of one plate: two replicates of a sample, the controls, and one well left empty in the plate map
+def filtered_rows():
+    return pd.DataFrame({
+        'Plate': ['p1'] * 7,
+        'Sample_Name': ['s1', 's1', 'ND', 'ND', 'gb2004', 'gb2004', np.nan],
+        'Gate': ['R6'] * 7,
+        'Y Parameter': ['methanogen'] * 7,
+        '%Gated': [10.0, 12.0, 50.0, 54.0, 2.0, 4.0, 99.0],
+    })
+
+
+def test_replicate_stats_means_and_counts():
+    stats = replicate_stats(filtered_rows().dropna(), keys=['Sample_Name'])
+    row = stats.set_index('Sample_Name').loc['s1']
+    assert row['%Gated'] == 11.0
+    assert row['Replicates'] == 2
+    assert np.isclose(row['%Gated SD'], np.sqrt(2))
+
+
+def test_unmapped_well_is_dropped():
+    stats = replicate_stats(filtered_rows(), keys=['Sample_Name', 'Plate'])
+    assert sorted(stats['Sample_Name']) == ['ND', 'gb2004', 's1']
+    assert stats['Replicates'].sum() == 6
+
+
+def test_average_data_with_unmapped_well():
+    averaged = average_data(filtered_rows())
+    assert averaged['Sample_Name'].notna().all()
+    assert len(averaged) == 3
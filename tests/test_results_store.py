@@ -0,0 +1,83 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Results_store import append_results, list_runs, query_results
+
+
+# An averaged table of one plate (means with integer replicate and outlier counts)
+def averaged(plate, value, samples=('gb2004_1', 'gb2004_2', 'ND')):
+    return pd.DataFrame({
+        'Sample_Name': list(samples),
+        'Plate': plate,
+        'Gate': 'R6',
+        'Y Parameter': 'methanogen',
+        '%Gated': [value + i for i in range(len(samples))],
+        'Replicates': np.array([3] * len(samples), dtype=np.int64),
+        'Outliers': np.array([0] * len(samples), dtype=np.int64),
+    })
+
+
+@pytest.fixture
+def store(tmp_path):
+    db_path = str(tmp_path / 'results.sqlite')
+    append_results(averaged('p1', 10.0), 'averaged', run_date=datetime.datetime(2025, 1, 1, 9), db_path=db_path)
+    append_results(averaged('p2', 20.0), 'averaged', run_date=datetime.datetime(2025, 1, 2, 9), db_path=db_path)
+    # p1 measured again: only this run is returned by default
+    append_results(averaged('p1', 30.0), 'averaged', run_date=datetime.datetime(2025, 1, 3, 9), db_path=db_path)
+    return db_path
+
+
+def test_append_creates_runs(store):
+    runs = list_runs(store)
+    assert list(runs['run_id']) == [3, 2, 1]
+    assert (runs['rows'] == 3).all()
+
+
+def test_latest_run_per_plate(store):
+    df = query_results(db_path=store)
+    assert len(df) == 6
+    assert sorted(df.loc[df['Plate'] == 'p1', '%Gated']) == [30.0, 31.0, 32.0]
+    assert len(query_results(all_runs=True, db_path=store)) == 9
+    assert sorted(query_results(run_id=1, db_path=store)['%Gated']) == [10.0, 11.0, 12.0]
+
+
+def test_integer_columns_round_trip(store):
+    df = query_results(db_path=store)
+    assert pd.api.types.is_integer_dtype(df['Replicates'])
+    assert pd.api.types.is_integer_dtype(df['Outliers'])
+    assert (df['Replicates'] == 3).all()
+
+
+def test_wildcard_and_list_filters(store):
+    assert set(query_results(sample='gb2004*', db_path=store)['Sample_Name']) == {'gb2004_1', 'gb2004_2'}
+    assert set(query_results(sample='gb2004_?', plate='p2', db_path=store)['Sample_Name']) == {'gb2004_1', 'gb2004_2'}
+    assert len(query_results(sample=['ND', 'gb2004_1'], db_path=store)) == 4
+    assert set(query_results(plate=['p1', 'p2'], gate='R6', db_path=store)['Plate']) == {'p1', 'p2'}
+    assert query_results(gate='R9', db_path=store).empty
+
+
+def test_since_and_until(store):
+    assert set(query_results(since='2025-01-02', all_runs=True, db_path=store)['%Gated']) == {20.0, 21.0, 22.0,
+                                                                                              30.0, 31.0, 32.0}
+    # A bare date includes the whole day
+    until = query_results(until='2025-01-02', all_runs=True, with_run=True, db_path=store)
+    assert sorted(until['run_id'].unique()) == [1, 2]
+    between = query_results(since='2025-01-02', until='2025-01-02', all_runs=True, db_path=store)
+    assert set(between['Plate']) == {'p2'}
+
+
+def test_kinds_are_not_mixed(store):
+    filtered = averaged('p1', 40.0)[['Sample_Name', 'Plate', 'Gate', 'Y Parameter', '%Gated']]
+    append_results(filtered, 'filtered', run_date=datetime.datetime(2025, 1, 4, 9), db_path=store)
+
+    # Without a kind only the averaged tables come back, each sample once
+    default = query_results(sample='ND', db_path=store)
+    assert len(default) == 2
+    assert default['Replicates'].notna().all()
+    assert list(query_results(sample='ND', kind='filtered', db_path=store)['%Gated']) == [42.0]
+
+    # A run_id selects that run whatever its kind
+    assert len(query_results(run_id=4, db_path=store)) == 3
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from Heatmap_matrix import amino_acids
+from Variant_effects import N_AA, fit_variant_effects, parse_variants, variant_matrix
+
+# Residue 12 is A and residue 45 is K
+SEQUENCE = 'M' * 11 + 'A' + 'G' * 32 + 'K' + 'S' * 15
+
+
+def column(position, aa):
+    return (position - 1) * N_AA + amino_acids.index(aa)
+
+
+def test_parse_variants():
+    parsed = parse_variants(['A12V:K45R', 'wt', '12v + 45r', 'A12V:A12V'], SEQUENCE)
+    # 'wt' has no mutations, so it has no rows
+    assert parsed['variant'].tolist() == [0, 0, 2, 2, 3, 3]
+    assert parsed['position'].tolist() == [11, 44, 11, 44, 11, 11]
+    assert parsed['aa_row'].tolist() == [amino_acids.index(aa) for aa in 'VRVRVV']
+    assert parsed['valid'].all()
+
+
+def test_variant_matrix_rows():
+    matrix, parsed_ok, n_mutations = variant_matrix(['A12V:K45R', 'WT', 'A12V:A12V', 'A12V:K45R'], SEQUENCE)
+    assert parsed_ok.tolist() == [True, True, True, True]
+    # A mutation listed twice counts once; the wild type is an empty row
+    assert n_mutations.tolist() == [2, 0, 1, 2]
+    assert matrix[0].indices.tolist() == sorted([column(12, 'V'), column(45, 'R')])
+    assert matrix[2].indices.tolist() == [column(12, 'V')]
+
+
+@pytest.mark.parametrize('name', ['G12V', 'A12V:G45R', 'A99V', 'A12Z', 'not a variant', ''])
+def test_unparsable_variants_are_left_out(name):
+    _, parsed_ok, _ = variant_matrix([name, 'A12V'], SEQUENCE)
+    assert parsed_ok.tolist() == [False, True]
+
+
+def test_additive_library_is_recovered():
+    rng = np.random.default_rng(0)
+    sites = [(position, aa) for position in (3, 12, 20, 45, 50) for aa in 'DLRV']
+    true_effect = dict(zip(sites, rng.normal(0, 10, len(sites))))
+    intercept = 40.0
+
+    # Up to three mutations per variant, at distinct residues
+    names, values = ['wt'], [intercept]
+    for _ in range(400):
+        chosen = rng.choice(len(sites), size=rng.integers(1, 4), replace=False)
+        mutations = {sites[i][0]: sites[i] for i in chosen}.values()
+        names.append(':'.join(f'{SEQUENCE[p - 1]}{p}{aa}' for p, aa in mutations))
+        values.append(intercept + sum(true_effect[m] for m in mutations))
+
+    # Undamped, so the fit is exact up to the solver tolerance
+    effects = fit_variant_effects(names, values, SEQUENCE, damp=0.0)
+    assert effects.intercept == pytest.approx(intercept, abs=1e-3)
+    for (position, aa), effect in true_effect.items():
+        assert effects.additive[column(position, aa)] == pytest.approx(effect, abs=1e-3)
+    assert np.abs(effects.variants['Epistasis']).max() < 1e-3
+    assert np.abs(effects.pairs['Mean Epistasis']).max() < 1e-3
+    assert np.abs(effects.positions['Mean Epistasis']).max() < 1e-3
+    assert not np.isfinite(effects.additive[column(12, 'W')])